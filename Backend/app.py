@@ -1,10 +1,27 @@
+import io
+import os
+import hashlib
 import streamlit as st
 import pdfplumber
 from structured_extraction import extract_lab_values
 from explanation_engine import generate_explanation
-from rag import load_documents, create_vector_store, retrieve
 from llm_generator import analyze_with_llm
 
+# ─────────────────────────────────────────────────────────────────────────────
+# Streamlit reruns this script on every widget change. Each stage is cached
+# on exactly its inputs, so a sidebar tweak only recomputes what depends on it:
+#   PDF text + lab values   ← file hash              (age/condition changes: cached)
+#   Gemini analysis         ← file hash + context    (failures are not cached)
+#   RAG index + embeddings  ← nothing (one per server process, shared by sessions)
+# ─────────────────────────────────────────────────────────────────────────────
+
+RAG_DOCS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+class LLMUnavailable(Exception):
+    """Raised inside the cached call so an empty result is never cached."""
+
+
 def extract_text_from_pdf(file):
     with pdfplumber.open(file) as pdf:
         text = ""
@@ -12,6 +29,58 @@ def extract_text_from_pdf(file):
             text += (page.extract_text() or "")
     return text
 
+
+def file_hash(uploaded_file):
+    # Hash each upload once per session, not on every rerun
+    hashes = st.session_state.setdefault("file_hashes", {})
+    if uploaded_file.file_id not in hashes:
+        hashes[uploaded_file.file_id] = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    return hashes[uploaded_file.file_id]
+
+
+@st.cache_data(show_spinner="Reading report...", max_entries=32)
+def extract_report(report_hash, _file_bytes):
+    """(report text, lab values) — keyed by the file hash only."""
+    report_text = extract_text_from_pdf(io.BytesIO(_file_bytes))
+    return report_text, extract_lab_values(report_text)
+
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def analyze_report(report_hash, age, condition, mode, _report_text, _structured_data):
+    """Gemini analysis — keyed by (file hash, patient context)."""
+    patient_context = {
+        "age": age,
+        "condition": condition,
+        "literacyLevel": mode
+    }
+    ai_response = analyze_with_llm(_report_text, patient_context, _structured_data)
+    if not ai_response:
+        raise LLMUnavailable()
+
+    # Printed once per fresh analysis, not on every cached rerun
+    print("\n" + "="*60)
+    print("🧬 AI ANALYSIS REPORT SUMMARY")
+    print("="*60)
+    print(f"\n👤 PATIENT SUMMARY:\n{ai_response.get('patient_summary', 'N/A')}")
+    print(f"\n📄 REPORT SUMMARY:\n{ai_response.get('test_report_summary', 'N/A')}")
+    print(f"\n🏥 CLINICAL INTERPRETATION:\n{ai_response.get('clinical_interpretation', 'N/A')}")
+    print("="*60 + "\n")
+    return ai_response
+
+
+@st.cache_resource(show_spinner="Loading medical reference index...")
+def load_rag_index():
+    """Embedding model + FAISS index, built once and shared by every session."""
+    from rag import load_documents, create_vector_store
+    return create_vector_store(load_documents(RAG_DOCS_DIR))
+
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def reference_context(query):
+    from rag import retrieve
+    index, documents = load_rag_index()
+    return retrieve(query, index, documents)
+
 st.title("Dr.MeD-AI Medical Report Analyzer")
 
 # Sidebar for patient context
@@ -20,13 +89,13 @@ with st.sidebar:
     age = st.number_input("Age", min_value=0, max_value=120, value=45)
     condition = st.text_input("Known Conditions", value="None")
     mode = st.selectbox("Explanation Mode", ["Standard", "Detailed"])
+    show_references = st.checkbox("Show reference material", value=False)
 
 uploaded_file = st.file_uploader("Upload Medical Report (PDF)", type=["pdf"])
 
 if uploaded_file:
-    report_text = extract_text_from_pdf(uploaded_file)
-    
-    structured_data = extract_lab_values(report_text)
+    report_hash = file_hash(uploaded_file)
+    report_text, structured_data = extract_report(report_hash, uploaded_file.getvalue())
     
     # DEMO FALLBACK: If regex fails to find data, load demo values so the UI works
     if not structured_data:
@@ -43,26 +112,14 @@ if uploaded_file:
     # =========================================================
     # AI ANALYSIS INTEGRATION (Terminal + UI)
     # =========================================================
-    patient_context = {
-        "age": age,
-        "condition": condition,
-        "literacyLevel": mode
-    }
-
     with st.spinner("🤖 Dr.MeD-AI is analyzing the report..."):
-        ai_response = analyze_with_llm(report_text, patient_context, structured_data)
+        try:
+            ai_response = analyze_report(report_hash, age, condition, mode, report_text, structured_data)
+        except LLMUnavailable:
+            ai_response = None
 
     if ai_response:
-        # 1. PRINT TO TERMINAL
-        print("\n" + "="*60)
-        print("🧬 AI ANALYSIS REPORT SUMMARY")
-        print("="*60)
-        print(f"\n👤 PATIENT SUMMARY:\n{ai_response.get('patient_summary', 'N/A')}")
-        print(f"\n📄 REPORT SUMMARY:\n{ai_response.get('test_report_summary', 'N/A')}")
-        print(f"\n🏥 CLINICAL INTERPRETATION:\n{ai_response.get('clinical_interpretation', 'N/A')}")
-        print("="*60 + "\n")
-
-        # 2. DISPLAY IN HTML PAGE (Streamlit)
+        # DISPLAY IN HTML PAGE (Streamlit)
         st.markdown("---")
         st.header("🧬 AI Analysis Report")
         
@@ -99,4 +156,10 @@ if uploaded_file:
     st.write("### Confidence Level")
     st.write(explanation["Confidence"])
 
+    if show_references:
+        st.write("### Reference Material")
+        abnormal = [item["test"] for item in structured_data if item["status"] != "Normal"]
+        for passage in reference_context(", ".join(abnormal) or condition):
+            st.caption(passage[:500])
+
     st.warning(explanation["Safety Note"])
@@ -0,0 +1,78 @@
+import json
+import uuid
+from urllib.parse import parse_qs
+from asgiref.wsgi import WsgiToAsgi
+from backend_server import app, run_analysis_async, inflight_analyses, analysis_key, coalesced_copy
+from instrumentation import span, collect_timings
+from log_setup import request_id_var
+
+# ─────────────────────────────────────────────────────────────────────────────
+# ASGI entry point — serve many in-flight analyses from one process.
+#
+#   uvicorn asgi:application --host 0.0.0.0 --port 5001
+#
+# POST /api/analyze-async is handled natively on the event loop: the request
+# only costs a coroutine while it waits on Gemini (bounded per model by
+# LLM_MAX_CONCURRENCY), extraction runs in the default thread pool.
+# Every other route (pages, uploads, /api/analyze, /metrics ...) is passed
+# to the regular Flask app through asgiref's WSGI adapter.
+# ─────────────────────────────────────────────────────────────────────────────
+
+ASYNC_ANALYZE_PATH = '/api/analyze-async'
+
+flask_asgi = WsgiToAsgi(app)
+
+
+async def _read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def _send_json(send, payload, status, request_id):
+    body = json.dumps(payload, default=str).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            (b'x-request-id', request_id.encode()),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def analyze_async_endpoint(scope, receive, send):
+    headers = dict(scope.get('headers') or [])
+    request_id = headers.get(b'x-request-id', b'').decode() or uuid.uuid4().hex[:12]
+    request_id_var.set(request_id)
+
+    try:
+        data = json.loads(await _read_body(receive) or b'{}')
+        query = parse_qs(scope.get('query_string', b'').decode())
+        with collect_timings() as timings:
+            with span("analyze_total", mode="async"):
+                (result, status), shared = await inflight_analyses.do_async(
+                    analysis_key(data), run_analysis_async, data)
+        result = coalesced_copy(result, shared)
+
+        if data.get('timings') or query.get('timings'):
+            result["timings"] = timings
+
+        await _send_json(send, result, status, request_id)
+
+    except Exception as e:
+        await _send_json(send, {"success": False, "error": str(e)}, 500, request_id)
+
+
+async def application(scope, receive, send):
+    if (scope['type'] == 'http' and scope['path'] == ASYNC_ANALYZE_PATH
+            and scope['method'] == 'POST'):
+        await analyze_async_endpoint(scope, receive, send)
+    else:
+        await flask_asgi(scope, receive, send)
@@ -1,13 +1,29 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, Response
 from werkzeug.utils import secure_filename
 import os
 import json
 from datetime import datetime
 import uuid
 import glob
-import pdfplumber
-from structured_extraction import extract_lab_values
-from llm_generator import analyze_with_llm
+import asyncio
+from dotenv import load_dotenv
+load_dotenv()   # before the modules below read their settings from the environment
+from structured_extraction import extract_lab_values_incremental
+from table_extraction import TableLabExtractor
+from explanation_engine import needs_llm, rule_based_analysis
+from llm_generator import analyze_with_llm, analyze_with_llm_async, rewrite_for_literacy
+from instrumentation import span, collect_timings, render_metrics, Stopwatch
+from log_setup import get_logger, log_payload, request_id_var
+from persistence import save_json, debug_ring
+from upload_store import StreamingUploadRequest, save_upload
+from rate_limiter import limiter
+from singleflight import SingleFlight
+from personalization import Personalizer, personalize_text
+from grounding import verify as verify_grounding
+from lab_history import lab_history
+from static_assets import StaticAssets
+from storage_lifecycle import LifecycleManager
+from entity_extraction import extractor as entity_extractor, prompt_section, structured_additions
 import webbrowser
 from threading import Timer
 
@@ -30,28 +46,54 @@ from threading import Timer
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 FRONTEND_DIR = os.path.join(os.path.dirname(BASE_DIR), 'Frontend')
 app = Flask(__name__, static_folder=BASE_DIR, static_url_path='/static')
+app.request_class = StreamingUploadRequest   # uploads stream to disk + SHA-256
+frontend = StaticAssets(FRONTEND_DIR)               # gzip/brotli + ETag/304 for the pages
+logger = get_logger("server")
+
+# ── Request-id correlation ───────────────────────────────────────────────────
+# Every log line written while handling a request carries the same id;
+# clients can pass their own via X-Request-ID and get it echoed back.
+@app.before_request
+def assign_request_id():
+    request_id_var.set(request.headers.get('X-Request-ID') or uuid.uuid4().hex[:12])
+
+@app.after_request
+def echo_request_id(response):
+    response.headers['X-Request-ID'] = request_id_var.get()
+    return response
 
 # ── Serve medical-ai.html at the root URL ───────────────────────────────────
 @app.route('/')
 def serve_frontend():
     """Serve the main HTML page — open http://localhost:5001 in your browser."""
-    return send_from_directory(FRONTEND_DIR, 'medical-ai.html')
+    return frontend.send('medical-ai.html')
 
 @app.route('/report-summary.html')
 def serve_report_summary():
-    return send_from_directory(FRONTEND_DIR, 'report-summary.html')
+    return frontend.send('report-summary.html')
 
 # Configuration
 app.config['UPLOAD_FOLDER'] = 'uploads/'
 app.config['DATA_FOLDER'] = 'data/'
-app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 10MB max file size
+app.config['BLOB_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'blobs')  # content-addressed store
+app.config['MAX_UPLOAD_MB'] = int(os.environ.get('MAX_UPLOAD_MB', 200))  # uploads stream to disk, so this can be large
+app.config['MAX_CONTENT_LENGTH'] = app.config['MAX_UPLOAD_MB'] * 1024 * 1024
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg'}
+MAX_REPORT_TEXT_CHARS = int(os.environ.get('MAX_REPORT_TEXT_CHARS', 200_000))  # text kept per analysis
 
 # Create upload directory if it doesn't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['BLOB_FOLDER'], exist_ok=True)
 os.makedirs(os.path.join(app.config['DATA_FOLDER'], 'uploads'), exist_ok=True)
 os.makedirs(os.path.join(app.config['DATA_FOLDER'], 'analysis'), exist_ok=True)
 
+# Retention, archival of old analysis records and orphan cleanup (background)
+lifecycle = LifecycleManager(app.config['UPLOAD_FOLDER'], app.config['DATA_FOLDER'], app.config['BLOB_FOLDER'])
+
+@app.before_request
+def start_lifecycle():
+    lifecycle.ensure_started()
+
 # ==================== UTILITY FUNCTIONS ====================
 
 def allowed_file(filename):
@@ -85,6 +127,7 @@ class AIModels:
         text = ""
         try:
             if file_path.lower().endswith('.pdf'):
+                import pdfplumber   # imported on first use, not at server boot
                 with pdfplumber.open(file_path) as pdf:
                     for page in pdf.pages:
                         text += (page.extract_text() or "")
@@ -96,89 +139,147 @@ class AIModels:
                 except ImportError:
                     text = "[Image uploaded. To extract text from images, please install 'pytesseract' and 'Pillow' libraries.]"
         except Exception as e:
-            print(f"Error extracting text from {file_path}: {e}")
+            logger.warning("Text extraction failed", extra={"file": file_path, "error": str(e)})
             text = "[Image uploaded but OCR failed. Tesseract-OCR is likely not installed or not in PATH. Please install Tesseract to read images.]"
         return text
     
     @staticmethod
-    def nlp_extract(text):
+    def iter_report_pages(file_path, tables=True, stopwatch=None):
         """
-        NLP model to extract medical entities
-        TODO: Implement with your NLP model (BERT, BioBERT, etc.)
+        Yield (page_text, table_rows, unparsed) one PDF page at a time
+        (images: one OCR chunk, no rows), releasing pdfplumber's per-page
+        layout caches after each page so memory stays flat regardless of page
+        count. table_rows are lab values read from the page's table columns,
+        or None when the page has no recognizable table (caller falls back to
+        regex); unparsed is the text of table lines that didn't make a row
+        (caller runs the regex over it). Table parsing time is added to
+        stopwatch, if given.
         """
-        # Mock extraction
-        return {
-            "entities": [
-                {"type": "measurement", "name": "Blood Glucose", "value": 105, "unit": "mg/dL"},
-                {"type": "measurement", "name": "HbA1c", "value": 6.2, "unit": "%"},
-                {"type": "measurement", "name": "Total Cholesterol", "value": 215, "unit": "mg/dL"}
-            ]
-        }
+        stopwatch = stopwatch or Stopwatch()
+        if not file_path.lower().endswith('.pdf'):
+            yield AIModels.extract_text_from_report(file_path), None, None
+            return
+        try:
+            import pdfplumber   # imported on first use, not at server boot
+            with pdfplumber.open(file_path) as pdf:
+                table_extractor = TableLabExtractor()
+                for page in pdf.pages:
+                    text = page.extract_text() or ""
+                    rows, unparsed = None, None
+                    if tables:
+                        with stopwatch.running():
+                            rows, unparsed = table_extractor.extract_page(page, text)
+                    # pdfplumber >= 0.10: close(); older versions: flush_cache()
+                    (getattr(page, 'close', None) or page.flush_cache)()
+                    yield text, rows, unparsed
+        except Exception as e:
+            logger.warning("Text extraction failed", extra={"file": file_path, "error": str(e)})
+
+    @staticmethod
+    def iter_report_text(file_path):
+        """Page texts only (no table parsing) — see iter_report_pages."""
+        for text, _, _ in AIModels.iter_report_pages(file_path, tables=False):
+            yield text
+    
+    @staticmethod
+    def nlp_extract(text, patient_context=None):
+        """
+        Medical entities (measurements, medications) via the lexicon matcher
+        in entity_extraction.py — local, linear in the text length.
+        """
+        return entity_extractor.extract(text, patient_context)
+
+    @staticmethod
+    def nlp_extract_batch(texts, patient_contexts=None):
+        """nlp_extract() for many documents in one call."""
+        return entity_extractor.extract_batch(texts, patient_contexts)
     
     @staticmethod
     def classify_condition(features):
         """
-        Classification model for medical conditions
-        TODO: Implement with your classifier (Random Forest, Neural Network, etc.)
+        Classification model for medical conditions (risk_model.py).
+        features: patient context (age, sex, condition) + "labs"
         """
-        return {
-            "condition": "Type 2 Diabetes",
-            "confidence": 0.92,
-            "severity": "mild"
-        }
+        from risk_model import model as risk_model   # NumPy loads on first use
+        return risk_model.classify([features])[0]
+    
+    @staticmethod
+    def classify_conditions(patients):
+        """Batch classification — one vectorized pass for all patients"""
+        from risk_model import model as risk_model
+        return risk_model.classify(patients)
     
     @staticmethod
     def assess_risk(patient_data):
         """
-        Risk assessment model
-        TODO: Implement risk prediction model
+        Risk assessment model (risk_model.py) — per-outcome probabilities
+        plus "overall" (chance of at least one)
         """
-        return {
-            "cardiovascular": 0.15,
-            "diabetes": 0.32,
-            "kidney": 0.08,
-            "overall": 0.25
-        }
+        from risk_model import model as risk_model
+        return risk_model.assess([patient_data])[0]
+    
+    @staticmethod
+    def assess_risks(patients):
+        """Batch risk assessment — one vectorized pass for all patients"""
+        from risk_model import model as risk_model
+        return risk_model.assess(patients)
     
     @staticmethod
-    def rag_query(query, context):
+    def rag_query(query, context, top_k=2):
         """
-        RAG system for medical knowledge retrieval
-        TODO: Implement RAG with vector database (Pinecone, Weaviate, etc.)
+        Reference passages for a query (rag.py). With RAG_SOCKET set, every
+        worker shares the embedding sidecar instead of loading its own model.
         """
+        index, documents = rag_store()
+        import rag
+        hits = rag.search(query, index, documents, top_k)
         return {
-            "answer": "Based on medical guidelines, this indicates...",
-            "sources": [
-                {"title": "Medical Reference", "url": "https://...", "relevance": 0.95}
-            ]
+            "answer": hits[0][0] if hits else "",
+            "sources": [{"title": (document.strip().splitlines() or [""])[0][:80], "excerpt": document[:500],
+                         "relevance": round(1.0 / (1.0 + distance), 3)}
+                        for document, distance in hits]
         }
     
     @staticmethod
     def personalize_explanation(content, patient_profile):
         """
-        Personalization model
-        TODO: Implement personalization based on literacy level
+        Personalization for free-standing content (see personalization.py;
+        stored analyses go through personalizer.get instead)
         """
-        literacy_level = patient_profile.get('literacyLevel', 'medium')
-        if 'low' in literacy_level.lower():
-            return "Your blood sugar is good. Keep doing what you're doing!"
-        elif 'high' in literacy_level.lower():
-            return "HbA1c of 6.2% indicates glycemic control within target range..."
-        else:
-            return "Your HbA1c is 6.2%, which means your average blood sugar is well-controlled..."
+        return personalize_text(content, patient_profile.get('literacyLevel', 'medium'),
+                                rewrite=rewrite_for_literacy)
     
     @staticmethod
     def calculate_confidence(analysis, source_data):
         """
-        Confidence scoring and hallucination detection
-        TODO: Implement confidence calculation
+        Confidence scoring and hallucination detection: numeric claims in the
+        analysis are checked against the extracted values (grounding.py)
         """
-        return {
-            "confidenceScore": 0.96,
-            "hallucinationRisk": "low",
-            "verifiedStatements": 45,
-            "uncertainStatements": 2
-        }
+        return verify_grounding(
+            analysis,
+            source_data.get('structuredData') or source_data.get('labs') or [],
+            source_data.get('extractedText') or source_data.get('text') or '',
+            source_data.get('patientContext')
+        )
+
+def warm_up():
+    """
+    Heavy libraries (pdfplumber, the Gemini SDK, NumPy) are imported on first
+    use so the server boots fast, and the frontend pages are compressed on
+    their first request. Production calls this once before forking
+    workers (serve.py, PREWARM=1) so the first requests don't pay for them
+    and every worker shares the loaded modules copy-on-write.
+    """
+    import pdfplumber  # noqa: F401
+    import knowledge_base
+    from llm_generator import warm_up as warm_up_llm
+    from risk_model import model as risk_model
+    warm_up_llm()
+    risk_model.load()
+    len(knowledge_base.table)   # builds the alias index
+    entity_extractor.load()      # builds the Aho-Corasick automaton
+    frontend.preload('medical-ai.html', 'report-summary.html')
+    logger.info("Pre-warm complete")
 
 # ==================== API ENDPOINTS ====================
 
@@ -201,8 +302,9 @@ def upload_report():
                 if file.filename != '' and allowed_file(file.filename):
                     filename = secure_filename(file.filename)
                     file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}_report_{filename}")
-                    file.save(file_path)
-                    files_saved.append({"type": "report", "path": file_path, "name": filename})
+                    with span("upload_save"):
+                        stored = save_upload(file, file_path)
+                    files_saved.append({"type": "report", "path": file_path, "name": filename, **stored})
 
         # Handle Prescription
         if 'prescription' in request.files:
@@ -211,8 +313,9 @@ def upload_report():
                 if file.filename != '' and allowed_file(file.filename):
                     filename = secure_filename(file.filename)
                     file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}_prescription_{filename}")
-                    file.save(file_path)
-                    files_saved.append({"type": "prescription", "path": file_path, "name": filename})
+                    with span("upload_save"):
+                        stored = save_upload(file, file_path)
+                    files_saved.append({"type": "prescription", "path": file_path, "name": filename, **stored})
         
         if not files_saved:
              return jsonify({"success": False, "error": "No valid files saved"}), 400
@@ -225,12 +328,12 @@ def upload_report():
             "uploadedAt": datetime.now().isoformat()
         }
         
-        # Save metadata to JSON storage
+        # Save metadata to JSON storage (write-behind, off the request thread)
         try:
-            with open(os.path.join(app.config['DATA_FOLDER'], 'uploads', f"{file_id}.json"), 'w') as f:
-                json.dump(metadata, f, indent=2)
+            with span("persistence", kind="upload_metadata"):
+                save_json(os.path.join(app.config['DATA_FOLDER'], 'uploads', f"{file_id}.json"), metadata)
         except Exception as e:
-            print(f"Warning: Failed to save upload metadata: {e}")
+            logger.warning("Failed to save upload metadata", extra={"error": str(e)})
 
         return jsonify({
             "success": True,
@@ -246,182 +349,375 @@ def upload_report():
             "error": str(e)
         }), 500
 
+# Reference documents for /api/rag/query: embedded and indexed on first query
+# (in the sidecar when RAG_SOCKET is set, otherwise in this worker)
+RAG_DOCS_DIR = os.path.join(BASE_DIR, 'data')
+_rag_loading = SingleFlight()
+_rag_corpus = None
+
+def rag_store():
+    """(index, documents), built once per worker process."""
+    global _rag_corpus
+    if _rag_corpus is None:
+        import rag
+        _rag_corpus, _ = _rag_loading.do('corpus', lambda: rag.create_vector_store(rag.load_documents(RAG_DOCS_DIR)))
+    return _rag_corpus
+
+# Double-clicks and frontend retries for the same file + context attach to the
+# analysis already running instead of starting a second extraction + LLM call.
+inflight_analyses = SingleFlight()
+
+def analysis_key(data):
+    """
+    Identity of an analyze request: everything that changes the result or
+    where it is recorded — file, context, models, mode (rules vs. LLM), and
+    the patient/date its lab values are appended under.
+    """
+    patient_context = data.get('patientContext', {})
+    return json.dumps({
+        "fileId": data.get('fileId'),
+        "patientContext": patient_context,
+        "models": data.get('models', {}),
+        "analysisMode": data.get('analysisMode', 'auto'),
+        "patientId": data.get('patientId') or patient_context.get('patientId'),
+        "reportDate": data.get('reportDate')
+    }, sort_keys=True, default=str)
+
+def coalesced_copy(result, shared):
+    # Every caller gets its own copy (timings are added per request)
+    result = dict(result)
+    if shared:
+        result["coalesced"] = True
+    return result
+
+# Literacy variants of finished analyses, built on first request and cached
+personalizer = Personalizer(os.path.join(app.config['DATA_FOLDER'], 'analysis'),
+                            rewrite=rewrite_for_literacy, load_archived=lifecycle.archive.load)
+
 @app.route('/api/analyze', methods=['POST'])
 def analyze_report():
     """Analyze medical report using AI models"""
     try:
         data = request.json
-        file_id = data.get('fileId')
-        patient_context = data.get('patientContext', {})
-        models_config = data.get('models', {})
-        
-        # Find the file using file_id
-        search_pattern = os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}_*")
-        files = glob.glob(search_pattern)
-        
-        if not files:
-            return jsonify({"success": False, "error": "File not found"}), 404
-            
-        # Step 1: Extract text from all files
-        extracted_text = ""
-        for file_path in files:
-            extracted_text += AIModels.extract_text_from_report(file_path) + "\n"
-        
-        # Step 2: Extract structured data (Real Logic)
-        structured_data = extract_lab_values(extracted_text)
-        
-        # Step 2: NLP extraction
-        nlp_results = AIModels.nlp_extract(extracted_text) if models_config.get('nlp') else None
-        
-        # Step 3: Classification
-        classification = AIModels.classify_condition(patient_context) if models_config.get('classifier') else None
-        
-        # Step 4: Risk assessment
-        risk_scores = AIModels.assess_risk(patient_context) if models_config.get('risk') else None
-        
-        # Step 5: Generate findings (Map structured_data to frontend format)
-        findings = []
-        for item in structured_data:
-            findings.append({
-                "label": item['test'],
-                "value": str(item['value']),
-                "status": item['status'].lower(),
-                "normalRange": item['range'],
-                "unit": "" 
-            })
-            
-        # Step 6: Generate AI Analysis (LLM)
-        print("🤖 Sending data to Gemini AI...")
-        llm_result = analyze_with_llm(extracted_text, patient_context, structured_data, file_paths=files)
+        with collect_timings() as timings:
+            with span("analyze_total"):
+                (result, status), shared = inflight_analyses.do(analysis_key(data), run_analysis, data)
+        result = coalesced_copy(result, shared)
 
-        # Save last LLM result to a debug file so /api/debug-last can serve it
-        try:
-            debug_payload = {
-                "llm_result": llm_result,
-                "extracted_text_preview": extracted_text[:500],
-                "structured_data": structured_data,
-                "timestamp": datetime.now().isoformat()
-            }
-            with open(os.path.join(BASE_DIR, '_debug_last.json'), 'w') as dbf:
-                json.dump(debug_payload, dbf, indent=2)
-        except Exception:
-            pass
-        
-        ai_response_data = {}
-        
-        if llm_result:
-            # Use LLM generated content
-            ai_response_data = {
-                "patient_summary": llm_result.get('patient_summary', "Not available"),
-                "test_report_summary": llm_result.get('test_report_summary', "Not available"),
-                "clinical_interpretation": llm_result.get('clinical_interpretation', "Not available"),
-                "known_information": llm_result.get('known_information', []),
-                "unclear_information": llm_result.get('unclear_information', [])
-            }
+        # Per-stage timings (ms) only when asked: {"timings": true} or ?timings=1
+        if data.get('timings') or request.args.get('timings'):
+            result["timings"] = timings
 
-            # Print analysis to terminal
-            print("\n" + "="*60)
-            print("🧬 AI ANALYSIS REPORT SUMMARY")
-            print("="*60)
-            print(f"\n👤 PATIENT SUMMARY:\n{ai_response_data['patient_summary']}")
-            print(f"\n📄 REPORT SUMMARY:\n{ai_response_data['test_report_summary']}")
-            print(f"\n🏥 CLINICAL INTERPRETATION:\n{ai_response_data['clinical_interpretation']}")
-            
-            if ai_response_data['known_information']:
-                print("\n✅ KNOWN INFORMATION:")
-                for item in ai_response_data['known_information']:
-                    print(f"  • {item}")
-            
-            if ai_response_data['unclear_information']:
-                print("\n❓ UNCLEAR / MISSING:")
-                for item in ai_response_data['unclear_information']:
-                    print(f"  • {item}")
-            print("="*60 + "\n")
-
-            recommendations = llm_result.get('recommendations', [])
-            uncertainties = llm_result.get('unclear_information', [])
-            confidence_score = 0.98 # High confidence when LLM works
-        else:
-            # Fallback if API fails (Demo Mode)
-            print("⚠️ Using Fallback/Demo Data")
-            personalized_analysis = "Based on the analysis of your report, we detected several key values. Please verify with your doctor."
-            recommendations = [
-                {"title": "Consult Doctor", "description": "Please review these findings with a specialist.", "icon": "👨‍⚕️", "priority": "high"}
-            ]
-            ai_response_data = {
-                "patient_summary": "Patient data extracted (Demo Mode)",
-                "test_report_summary": "Report analysis unavailable (Demo Mode)",
-                "clinical_interpretation": personalized_analysis,
-                "known_information": ["Analysis run in demo mode", "AI model not connected"],
-                "unclear_information": ["Full context unavailable"]
-            }
-            uncertainties = ["Unable to verify specific context without AI connection"]
-            confidence_score = 0.85
-        
-        # Compile response
-        response = {
-            "success": True,
-            "analysisId": f"analysis_{uuid.uuid4().hex[:8]}",
-            "confidence": int(confidence_score * 100),
-            "aiResponse": ai_response_data,
-            "findings": findings,
-            "analysis": ai_response_data.get('clinical_interpretation', ''),
-            "recommendations": recommendations,
-            "uncertainties": uncertainties,
-            "riskScore": risk_scores or {"overall": 0.25},
-            "classification": classification,
-            "processedAt": datetime.now().isoformat()
-        }
+        return jsonify(result), status
         
-        # Save analysis to JSON storage
-        try:
-            analysis_record = {
-                "analysisId": response["analysisId"],
-                "fileId": file_id,
-                "patientContext": patient_context,
-                "result": response,
-                "timestamp": datetime.now().isoformat()
-            }
-            with open(os.path.join(app.config['DATA_FOLDER'], 'analysis', f"{response['analysisId']}.json"), 'w') as f:
-                json.dump(analysis_record, f, indent=2)
-        except Exception as e:
-            print(f"Warning: Failed to save analysis record: {e}")
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+@app.route('/api/analyze-async', methods=['POST'])
+async def analyze_report_async():
+    """
+    Same contract as /api/analyze, but the Gemini call is awaited instead of
+    holding a thread — when served by asgi.py (uvicorn), which handles this
+    path natively on one event loop. Here (dev server / WSGI) every async
+    view gets an event loop of its own, so per-loop coalescing would never
+    match: the pipeline runs in a worker thread through the thread-level
+    SingleFlight, coalescing with /api/analyze like any other request.
+    """
+    try:
+        data = request.json
+        with collect_timings() as timings:
+            with span("analyze_total", mode="async"):
+                (result, status), shared = await asyncio.to_thread(
+                    inflight_analyses.do, analysis_key(data), run_analysis, data)
+        result = coalesced_copy(result, shared)
+
+        if data.get('timings') or request.args.get('timings'):
+            result["timings"] = timings
+
+        return jsonify(result), status
 
-        return jsonify(response), 200
-        
     except Exception as e:
         return jsonify({
             "success": False,
             "error": str(e)
         }), 500
 
+def run_analysis(data):
+    """
+    Full analysis pipeline for one /api/analyze request body.
+    Returns (response_dict, http_status).
+    """
+    prep = _prepare_analysis(data)
+    if prep is None:
+        return {"success": False, "error": "File not found"}, 404
+
+    # Step 6: Generate AI Analysis — the LLM only runs when the rule engine
+    # can't cover the report or the user asked for a detailed narrative
+    llm_result = None
+    if needs_llm(prep["structured_data"], data.get('analysisMode', 'auto')):
+        logger.info("Sending data to Gemini", extra={"fileId": prep["file_id"], "labValues": len(prep["structured_data"])})
+        llm_result = analyze_with_llm(prep["extracted_text"], prep["patient_context"],
+                                      prep["structured_data"], file_paths=prep["files"],
+                                      priority=data.get('priority', 'interactive'),
+                                      history=prep["history"], entities=prep["entities"])
+    return _finish_analysis(prep, llm_result), 200
+
+async def run_analysis_async(data):
+    """
+    Async run_analysis(): CPU/disk-bound extraction and the finishing steps
+    (grounding, lab-history append under an SQLite write lock) run in a
+    worker thread, the LLM call is awaited — nothing blocks the event loop.
+    """
+    prep = await asyncio.to_thread(_prepare_analysis, data)
+    if prep is None:
+        return {"success": False, "error": "File not found"}, 404
+
+    llm_result = None
+    if needs_llm(prep["structured_data"], data.get('analysisMode', 'auto')):
+        logger.info("Sending data to Gemini", extra={"fileId": prep["file_id"], "labValues": len(prep["structured_data"])})
+        llm_result = await analyze_with_llm_async(prep["extracted_text"], prep["patient_context"],
+                                                  prep["structured_data"], file_paths=prep["files"],
+                                                  priority=data.get('priority', 'interactive'),
+                                                  history=prep["history"], entities=prep["entities"])
+    return await asyncio.to_thread(_finish_analysis, prep, llm_result), 200
+
+def _prepare_analysis(data):
+    """
+    Steps 1-5: locate the uploaded files, extract text and lab values and run
+    the local models. Returns the intermediate results, or None if the fileId
+    has no files.
+    """
+    file_id = data.get('fileId')
+    patient_context = data.get('patientContext', {})
+    patient_id = data.get('patientId') or patient_context.get('patientId')
+    models_config = data.get('models', {})
+    
+    # Find the file using file_id
+    search_pattern = os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}_*")
+    files = glob.glob(search_pattern)
+    
+    if not files:
+        return None
+        
+    # Step 1 + 2: Stream text page by page into the lab value extractors.
+    # Pages with a recognizable results table are read column by column;
+    # the rest go through the regex extractor. Only the first
+    # MAX_REPORT_TEXT_CHARS are kept for the prompt/debug view, so a
+    # 300-page scan never sits in memory as one giant string.
+    # lab_extraction = table parsing + regex over each page, summed (part of text_extraction)
+    retained = []
+    retained_chars = 0
+    table_values = []
+    lab_time = Stopwatch()
+
+    def pages():
+        nonlocal retained_chars
+        for file_path in files:
+            for page_text, table_rows, unparsed in AIModels.iter_report_pages(file_path, stopwatch=lab_time):
+                if retained_chars < MAX_REPORT_TEXT_CHARS:
+                    retained.append(page_text[:MAX_REPORT_TEXT_CHARS - retained_chars])
+                    retained_chars += len(retained[-1])
+                # The regex runs while we're suspended at the yield → timed as lab extraction
+                with lab_time.running():
+                    if table_rows:
+                        table_values.extend(table_rows)
+                        # already parsed — only table lines that didn't make a row go to the regex
+                        yield "\n" + (unparsed or "") + "\n"
+                    else:
+                        yield page_text
+            retained.append("\n")
+            with lab_time.running():
+                yield "\n"
+
+    with span("text_extraction"):
+        regex_values = extract_lab_values_incremental(pages())
+    lab_time.record("lab_extraction")
+    structured_data = table_values + regex_values
+    extracted_text = "".join(retained)
+    
+    # Step 2: Entity extraction — values the table/regex pass missed become
+    # findings too; medications go to the prompt so Gemini doesn't re-extract
+    with span("nlp"):
+        nlp_results = AIModels.nlp_extract(extracted_text, patient_context)
+    structured_data = structured_data + structured_additions(nlp_results, structured_data)
+    entities = prompt_section(nlp_results, structured_data)
+    
+    # Step 3: Classification
+    patient_features = {**patient_context, "labs": structured_data}
+    classification = AIModels.classify_condition(patient_features) if models_config.get('classifier') else None
+    
+    # Step 4: Risk assessment
+    risk_scores = AIModels.assess_risk(patient_features) if models_config.get('risk') else None
+    
+    # Step 5: Generate findings (Map structured_data to frontend format)
+    findings = []
+    for item in structured_data:
+        findings.append({
+            "label": item['test'],
+            "value": str(item['value']),
+            "status": item['status'].lower(),
+            "normalRange": item['range'],
+            "unit": item.get('unit', '')
+        })
+
+    # Previous results for this patient, summarized for the prompt
+    with span("lab_history", kind="summary"):
+        history = lab_history.summary(patient_id, structured_data, before=data.get('reportDate'),
+                                      file_id=file_id)
+
+    return {
+        "file_id": file_id,
+        "patient_context": patient_context,
+        "patient_id": patient_id,
+        "report_date": data.get('reportDate'),
+        "history": history,
+        "entities": entities,
+        "nlp_results": nlp_results if models_config.get('nlp') else None,
+        "files": files,
+        "extracted_text": extracted_text,
+        "structured_data": structured_data,
+        "classification": classification,
+        "risk_scores": risk_scores,
+        "findings": findings
+    }
+
+def _finish_analysis(prep, llm_result):
+    """
+    Step 7: assemble the response and persist it. Source, in order: the LLM
+    result, the rule engine (when lab values were extracted — also covers a
+    failed LLM call), the demo fallback.
+    """
+    file_id = prep["file_id"]
+    patient_context = prep["patient_context"]
+    extracted_text = prep["extracted_text"]
+    structured_data = prep["structured_data"]
+    findings = prep["findings"]
+    classification = prep["classification"]
+    risk_scores = prep["risk_scores"]
+
+    # Keep this request's LLM result in the in-memory ring so /api/debug-last can serve it
+    debug_ring.add(request_id_var.get(), {
+        "requestId": request_id_var.get(),
+        "llm_result": llm_result,
+        "extracted_text_preview": extracted_text[:500],
+        "structured_data": structured_data,
+        "timestamp": datetime.now().isoformat()
+    })
+    
+    ai_response_data = {}
+    grounding = None
+    
+    if llm_result:
+        # Use LLM generated content
+        ai_response_data = {
+            "patient_summary": llm_result.get('patient_summary', "Not available"),
+            "test_report_summary": llm_result.get('test_report_summary', "Not available"),
+            "clinical_interpretation": llm_result.get('clinical_interpretation', "Not available"),
+            "known_information": llm_result.get('known_information', []),
+            "unclear_information": llm_result.get('unclear_information', [])
+        }
+
+        # Full summary only at DEBUG (or sampled) — never on every request
+        log_payload(logger, "AI analysis report summary", ai_response_data)
+
+        recommendations = llm_result.get('recommendations', [])
+        uncertainties = llm_result.get('unclear_information', [])
+
+        # Confidence = how many of the LLM's numbers the report actually backs
+        with span("grounding"):
+            grounding = AIModels.calculate_confidence(ai_response_data, {
+                "structuredData": structured_data,
+                "extractedText": extracted_text,
+                "patientContext": patient_context
+            })
+        confidence_score = grounding["confidenceScore"]
+        analysis_tier = "llm"
+    elif structured_data:
+        # Deterministic explanation engine — milliseconds, no LLM call
+        with span("rule_analysis"):
+            rules = rule_based_analysis(structured_data, patient_context)
+        ai_response_data = {key: rules[key] for key in (
+            "patient_summary", "test_report_summary", "clinical_interpretation",
+            "known_information", "unclear_information")}
+        recommendations = rules["recommendations"]
+        uncertainties = rules["unclear_information"]
+        confidence_score = rules["confidence"]
+        analysis_tier = "rules"
+    else:
+        # Fallback if API fails (Demo Mode)
+        logger.warning("Using Fallback/Demo Data", extra={"fileId": file_id})
+        personalized_analysis = "Based on the analysis of your report, we detected several key values. Please verify with your doctor."
+        recommendations = [
+            {"title": "Consult Doctor", "description": "Please review these findings with a specialist.", "icon": "👨‍⚕️", "priority": "high"}
+        ]
+        ai_response_data = {
+            "patient_summary": "Patient data extracted (Demo Mode)",
+            "test_report_summary": "Report analysis unavailable (Demo Mode)",
+            "clinical_interpretation": personalized_analysis,
+            "known_information": ["Analysis run in demo mode", "AI model not connected"],
+            "unclear_information": ["Full context unavailable"]
+        }
+        uncertainties = ["Unable to verify specific context without AI connection"]
+        confidence_score = 0.85
+        analysis_tier = "demo"
+    
+    # Compile response
+    response = {
+        "success": True,
+        "analysisId": f"analysis_{uuid.uuid4().hex[:8]}",
+        "confidence": int(confidence_score * 100),
+        "aiResponse": ai_response_data,
+        "findings": findings,
+        "analysis": ai_response_data.get('clinical_interpretation', ''),
+        "recommendations": recommendations,
+        "uncertainties": uncertainties,
+        "riskScore": risk_scores or {"overall": 0.25},
+        "classification": classification,
+        "analysisTier": analysis_tier,
+        "grounding": grounding,
+        "entities": prep["nlp_results"]["entities"] if prep["nlp_results"] else None,
+        "processedAt": datetime.now().isoformat()
+    }
+    
+    # Save analysis to JSON storage
+    try:
+        analysis_record = {
+            "analysisId": response["analysisId"],
+            "fileId": file_id,
+            "patientId": prep["patient_id"],
+            "patientContext": patient_context,
+            "structuredData": structured_data,
+            "result": response,
+            "timestamp": datetime.now().isoformat()
+        }
+        with span("persistence", kind="analysis_record"):
+            save_json(os.path.join(app.config['DATA_FOLDER'], 'analysis', f"{response['analysisId']}.json"), analysis_record)
+        personalizer.remember(analysis_record)
+    except Exception as e:
+        logger.warning("Failed to save analysis record", extra={"error": str(e)})
+
+    # Append the lab values to the patient's time series (trend queries)
+    try:
+        with span("lab_history", kind="append"):
+            lab_history.append(prep["patient_id"], response["analysisId"], structured_data, prep["report_date"],
+                               file_id=file_id)
+    except Exception as e:
+        logger.warning("Failed to record lab history", extra={"error": str(e)})
+
+    return response
+
 @app.route('/api/patient/history', methods=['GET'])
 def get_patient_history():
     """Get patient's medical history"""
     try:
         patient_id = request.args.get('patientId')
         
-        # Fetch from JSON storage
-        history = []
-        analysis_path = os.path.join(app.config['DATA_FOLDER'], 'analysis')
-        if os.path.exists(analysis_path):
-            files = glob.glob(os.path.join(analysis_path, "*.json"))
-            for f_path in files:
-                try:
-                    with open(f_path, 'r') as f:
-                        record = json.load(f)
-                        # In a real app, filter by patient_id here
-                        history.append({
-                            "date": record['timestamp'].split('T')[0],
-                            "reportType": "Medical Report",
-                            "analysisId": record['analysisId'],
-                            "summary": record['result'].get('analysis', '')[:100] + "..."
-                        })
-                except:
-                    continue
-        
-        # Sort by date descending
-        history.sort(key=lambda x: x['date'], reverse=True)
+        # Live JSON records + the archive index (records packed by the lifecycle sweep)
+        with span("persistence", kind="history"):
+            history = lifecycle.history(patient_id)
         
         return jsonify({
             "success": True,
@@ -432,6 +728,28 @@ def get_patient_history():
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/api/patient/trends', methods=['GET'])
+def get_patient_trends():
+    """Lab value trends for one patient (optionally one test)"""
+    try:
+        patient_id = request.args.get('patientId')
+        if not patient_id:
+            return jsonify({"success": False, "error": "patientId is required"}), 400
+        limit = request.args.get('limit', type=int)
+        
+        with span("lab_history", kind="trends"):
+            trends = lab_history.trends(patient_id, request.args.get('analyte'),
+                                        since=request.args.get('since'), limit=limit)
+        
+        return jsonify({
+            "success": True,
+            "patientId": patient_id,
+            "trends": trends
+        }), 200
+        
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
 @app.route('/api/doctor/verify', methods=['POST'])
 def verify_analysis():
     """Doctor verification of AI analysis"""
@@ -506,12 +824,28 @@ def nlp_extract():
         data = request.json
         text = data.get('text', '')
         
-        result = AIModels.nlp_extract(text)
+        with span("nlp", kind="extract"):
+            result = AIModels.nlp_extract(text, data.get('patientContext'))
         return jsonify(result), 200
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/models/nlp/extract/batch', methods=['POST'])
+def nlp_extract_batch():
+    """Batch NLP extraction endpoint"""
+    try:
+        data = request.json
+        documents = [d if isinstance(d, dict) else {"text": d} for d in data.get('documents', [])]
+        
+        with span("nlp", kind="extract_batch"):
+            results = AIModels.nlp_extract_batch([d.get('text', '') for d in documents],
+                                                 [d.get('patientContext') for d in documents])
+        return jsonify({"results": results, "count": len(results)}), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/models/classify', methods=['POST'])
 def classify():
     """Classification endpoint"""
@@ -525,18 +859,46 @@ def classify():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/models/classify/batch', methods=['POST'])
+def classify_batch():
+    """Batch classification endpoint"""
+    try:
+        data = request.json
+        patients = data.get('patients', [])
+        
+        with span("risk_model", kind="classify_batch"):
+            results = AIModels.classify_conditions(patients)
+        return jsonify({"results": results, "count": len(results)}), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/models/risk-assessment', methods=['POST'])
 def risk_assessment():
     """Risk assessment endpoint"""
     try:
         data = request.json
         
-        result = AIModels.assess_risk(data)
+        result = AIModels.assess_risk(data.get('patientData', data))
         return jsonify({"riskScores": result}), 200
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/models/risk-assessment/batch', methods=['POST'])
+def risk_assessment_batch():
+    """Batch risk assessment endpoint"""
+    try:
+        data = request.json
+        patients = data.get('patients', [])
+        
+        with span("risk_model", kind="risk_batch"):
+            results = AIModels.assess_risks(patients)
+        return jsonify({"riskScores": results, "count": len(results)}), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/rag/query', methods=['POST'])
 def rag_query():
     """RAG system query endpoint"""
@@ -558,7 +920,15 @@ def personalize():
         data = request.json
         content = data.get('content', '')
         profile = data.get('patientProfile', {})
-        
+        analysis_id = data.get('analysisId')
+
+        # Stored analysis → cached literacy variant (no new analysis)
+        if analysis_id:
+            variant, cached = personalizer.get(analysis_id, profile.get('literacyLevel', 'medium'))
+            if variant is None:
+                return jsonify({"error": f"Unknown analysisId: {analysis_id}"}), 404
+            return jsonify({"personalizedContent": variant, "cached": cached}), 200
+
         result = AIModels.personalize_explanation(content, profile)
         return jsonify({"personalizedContent": result}), 200
         
@@ -585,12 +955,30 @@ def confidence_score():
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """API health check"""
+    try:
+        rate_limits = limiter.stats()
+    except Exception as e:
+        rate_limits = {"error": str(e)}
     return jsonify({
         "status": "healthy",
         "version": "1.0.0",
+        "rateLimits": rate_limits,
         "timestamp": datetime.now().isoformat()
     }), 200
 
+# ==================== METRICS ====================
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus scrape endpoint — per-stage duration histograms
+    (upload_save, text_extraction, lab_extraction — the table/regex share
+    of text_extraction —, nlp, rule_analysis, llm_call per model, json_parse, grounding,
+    lab_history, persistence, persistence_flush, personalize, risk_model,
+    analyze_total).
+    """
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 # ==================== DEBUG: LAST LLM RESPONSE ====================
 
 @app.route('/api/debug-last', methods=['GET'])
@@ -599,12 +987,17 @@ def debug_last():
     Returns the raw LLM result from the most recent /api/analyze call.
     Open http://localhost:5001/api/debug-last in your browser to inspect
     exactly what Gemini returned — useful when HTML display is blank.
+
+    Pass ?requestId=<X-Request-ID of an analyze call> to get that specific
+    request instead of the latest (last DEBUG_RING_SIZE calls are kept in memory).
     """
-    path = os.path.join(BASE_DIR, '_debug_last.json')
-    if not os.path.exists(path):
-        return jsonify({"message": "No analysis run yet. Call /api/analyze first."}), 404
-    with open(path, 'r') as f:
-        return jsonify(json.load(f)), 200
+    payload = debug_ring.get(request.args.get('requestId'))
+    if payload is None:
+        return jsonify({
+            "message": "No matching analysis in memory. Call /api/analyze first.",
+            "availableRequestIds": debug_ring.request_ids()
+        }), 404
+    return jsonify(payload), 200
 
 # ==================== TEST CONNECTION (Frontend Debug) ====================
 
@@ -672,7 +1065,7 @@ def request_entity_too_large(error):
         "success": False,
         "error": {
             "code": "FILE_TOO_LARGE",
-            "message": "File size exceeds 10MB limit"
+            "message": f"File size exceeds {app.config['MAX_UPLOAD_MB']}MB limit"
         }
     }), 413
 
@@ -713,7 +1106,11 @@ if __name__ == '__main__':
     print("    GET   /              → serves medical-ai.html")
     print("    POST  /api/upload-report")
     print("    POST  /api/analyze")
+    print("    POST  /api/analyze-async")
     print("    GET   /api/health")
+    print("    GET   /metrics")
+    print("")
+    print("  Development server only — for production run: python serve.py")
     print("=" * 60)
     
     # Allow port to be set via environment variable (Terminal input)
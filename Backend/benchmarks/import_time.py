@@ -0,0 +1,85 @@
+"""
+Server boot import profile (python -X importtime).
+
+    cd Backend
+    python benchmarks/import_time.py                  # top 15 slowest imports
+    python benchmarks/import_time.py --top 30
+    python benchmarks/import_time.py --max-ms 800     # exit 1 above budget (CI)
+
+Imports backend_server in a fresh interpreter with -X importtime and reports
+the total import time and the slowest modules (cumulative, including their
+own imports). Fails (exit 1) if:
+
+    - any module in LAZY_MODULES was imported at boot — these must only be
+      imported on first use (see warm_up() in backend_server.py), or
+    - --max-ms is given and the total exceeds it.
+
+Take the median of a few runs before moving the budget: the first run after
+a cold disk cache is always slower.
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Heavy packages that must not be imported just to boot the server
+LAZY_MODULES = ("pdfplumber", "google.generativeai", "numpy", "sentence_transformers", "faiss")
+
+
+def profile(module="backend_server", runs=3):
+    """[(cumulative_us, self_us, name)] for the median-total run."""
+    results = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=BACKEND_DIR, capture_output=True, text=True,
+            env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"})
+        if out.returncode != 0:
+            sys.exit(f"import {module} failed:\n{out.stderr[-2000:]}")
+        rows = []
+        for line in out.stderr.splitlines():
+            # "import time:  self [us] | cumulative | imported package"
+            if not line.startswith("import time:") or "imported package" in line:
+                continue
+            self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+            rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+        results.append(rows)
+    results.sort(key=lambda rows: _total(rows, module))
+    return results[len(results) // 2]
+
+
+def _total(rows, module):
+    return next((cum for cum, _, name in rows if name.strip() == module), 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="backend_server")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--max-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    rows = profile(args.module, args.runs)
+    total_ms = _total(rows, args.module) / 1000
+    print(f"import {args.module}: {total_ms:.1f} ms  ({len(rows)} modules, median of {args.runs})\n")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for cumulative, self_us, name in sorted(rows, reverse=True)[:args.top]:
+        print(f"{cumulative / 1000:>14.1f} {self_us / 1000:>9.1f}  {name}")
+
+    failed = False
+    imported = {name.strip() for _, _, name in rows}
+    eager = [m for m in LAZY_MODULES if m in imported]
+    if eager:
+        print(f"\nFAIL: imported at boot, should be lazy: {', '.join(eager)}")
+        failed = True
+    if args.max_ms is not None and total_ms > args.max_ms:
+        print(f"\nFAIL: {total_ms:.1f} ms exceeds budget of {args.max_ms:.0f} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
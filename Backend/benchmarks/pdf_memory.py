@@ -0,0 +1,129 @@
+"""
+Peak RSS vs. page count for report text extraction.
+
+    cd Backend
+    python benchmarks/pdf_memory.py              # 25, 50, 100, 200, 400 pages
+    python benchmarks/pdf_memory.py 100 1000     # custom page counts
+
+For each page count a synthetic lab-report PDF is generated, then each mode
+runs in a fresh subprocess and reports its peak RSS:
+
+    legacy     whole document open, all page text concatenated, no cache release
+               (what /api/analyze did before streaming extraction)
+    streaming  AIModels.iter_report_pages (table columns, like /api/analyze) →
+               extract_lab_values_incremental for pages without a table,
+               text capped at MAX_REPORT_TEXT_CHARS
+
+The streaming column should stay roughly flat as pages grow; legacy grows
+linearly. Compare growth rather than absolute numbers — the streaming child
+also imports the Flask app. Linux/macOS only (uses resource.getrusage).
+"""
+import os
+import sys
+import json
+import tempfile
+import subprocess
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LAB_ROWS = [
+    ("Hemoglobin", 12.5, "13.0-17.0"),
+    ("WBC", 8500, "4000-11000"),
+    ("Platelets", 250000, "150000-450000"),
+    ("HbA1c", 6.2, "4.0-5.6"),
+    ("TSH", 2.1, "0.4-4.0"),
+    ("Creatinine", 1.1, "0.7-1.3"),
+]
+
+
+def write_pdf(path, pages, lines_per_page=45):
+    """Minimal multi-page PDF (Helvetica text) — no external dependency."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None,
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for p in range(pages):
+        rows = []
+        for i in range(lines_per_page):
+            name, value, rng = LAB_ROWS[(p + i) % len(LAB_ROWS)]
+            rows.append(f"BT /F1 10 Tf 50 {780 - i * 16} Td (Page {p + 1} {name} {value} {rng}) Tj ET")
+        stream = "\n".join(rows)
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        content_id = len(objects)
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for n, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{n} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{o:010d} 00000 n \n" for o in offsets).encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def run_mode(mode, pdf_path):
+    """Executed in a child process: extract, then print peak RSS (MB) as JSON."""
+    import resource
+    sys.path.insert(0, BACKEND_DIR)
+
+    if mode == "legacy":
+        import pdfplumber
+        from structured_extraction import extract_lab_values
+        text = ""
+        with pdfplumber.open(pdf_path) as pdf:
+            for page in pdf.pages:
+                text += (page.extract_text() or "")
+        values = extract_lab_values(text)
+    else:
+        from backend_server import AIModels, MAX_REPORT_TEXT_CHARS
+        from structured_extraction import extract_lab_values_incremental
+        kept = []
+        kept_chars = 0
+        table_values = []
+
+        def pages():
+            nonlocal kept_chars
+            for page_text, table_rows, unparsed in AIModels.iter_report_pages(pdf_path):
+                if kept_chars < MAX_REPORT_TEXT_CHARS:
+                    kept.append(page_text[:MAX_REPORT_TEXT_CHARS - kept_chars])
+                    kept_chars += len(kept[-1])
+                if table_rows:
+                    table_values.extend(table_rows)
+                    yield "\n" + (unparsed or "") + "\n"
+                else:
+                    yield page_text
+
+        values = table_values + extract_lab_values_incremental(pages())
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    print(json.dumps({"peak_rss_mb": round(peak_mb, 1), "lab_values": len(values)}))
+
+
+def main(page_counts):
+    print(f"{'pages':>6} {'legacy MB':>10} {'streaming MB':>13} {'lab values':>11}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for pages in page_counts:
+            pdf_path = os.path.join(tmp, f"report_{pages}.pdf")
+            write_pdf(pdf_path, pages)
+            row = {}
+            for mode in ("legacy", "streaming"):
+                out = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--child", mode, pdf_path],
+                    cwd=tmp, capture_output=True, text=True, check=True)
+                row[mode] = json.loads(out.stdout.strip().splitlines()[-1])
+            print(f"{pages:>6} {row['legacy']['peak_rss_mb']:>10} "
+                  f"{row['streaming']['peak_rss_mb']:>13} {row['streaming']['lab_values']:>11}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        run_mode(sys.argv[2], sys.argv[3])
+    else:
+        main([int(a) for a in sys.argv[1:]] or [25, 50, 100, 200, 400])
@@ -0,0 +1,211 @@
+import os
+import sys
+import json
+import time
+import queue
+import hashlib
+import threading
+import socketserver
+from concurrent.futures import Future
+import numpy as np
+import rag
+from log_setup import get_logger
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Embedding sidecar — one SentenceTransformer + FAISS indexes per node,
+# shared by every server worker over a Unix socket.
+#
+#   RAG_SOCKET=/tmp/drmed-embeddings.sock python embedding_service.py
+#   (serve.py starts it automatically when RAG_SOCKET is set)
+#
+# HOW IT WORKS:
+#   Clients (rag.EmbeddingClient) keep one connection per thread and send
+#   one JSON request per line:
+#     {"op": "index",  "documents": [...]}        → {"index": id, "size": n}
+#     {"op": "search", "index": id, "query": "...", "top_k": 2}
+#                                                   → {"indices": [...], "distances": [...]}
+#     {"op": "encode", "texts": [...]}             → {"embeddings": [[...], ...]}
+#     {"op": "info"}                               → model, indexes, batches served
+#   An index is keyed by the SHA-256 of its documents, so every worker that
+#   registers the same corpus gets the same index (built once).
+#
+#   Connection threads don't call the model themselves: they hand their
+#   texts to the micro-batcher and wait. The batcher takes whatever arrived
+#   within RAG_BATCH_WINDOW_MS (up to RAG_BATCH_MAX texts), encodes it in
+#   ONE model.encode() call and runs one FAISS search per index for all the
+#   queries in the batch — many small concurrent queries cost about as much
+#   as one, and the model is only ever used from one thread.
+#
+# ENVIRONMENT:
+#   RAG_SOCKET            socket path (default /tmp/drmed-embeddings.sock)
+#   RAG_BATCH_MAX         texts encoded per batch (default 64)
+#   RAG_BATCH_WINDOW_MS   how long a batch waits for more requests (default 5)
+#   RAG_MODEL             SentenceTransformer name (see rag.py)
+# ─────────────────────────────────────────────────────────────────────────────
+
+logger = get_logger("embeddings")
+
+SOCKET_PATH = os.getenv("RAG_SOCKET", "/tmp/drmed-embeddings.sock")
+BATCH_MAX = int(os.getenv("RAG_BATCH_MAX", "64"))
+BATCH_WINDOW = float(os.getenv("RAG_BATCH_WINDOW_MS", "5")) / 1000
+
+
+class MicroBatcher:
+    """Collects encode/search jobs from many threads and runs them in batches."""
+
+    def __init__(self, encode, batch_max=BATCH_MAX, window=BATCH_WINDOW):
+        self.encode = encode            # list[str] → (n × dim) array
+        self.batch_max = batch_max
+        self.window = window
+        self.indexes = {}               # id → FAISS index
+        self.batches = 0
+        self.texts = 0
+        self._jobs = queue.Queue()
+        self._index_lock = threading.Lock()
+        threading.Thread(target=self._run, name="embedding-batcher", daemon=True).start()
+
+    def submit(self, texts, index=None, top_k=0):
+        """Future of the embeddings (index=None) or of (distances, indices) per text."""
+        future = Future()
+        self._jobs.put((list(texts), index, top_k, future))
+        return future
+
+    def add_index(self, documents):
+        index_id = hashlib.sha256(json.dumps(documents).encode("utf-8")).hexdigest()[:16]
+        with self._index_lock:
+            if index_id not in self.indexes:
+                embeddings = self.submit(documents).result() if documents else np.zeros((0, 1))
+                self.indexes[index_id] = rag.build_index(embeddings) if len(documents) else None
+                logger.info("Index built", extra={"index": index_id, "documents": len(documents)})
+        return index_id
+
+    def _collect(self):
+        jobs = [self._jobs.get()]
+        size = len(jobs[0][0])
+        deadline = time.monotonic() + self.window
+        while size < self.batch_max:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job = self._jobs.get(timeout=remaining)
+            except queue.Empty:
+                break
+            jobs.append(job)
+            size += len(job[0])
+        return jobs
+
+    def _run(self):
+        while True:
+            jobs = self._collect()
+            try:
+                self._process(jobs)
+            except Exception as e:
+                # Never let one bad batch kill the only thread that serves the model
+                for job in jobs:
+                    if not job[3].done():
+                        job[3].set_exception(e)
+
+    def _process(self, jobs):
+        texts = [text for job in jobs for text in job[0]]
+        embeddings = (np.asarray(self.encode(texts), dtype=np.float32) if texts
+                      else np.zeros((0, 0), dtype=np.float32))
+        self.batches += 1
+        self.texts += len(texts)
+
+        # One FAISS search per index for every query of the batch
+        offsets, start = [], 0
+        for job_texts, _, _, _ in jobs:
+            offsets.append((start, start + len(job_texts)))
+            start += len(job_texts)
+        by_index = {}
+        for job, (lo, hi) in zip(jobs, offsets):
+            if job[1] is not None:
+                by_index.setdefault(job[1], []).append((job, lo, hi))
+        results = {}
+        for index_id, members in by_index.items():
+            top_k = max(job[2] for job, _, _ in members)
+            rows = np.concatenate([embeddings[lo:hi] for _, lo, hi in members])
+            try:
+                if index_id not in self.indexes:
+                    raise LookupError(f"{rag.UNKNOWN_INDEX} {index_id}")
+                index = self.indexes[index_id]
+                if index is None:       # empty corpus
+                    distances, indices = np.zeros((len(rows), 0)), np.zeros((len(rows), 0), dtype=np.int64)
+                else:
+                    distances, indices = index.search(rows, min(top_k, index.ntotal))
+            except Exception as e:
+                for job, _, _ in members:
+                    results[id(job)] = e
+                continue
+            row = 0
+            for job, lo, hi in members:
+                n = hi - lo
+                results[id(job)] = (distances[row:row + n, :job[2]], indices[row:row + n, :job[2]])
+                row += n
+
+        for job, (lo, hi) in zip(jobs, offsets):
+            future = job[3]
+            if job[1] is None:
+                future.set_result(embeddings[lo:hi])
+            elif isinstance(results.get(id(job)), Exception):
+                future.set_exception(results[id(job)])
+            else:
+                future.set_result(results[id(job)])
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        batcher = self.server.batcher
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                op = request.get("op")
+                if op == "search":
+                    distances, indices = batcher.submit([request["query"]], request["index"],
+                                                        max(1, int(request.get("top_k", 2)))).result()
+                    reply = {"distances": distances[0].tolist(), "indices": indices[0].tolist()}
+                elif op == "encode":
+                    reply = {"embeddings": batcher.submit(request["texts"]).result().tolist()}
+                elif op == "index":
+                    index_id = batcher.add_index(request["documents"])
+                    reply = {"index": index_id, "size": len(request["documents"])}
+                elif op == "info":
+                    reply = {"model": rag.MODEL_NAME, "pid": os.getpid(), "indexes": len(batcher.indexes),
+                             "batches": batcher.batches, "texts": batcher.texts}
+                else:
+                    reply = {"error": f"unknown op {op!r}"}
+            except Exception as e:
+                reply = {"error": str(e)}
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class EmbeddingServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, batcher):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)      # stale socket from a previous run
+        self.batcher = batcher
+        super().__init__(socket_path, _Handler)
+        os.chmod(socket_path, 0o660)
+
+
+def main(socket_path=SOCKET_PATH):
+    model = rag.get_model()         # load before accepting connections
+    batcher = MicroBatcher(model.encode)
+    server = EmbeddingServer(socket_path, batcher)
+    logger.info("Embedding service ready", extra={"socket": socket_path, "model": rag.MODEL_NAME,
+                                                  "batchMax": BATCH_MAX})
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else SOCKET_PATH)
@@ -0,0 +1,342 @@
+import os
+import re
+import json
+import time
+import bisect
+import threading
+from collections import deque
+import knowledge_base
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Local medical entity extraction (lab reports and prescriptions).
+#
+# HOW IT WORKS:
+#   Every term we care about — analyte aliases from the knowledge table,
+#   drugs / units / dosing frequencies from knowledge/lexicon.tsv — goes into
+#   one Aho-Corasick automaton, built once per process. A document is
+#   lower-cased and walked through it a single time, so matching is linear in
+#   the text length no matter how many terms the lexicon has. Overlapping
+#   hits resolve leftmost-longest ("insulin glargine" beats "insulin"), and
+#   a hit must sit on word boundaries (units may follow a digit: "500mg").
+#
+#   Numbers are found in the same pass over the text and bound to the
+#   nearest entity before them on the same line:
+#     analyte → value, unit right after it, "low-high" range after that;
+#               status from that range, else the knowledge-table range
+#     drug    → dose + unit, frequency ("BD", "1-0-1"), duration ("x 5 days")
+#   Units and frequencies that bind to nothing are dropped.
+#
+#   extract_batch() shares the automaton across all documents of a call.
+#
+# ENVIRONMENT:
+#   LEXICON_FILE     drugs/units/frequencies (default knowledge/lexicon.tsv)
+# ─────────────────────────────────────────────────────────────────────────────
+
+LEXICON_FILE = os.getenv(
+    "LEXICON_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge", "lexicon.tsv"))
+
+MIN_ALIAS_CHARS = 2           # one-letter aliases ("k" for potassium) match too much prose
+# Units that are numerically the same as the knowledge table's
+SAME_UNIT = {"µIU/mL": "mIU/L", "cells/µL": "/µL"}
+
+_NUMBER = re.compile(r"(?<![\w./])[<>≤≥]?\s?(\d+(?:,\d{3})*(?:\.\d+)?)(?![\d.]|/\d)")
+_RANGE = re.compile(r"\s*[\[(]?\s*(\d+(?:\.\d+)?)\s*(?:-|–|to)\s*(\d+(?:\.\d+)?)", re.I)
+_SCHEDULE = re.compile(r"(?<![\w-])([0-4](?:\.5)?)-([0-4](?:\.5)?)-([0-4](?:\.5)?)(?![\w-])")
+_DURATION = re.compile(r"(?:for|x|×)\s*(\d+)\s*(days?|weeks?|months?)\b", re.I)
+_GAP = re.compile(r"[\s:=]*")
+_SAME_TERM_GAP = re.compile(r"[\s()\[\],/-]*")
+_NOT_VALUE = re.compile(r"\s*(?:-\s*)?(?:days?|weeks?|months?|years?|yrs?|hours?|hrs?|times)\b", re.I)
+
+
+class _Automaton:
+    """Aho-Corasick over lower-cased terms; payload per term."""
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]         # node → ((term length, payload), ...)
+
+    def add(self, term, payload):
+        node = 0
+        for ch in term:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(())
+            node = nxt
+        self.out[node] += ((len(term), payload),)
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                target = self.goto[f].get(ch, 0)
+                self.fail[nxt] = target if target != nxt else 0
+                self.out[nxt] += self.out[self.fail[nxt]]
+        return self
+
+    def matches(self, text):
+        """(start, end, payload) for every occurrence, in end order."""
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for length, payload in out[node]:
+                yield i + 1 - length, i + 1, payload
+
+
+def _load_lexicon(path):
+    entries = []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("#") or "\t" not in line:
+                    continue
+                aliases, record = line.rstrip("\n").split("\t", 1)
+                record = json.loads(record)
+                entries += [(alias, record) for alias in aliases.split("|") if alias]
+    except OSError:
+        pass
+    return entries
+
+
+class EntityExtractor:
+
+    def __init__(self, lexicon_file=LEXICON_FILE):
+        self.lexicon_file = lexicon_file
+        self._automaton = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._automaton is not None:
+            return self._automaton
+        with self._lock:
+            if self._automaton is None:
+                automaton = _Automaton()
+                for alias in knowledge_base.table:
+                    if len(alias) >= MIN_ALIAS_CHARS:
+                        automaton.add(alias, {"type": "analyte", "name": knowledge_base.canonical_name(alias)})
+                for alias, record in _load_lexicon(self.lexicon_file):
+                    automaton.add(alias, record)
+                self._automaton = automaton.build()
+        return self._automaton
+
+    # ── Matching ─────────────────────────────────────────────────────────────
+    def _terms(self, text, lowered):
+        """Non-overlapping (start, end, payload), leftmost-longest, on word boundaries."""
+        hits = []
+        n = len(text)
+        for start, end, payload in self.load().matches(lowered):
+            before = text[start - 1] if start else " "
+            after = text[end] if end < n else " "
+            if lowered[start].isalnum() and before.isalnum():
+                if not (payload["type"] == "unit" and before.isdigit()):
+                    continue
+            if lowered[end - 1].isalnum() and after.isalnum():
+                continue
+            hits.append((start, end, payload))
+        hits.sort(key=lambda h: (h[0], h[0] - h[1]))
+        terms, last_end = [], 0
+        for hit in hits:
+            if hit[0] >= last_end:
+                terms.append(hit)
+                last_end = hit[1]
+        return terms
+
+    # ── Extraction ───────────────────────────────────────────────────────────
+    def extract(self, text, patient_context=None):
+        """Entities of one document (see module header)."""
+        started = time.perf_counter()
+        text = str(text or "")
+        lowered = _lower(text)
+        context = patient_context or {}
+
+        terms = self._terms(text, lowered)
+        units = {start: (end, payload["name"]) for start, end, payload in terms if payload["type"] == "unit"}
+        schedules = [(m.start(), m.end(), {"name": m.group(), "perDay": sum(float(g) for g in m.groups())})
+                     for m in _SCHEDULE.finditer(text)]
+        frequencies = sorted([t for t in terms if t[2]["type"] == "frequency"] + schedules,
+                             key=lambda f: f[0])
+        frequency_starts = [f[0] for f in frequencies]
+        # Numbers inside a term ("Vitamin B12", "ml/min/1.73m2") or a schedule ("1-0-1") are not values
+        covered = sorted([(s, e) for s, e, _ in terms] + [(s, e) for s, e, _ in schedules])
+        covered_starts = [s for s, _ in covered]
+        numbers = [(m.start(1), m.end(1), float(m.group(1).replace(",", "")))
+                   for m in _NUMBER.finditer(text)
+                   if not _inside(covered, covered_starts, m.start(1))
+                   and not _NOT_VALUE.match(text, m.end(1))]
+        number_starts = [n[0] for n in numbers]
+        newlines = [i for i, ch in enumerate(text) if ch == "\n"]
+
+        anchors = []
+        for term in terms:
+            if term[2]["type"] not in ("analyte", "drug"):
+                continue
+            # "HbA1c (Glycated hemoglobin) 7.8" is one test named twice
+            if (anchors and anchors[-1][2]["name"] == term[2]["name"]
+                    and _SAME_TERM_GAP.match(text, anchors[-1][1]).end() >= term[0]):
+                anchors[-1] = (anchors[-1][0], term[1], term[2], anchors[-1][3])
+                continue
+            anchors.append((*term, term[1]))    # + end of the name as written
+        entities = []
+        for k, (start, end, payload, name_end) in enumerate(anchors):
+            # Window: rest of this line, up to the next analyte/drug
+            line_end = newlines[bisect.bisect_left(newlines, end)] if newlines and end <= newlines[-1] else len(text)
+            stop = min(line_end, anchors[k + 1][0]) if k + 1 < len(anchors) else line_end
+            window = numbers[bisect.bisect_left(number_starts, end):bisect.bisect_left(number_starts, stop)]
+            if payload["type"] == "analyte":
+                entities.append(self._measurement(text, start, end, payload, window, units, stop, context))
+            else:
+                freq = frequencies[bisect.bisect_left(frequency_starts, end):
+                                   bisect.bisect_left(frequency_starts, stop)]
+                entities.append(self._medication(text, start, end, payload, window, units, freq, stop))
+            entities[-1]["text"] = text[start:name_end]
+
+        return {
+            "entities": entities,
+            "measurements": sum(1 for e in entities if e["type"] == "measurement"),
+            "medications": sum(1 for e in entities if e["type"] == "medication"),
+            "durationMs": round((time.perf_counter() - started) * 1000, 3),
+        }
+
+    def extract_batch(self, texts, patient_contexts=None):
+        """extract() for many documents; one automaton for the whole batch."""
+        self.load()
+        contexts = patient_contexts or [None] * len(texts)
+        return [self.extract(text, context) for text, context in zip(texts, contexts)]
+
+    @staticmethod
+    def _unit_after(text, position, units):
+        gap = _GAP.match(text, position).end()
+        unit = units.get(gap) or units.get(position)
+        return unit if unit else (position, None)
+
+    def _measurement(self, text, start, end, payload, window, units, stop, context):
+        entity = {"type": "analyte", "name": payload["name"], "text": text[start:end], "start": start, "end": end}
+        if not window:
+            return entity
+        value_start, value_end, value = window[0]
+        unit_end, unit = self._unit_after(text, value_end, units)
+        entity.update(type="measurement", value=value, unit=unit, end=unit_end, range=None, status=None)
+
+        bounds = None
+        match = _RANGE.match(text, unit_end)
+        if match and match.end() <= stop:
+            bounds = float(match.group(1)), float(match.group(2))
+            entity["range"] = f"{match.group(1)}-{match.group(2)}"
+            entity["end"] = match.end()
+        elif unit and _same_unit(unit, (knowledge_base.table.record(payload["name"]) or {}).get("unit")):
+            # The table's range only applies in the table's unit (platelets in lakh/cumm ≠ /µL)
+            bounds = knowledge_base.reference_range(payload["name"], context.get("age"),
+                                                    context.get("sex") or context.get("gender"))
+            if bounds:
+                entity["range"] = f"{bounds[0]:g}-{bounds[1]:g}"
+        if bounds:
+            low, high = bounds
+            entity["status"] = "Low" if value < low else "High" if value > high else "Normal"
+        return entity
+
+    def _medication(self, text, start, end, payload, window, units, frequencies, stop):
+        entity = {"type": "medication", "name": payload["name"], "class": payload.get("class"),
+                  "text": text[start:end], "dose": None, "unit": None, "frequency": None,
+                  "perDay": None, "duration": None, "start": start, "end": end}
+        for value_start, value_end, value in window:
+            unit_end, unit = self._unit_after(text, value_end, units)
+            if unit:
+                entity.update(dose=value, unit=unit, end=unit_end)
+                break
+        if frequencies:
+            _, freq_end, freq = frequencies[0]
+            entity.update(frequency=freq["name"], perDay=freq.get("perDay"), end=max(entity["end"], freq_end))
+        duration = _DURATION.search(text, entity["end"], stop)
+        if duration:
+            entity["duration"] = f"{duration.group(1)} {duration.group(2).lower()}"
+            entity["end"] = duration.end()
+        return entity
+
+
+def _lower(text):
+    lowered = text.lower()
+    if len(lowered) != len(text):       # a few Unicode letters lower-case to 2 chars
+        lowered = "".join(ch.lower()[:1] for ch in text)
+    return lowered
+
+
+def _same_unit(unit, table_unit):
+    return table_unit is not None and SAME_UNIT.get(unit, unit) == SAME_UNIT.get(table_unit, table_unit)
+
+
+def _inside(spans, starts, position):
+    i = bisect.bisect_right(starts, position) - 1
+    return i >= 0 and spans[i][0] <= position < spans[i][1]
+
+
+class _Parsed:
+    """
+    What the table/regex pass already extracted. Its test names keep whatever
+    the report printed ("Serum Hemoglobin"), so besides the exact canonical
+    name every analyte the lexicon finds inside a name counts as parsed —
+    together with the row's value, so "Mean Corpuscular Hemoglobin 29" does
+    not hide "Hemoglobin 12.5".
+    """
+
+    def __init__(self, structured_data):
+        self.names = set()
+        self.values = set()
+        for item in structured_data:
+            test = str(item.get("test") or "")
+            self.names.add(knowledge_base.canonical_name(test) or test)
+            for _, _, payload in extractor._terms(test, _lower(test)):
+                if payload["type"] == "analyte":
+                    self.values.add((payload["name"], item.get("value")))
+
+    def __contains__(self, entity):
+        return entity["name"] in self.names or (entity["name"], entity.get("value")) in self.values
+
+    def add(self, entity):
+        self.names.add(entity["name"])
+
+
+def prompt_section(result, structured_data=()):
+    """Compact lines for the Gemini prompt: medications + values the table/regex pass missed."""
+    parsed = _Parsed(structured_data)
+    lines = []
+    for entity in result.get("entities", []):
+        if entity["type"] == "medication":
+            parts = [entity["name"]]
+            if entity["dose"] is not None:
+                parts.append(f"{entity['dose']:g} {entity['unit']}")
+            parts += [entity[key] for key in ("frequency", "duration") if entity[key]]
+            lines.append("Medication: " + " ".join(parts))
+        elif entity["type"] == "measurement" and entity not in parsed:
+            unit = f" {entity['unit']}" if entity["unit"] else ""
+            lines.append(f"Measurement: {entity['name']} {entity['value']:g}{unit}"
+                         + (f" (range {entity['range']})" if entity["range"] else ""))
+    return "\n".join(dict.fromkeys(lines))
+
+
+def structured_additions(result, structured_data):
+    """Measurements with a status that structured_data doesn't already have (→ findings)."""
+    parsed = _Parsed(structured_data)
+    added = []
+    for entity in result.get("entities", []):
+        if entity["type"] != "measurement" or not entity["status"] or entity in parsed:
+            continue
+        parsed.add(entity)
+        added.append({"test": entity["name"], "value": entity["value"], "range": entity["range"],
+                      "status": entity["status"], "unit": entity["unit"] or ""})
+    return added
+
+
+extractor = EntityExtractor()
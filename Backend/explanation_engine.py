@@ -1,12 +1,19 @@
-def get_medical_meaning(test_name):
-    meanings = {
-        "HbA1c": "HbA1c reflects average blood sugar levels over the past 3 months.",
-        "TSH": "TSH measures thyroid function.",
-        "Hemoglobin": "Hemoglobin measures oxygen-carrying capacity of blood.",
-        "WBC": "WBC indicates immune system activity."
-    }
-    
-    return meanings.get(test_name, "No detailed explanation available for this test.")
+import os
+import knowledge_base
+
+# Tiered analysis thresholds (see needs_llm)
+FAST_PATH_MIN_COVERAGE = float(os.getenv("FAST_PATH_MIN_COVERAGE", "0.8"))
+FAST_PATH_MAX_ABNORMAL = int(os.getenv("FAST_PATH_MAX_ABNORMAL", "2"))
+
+
+def get_medical_meaning(test_name, literacy="medium"):
+    return knowledge_base.meaning(test_name, literacy)
+
+
+def is_known_test(test_name):
+    return knowledge_base.is_known(test_name)
+
+
 def generate_explanation(structured_data, age, condition, mode):
     
     findings = []
@@ -23,7 +30,7 @@ def generate_explanation(structured_data, age, condition, mode):
         
         findings.append(f"{test} is {status} ({value}). Normal range: {range_val}.")
         
-        meaning = get_medical_meaning(test)
+        meaning = knowledge_base.explain(test, status, mode)
         
         if status != "Normal":
             abnormal_count += 1
@@ -56,4 +63,89 @@ def generate_explanation(structured_data, age, condition, mode):
         "Safety Note": "This is an AI-generated explanation. Not a medical diagnosis."
     }
     
-    return explanation
\ No newline at end of file
+    return explanation
+
+
+def _age_number(age):
+    try:
+        return int(float(age))
+    except (TypeError, ValueError):
+        return 0
+
+
+def knowledge_coverage(structured_data):
+    """Fraction of extracted values the knowledge table can explain."""
+    if not structured_data:
+        return 0.0
+    return sum(1 for item in structured_data if is_known_test(item["test"])) / len(structured_data)
+
+
+def needs_llm(structured_data, analysis_mode="auto"):
+    """
+    Tier decision for /api/analyze.
+      "fast"     → never call the LLM
+      "detailed" → always call the LLM (user asked for a narrative)
+      "auto"     → LLM only when the rule engine can't cover the report:
+                   nothing extracted, too many unknown tests, or too many
+                   abnormal values for a canned explanation.
+    """
+    if analysis_mode == "fast":
+        return False
+    if analysis_mode == "detailed":
+        return True
+    if not structured_data:
+        return True
+    abnormal = sum(1 for item in structured_data if item["status"] != "Normal")
+    return knowledge_coverage(structured_data) < FAST_PATH_MIN_COVERAGE or abnormal > FAST_PATH_MAX_ABNORMAL
+
+
+def rule_based_analysis(structured_data, patient_context):
+    """
+    Deterministic report analysis in the same shape as the LLM result
+    (patient_summary … recommendations), built from generate_explanation().
+    """
+    age = _age_number(patient_context.get("age"))
+    condition = str(patient_context.get("condition") or "None")
+    explanation = generate_explanation(structured_data, age, condition,
+                                       patient_context.get("literacyLevel", "Medium"))
+
+    abnormal = [item for item in structured_data if item["status"] != "Normal"]
+    high = sum(1 for item in abnormal if item["status"] == "High")
+    low = len(abnormal) - high
+
+    if abnormal:
+        interpretation = " ".join(explanation["Known"])
+    else:
+        interpretation = f"All {len(structured_data)} measured values are within their reference ranges."
+    if explanation["Personalized Note"]:
+        interpretation += " " + explanation["Personalized Note"].strip()
+
+    recommendations = [{
+        "title": f"Discuss {item['test']} with your doctor",
+        "description": f"{item['test']} is {item['status'].lower()} ({item['value']}; normal range {item['range']}).",
+        "icon": "🩺",
+        "priority": "high" if len(abnormal) > 1 or knowledge_base.severity(
+            item["test"], item["value"], item["status"]) != "mild" else "medium"
+    } for item in abnormal]
+    if not recommendations:
+        recommendations.append({
+            "title": "Routine follow-up",
+            "description": "No abnormal values were found. Keep your regular check-up schedule.",
+            "icon": "📅",
+            "priority": "low"
+        })
+
+    unclear = [f"{item['test']}: no reference explanation available."
+               for item in structured_data if not is_known_test(item["test"])]
+
+    return {
+        "patient_summary": f"Age: {patient_context.get('age', 'Unknown')}, known conditions: {condition}.",
+        "test_report_summary": (f"{len(structured_data)} test values extracted: "
+                                f"{len(structured_data) - len(abnormal)} normal, {high} high, {low} low."),
+        "clinical_interpretation": interpretation,
+        "known_information": explanation["Findings"],
+        "unclear_information": unclear,
+        "recommendations": recommendations,
+        "confidence": {"High": 0.95, "Medium": 0.9, "Low": 0.8}[explanation["Confidence"]],
+        "coverage": round(knowledge_coverage(structured_data), 3)
+    }
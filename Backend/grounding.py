@@ -0,0 +1,169 @@
+import re
+import time
+from functools import lru_cache
+import knowledge_base
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Confidence by grounding: check the numbers an analysis states against the
+# values actually extracted from the report.
+#
+# HOW IT WORKS:
+#   The analysis is split into statements (known_information items and the
+#   sentences of the narrative). Every number in a statement is a claim; it
+#   is attributed to the nearest analyte mentioned before it (report test
+#   names and their knowledge-table aliases) and accepted when it matches
+#     1. that analyte's extracted value or reference-range bounds,
+#     2. a reference or guideline value for that analyte in the knowledge
+#        table — range bounds, severity thresholds and every number its
+#        explanations quote ("5.7–6.4% indicates prediabetes"), or
+#     3. any number printed in the report text / the patient's age.
+#   Durations ("3 months") are not claims. A statement is verified when all
+#   its claims are; statements without numbers are not counted.
+#
+#   Everything is set/dict lookups over an index built once per report, so
+#   a typical report is checked in about a millisecond.
+# ─────────────────────────────────────────────────────────────────────────────
+
+_NUMBER = re.compile(r"(?<![\w.])\d+(?:,\d{3})*(?:\.\d+)?(?![\w])")
+_DURATION = re.compile(r"\s*(?:-\s*)?(?:months?|years?|yrs?|weeks?|days?|hours?|hrs?|times)\b", re.I)
+_SENTENCE = re.compile(r"(?<=[.!?])\s+(?=[A-Z])")
+STATEMENT_FIELDS = ("known_information", "clinical_interpretation", "test_report_summary")
+MAX_REPORTED = 10          # unsupported claims listed in the result
+
+
+def _keys(value):
+    """Lookup keys tolerant to the rounding an LLM applies when quoting values."""
+    return {round(value, 2), round(value, 1)}
+
+
+def _numbers(text):
+    for match in _NUMBER.finditer(text):
+        if not _DURATION.match(text, match.end()):
+            yield match.start(), float(match.group().replace(",", ""))
+
+
+@lru_cache(maxsize=4096)
+def _mention_pattern(test_name):
+    names = {knowledge_base.normalize_test(test_name)} | set(knowledge_base.aliases(test_name))
+    names = sorted((n for n in names if n), key=len, reverse=True)
+    return re.compile(r"(?<![\w])(?:" + "|".join(re.escape(n) for n in names) + r")(?![\w])", re.I)
+
+
+@lru_cache(maxsize=4096)
+def _reference_keys(test_name):
+    """Value keys of the knowledge table's ranges, thresholds and quoted guideline numbers."""
+    record = knowledge_base.table.record(test_name)
+    if record is None:
+        return frozenset()
+    numbers = [bound for rng in record["ranges"] for bound in rng[3:5]]
+    numbers += [t for thresholds in record.get("severity", {}).values() for t in thresholds]
+    texts = list(record.get("meaning", {}).values())
+    texts += [text for by_level in record.get("status", {}).values() for text in by_level.values()]
+    numbers += [n for text in texts for n in re.findall(r"\d+(?:\.\d+)?", text)]
+    return frozenset().union(*(_keys(float(n)) for n in numbers)) if numbers else frozenset()
+
+
+class GroundingIndex:
+    """(analyte, value) pairs + every number in the source text, for one report."""
+
+    def __init__(self, structured_data, extracted_text="", patient_context=None):
+        self.analytes = {}          # test name → value keys (value, range bounds, guideline thresholds)
+        for item in structured_data or []:
+            test = str(item.get("test") or item.get("label") or "").strip()
+            if not test:
+                continue
+            keys = self.analytes.setdefault(test, set(_reference_keys(test)))
+            for number in [item.get("value")] + re.findall(r"\d+(?:\.\d+)?", str(item.get("range", ""))):
+                try:
+                    keys |= _keys(float(number))
+                except (TypeError, ValueError):
+                    pass
+
+        self.text_keys = set()
+        for _, number in _numbers(extracted_text or ""):
+            self.text_keys |= _keys(number)
+        age = (patient_context or {}).get("age")
+        try:
+            self.text_keys |= _keys(float(age))
+        except (TypeError, ValueError):
+            pass
+
+    def _mentions(self, statement):
+        """(position, test) of every analyte named in the statement, in order."""
+        found = []
+        for test in self.analytes:
+            for match in _mention_pattern(test).finditer(statement):
+                found.append((match.start(), test))
+        return sorted(found)
+
+    def check(self, statement):
+        """[(value, analyte, supported)] for every numeric claim in the statement."""
+        numbers = list(_numbers(statement))
+        if not numbers:
+            return []
+        mentions = self._mentions(statement)
+        claims = []
+        for position, value in numbers:
+            before = [test for pos, test in mentions if pos < position]
+            analyte = before[-1] if before else (mentions[0][1] if mentions else None)
+            keys = _keys(value)
+            supported = bool((analyte and keys & self.analytes[analyte]) or keys & self.text_keys)
+            claims.append((value, analyte, supported))
+        return claims
+
+
+def statements_of(analysis):
+    """Statements from an aiResponse-shaped dict or a plain string."""
+    if isinstance(analysis, str):
+        parts = [analysis]
+    else:
+        parts = []
+        for field in STATEMENT_FIELDS:
+            value = (analysis or {}).get(field)
+            parts += value if isinstance(value, list) else [value or ""]
+    return [s.strip() for part in parts for s in _SENTENCE.split(str(part)) if s.strip()]
+
+
+def risk_level(risk):
+    return "low" if risk < 0.1 else "medium" if risk < 0.3 else "high"
+
+
+def verify(analysis, structured_data, extracted_text="", patient_context=None):
+    """
+    Grounding report for /api/analyze and /api/models/confidence:
+    confidenceScore, hallucinationRisk, verified/uncertain statement counts
+    and the first unsupported claims.
+    """
+    started = time.perf_counter()
+    index = GroundingIndex(structured_data, extracted_text, patient_context)
+
+    verified = uncertain = claims_total = claims_unsupported = 0
+    unsupported = []
+    for statement in statements_of(analysis):
+        claims = index.check(statement)
+        if not claims:
+            continue
+        bad = [(value, analyte) for value, analyte, ok in claims if not ok]
+        claims_total += len(claims)
+        claims_unsupported += len(bad)
+        if bad:
+            uncertain += 1
+            for value, analyte in bad:
+                if len(unsupported) < MAX_REPORTED:
+                    unsupported.append({"statement": statement[:200], "value": value, "analyte": analyte})
+        else:
+            verified += 1
+
+    # No numbers to check → neutral score rather than a perfect one
+    risk = claims_unsupported / claims_total if claims_total else 0.0
+    confidence = 0.99 - 0.6 * risk if claims_total else 0.9
+    return {
+        "confidenceScore": round(confidence, 2),
+        "hallucinationRisk": risk_level(risk),
+        "riskScore": round(risk, 3),
+        "verifiedStatements": verified,
+        "uncertainStatements": uncertain,
+        "checkedClaims": claims_total,
+        "unsupportedClaims": unsupported,
+        "durationMs": round((time.perf_counter() - started) * 1000, 3),
+    }
@@ -0,0 +1,141 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Lightweight stage timing — no external dependency.
+#
+# HOW IT WORKS:
+#   with span("text_extraction"):        ← times the block
+#       ...
+#   Every span is observed into a process-wide histogram (served as
+#   Prometheus text on /metrics) and, if the current request opened a
+#   collect_timings() block, also added to that request's timings dict.
+#
+#   A ContextVar (not threading.local) holds the per-request collector so the
+#   same spans work from Flask threads and from asyncio tasks.
+# ─────────────────────────────────────────────────────────────────────────────
+
+# Seconds. Covers fast local stages (ms) up to slow Gemini calls (tens of s).
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_str(labels, extra=None):
+    items = list(labels)
+    if extra:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+class Histogram:
+    """Thread-safe Prometheus-style histogram with arbitrary labels."""
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}   # label tuple → [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {k: list(v) for k, v in self._series.items()}
+        for key, series in sorted(snapshot.items()):
+            for i, bound in enumerate(self.buckets):
+                lines.append(f"{self.name}_bucket{_label_str(key, ('le', repr(float(bound))))} {series[i]}")
+            lines.append(f"{self.name}_bucket{_label_str(key, ('le', '+Inf'))} {series[-2]}")
+            lines.append(f"{self.name}_count{_label_str(key)} {series[-2]}")
+            lines.append(f"{self.name}_sum{_label_str(key)} {series[-1]:.6f}")
+        return lines
+
+
+# ── Registry ─────────────────────────────────────────────────────────────────
+STAGE_SECONDS = Histogram(
+    "drmed_stage_duration_seconds",
+    "Duration of analysis pipeline stages in seconds.",
+)
+_REGISTRY = [STAGE_SECONDS]
+
+_current_timings = contextvars.ContextVar("drmed_timings", default=None)
+
+
+@contextmanager
+def collect_timings():
+    """
+    Collect every span run inside this block into a dict of milliseconds,
+    e.g. {"text_extraction": 41.2, "llm_call:models/gemini-1.5-flash": 2310.5}.
+    """
+    timings = {}
+    token = _current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _current_timings.reset(token)
+
+
+def record(stage, elapsed, **labels):
+    """Record one duration (seconds) for a stage — what span() does on exit."""
+    STAGE_SECONDS.observe(elapsed, stage=stage, **labels)
+    timings = _current_timings.get()
+    if timings is not None:
+        key = ":".join([stage] + [str(v) for _, v in sorted(labels.items())])
+        timings[key] = round(timings.get(key, 0.0) + elapsed * 1000, 3)
+
+
+@contextmanager
+def span(stage, **labels):
+    """Time a pipeline stage. Extra labels (e.g. model=...) become metric labels."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, **labels)
+
+
+class Stopwatch:
+    """
+    Adds up many short intervals of one stage that are interleaved with
+    other work (e.g. lab parsing between PDF page reads); record() them once.
+    """
+
+    def __init__(self):
+        self.elapsed = 0.0
+
+    @contextmanager
+    def running(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def record(self, stage, **labels):
+        record(stage, self.elapsed, **labels)
+
+
+def render_metrics():
+    """Prometheus text exposition format (version 0.0.4) for /metrics."""
+    lines = []
+    for metric in _REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,176 @@
+import os
+import json
+import mmap
+import threading
+from functools import lru_cache
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Precomputed analyte knowledge table (meanings, reference ranges, severity).
+#
+# HOW IT WORKS:
+#   knowledge/analytes.tsv holds one analyte per line:
+#       alias|alias|alias <TAB> {compact JSON record}
+#   On first use the file is memory-mapped and scanned once; only the alias
+#   column is decoded, giving an alias → byte offset index. A record's JSON is
+#   parsed the first time that analyte is looked up (and then cached), so
+#   startup cost and resident memory stay small even with thousands of rows —
+#   the OS pages in only the lines that are actually used.
+#
+#   Phrases are memoized per (test, status, literacy), so a report explains
+#   each analyte with a dict hit instead of rebuilding strings every time.
+#
+# ENVIRONMENT:
+#   KNOWLEDGE_FILE     path to the table (default knowledge/analytes.tsv next to this file)
+# ─────────────────────────────────────────────────────────────────────────────
+
+KNOWLEDGE_FILE = os.getenv(
+    "KNOWLEDGE_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge", "analytes.tsv"))
+
+LITERACY_LEVELS = ("low", "medium", "high")
+UNKNOWN_MEANING = "No detailed explanation available for this test."
+
+
+def normalize_test(name):
+    return " ".join(str(name or "").lower().split())
+
+
+def literacy_key(level):
+    """'Low (Simple Terms)' / 'Standard' / 'Detailed' → low | medium | high."""
+    word = (str(level or "").strip().lower().split() or [""])[0]
+    if word in LITERACY_LEVELS:
+        return word
+    return {"simple": "low", "detailed": "high", "professional": "high"}.get(word, "medium")
+
+
+class KnowledgeTable:
+
+    def __init__(self, path=KNOWLEDGE_FILE):
+        self.path = path
+        self._index = None      # alias → byte offset of the record line
+        self._mm = None
+        self._lock = threading.Lock()
+
+    def _load_index(self):
+        if self._index is not None:
+            return self._index
+        with self._lock:
+            if self._index is None:
+                index = {}
+                try:
+                    with open(self.path, "rb") as f:
+                        self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    self._mm = None
+                offset = 0
+                mm = self._mm
+                while mm is not None and offset < len(mm):
+                    end = mm.find(b"\n", offset)
+                    end = len(mm) if end == -1 else end
+                    tab = mm.find(b"\t", offset, end)
+                    if tab != -1 and mm[offset:offset + 1] != b"#":
+                        for alias in mm[offset:tab].decode("utf-8").split("|"):
+                            index.setdefault(normalize_test(alias), tab + 1)
+                    offset = end + 1
+                self._index = index
+        return self._index
+
+    @lru_cache(maxsize=None)
+    def _record_at(self, offset):
+        end = self._mm.find(b"\n", offset)
+        return json.loads(self._mm[offset:end if end != -1 else len(self._mm)].decode("utf-8"))
+
+    def record(self, test_name):
+        """Full knowledge record for a test name or alias, or None."""
+        offset = self._load_index().get(normalize_test(test_name))
+        return self._record_at(offset) if offset is not None else None
+
+    def aliases(self, test_name):
+        """Every alias on this test's line (lower-case), or () if unknown."""
+        offset = self._load_index().get(normalize_test(test_name))
+        if offset is None:
+            return ()
+        start = self._mm.rfind(b"\n", 0, offset - 1) + 1
+        return tuple(self._mm[start:offset - 1].decode("utf-8").split("|"))
+
+    def __contains__(self, test_name):
+        return normalize_test(test_name) in self._load_index()
+
+    def __iter__(self):
+        """Every alias in the table (lower-case)."""
+        return iter(self._load_index())
+
+    def __len__(self):
+        return len(set(self._load_index().values()))
+
+
+table = KnowledgeTable()
+
+
+def is_known(test_name):
+    return test_name in table
+
+
+@lru_cache(maxsize=8192)
+def canonical_name(test_name):
+    """Display name shared by all aliases ('SGPT' → 'ALT'), or None if unknown."""
+    record = table.record(test_name)
+    return record["name"] if record else None
+
+
+@lru_cache(maxsize=8192)
+def aliases(test_name):
+    return table.aliases(test_name)
+
+
+@lru_cache(maxsize=8192)
+def meaning(test_name, literacy="medium"):
+    record = table.record(test_name)
+    if record is None:
+        return UNKNOWN_MEANING
+    texts = record["meaning"]
+    return texts.get(literacy_key(literacy)) or texts["medium"]
+
+
+@lru_cache(maxsize=8192)
+def explain(test_name, status, literacy="medium"):
+    """What the test measures plus what this status means, at the reader's level."""
+    level = literacy_key(literacy)
+    text = meaning(test_name, level)
+    record = table.record(test_name)
+    phrases = (record or {}).get("status", {}).get(status) or {}
+    extra = phrases.get(level) or phrases.get("medium")
+    return f"{text} {extra}" if extra else text
+
+
+def reference_range(test_name, age=None, sex=None):
+    """(low, high) for this patient's age/sex from the bundled table, or None."""
+    record = table.record(test_name)
+    if record is None:
+        return None
+    sex = str(sex or "any").strip().lower()[:1]
+    sex = {"m": "male", "f": "female"}.get(sex, "any")
+    age = age if isinstance(age, (int, float)) else None
+    best = None
+    for rng_sex, age_min, age_max, low, high in record["ranges"]:
+        if age is not None and not (age_min <= age < age_max):
+            continue
+        if rng_sex == sex:
+            return low, high
+        if rng_sex == "any" and best is None:
+            best = (low, high)
+    return best
+
+
+def severity(test_name, value, status):
+    """'mild' | 'moderate' | 'severe' for an abnormal value, 'normal' otherwise."""
+    if status == "Normal":
+        return "normal"
+    record = table.record(test_name)
+    thresholds = (record or {}).get("severity", {}).get(status.lower())
+    if not thresholds:
+        return "mild"
+    moderate, severe = thresholds
+    if status == "High":
+        return "severe" if value >= severe else "moderate" if value >= moderate else "mild"
+    return "severe" if value <= severe else "moderate" if value <= moderate else "mild"
@@ -0,0 +1,210 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+import knowledge_base
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Per-patient lab time series (HbA1c across visits, …) with trend queries.
+#
+# HOW IT WORKS:
+#   Every analysis with a patientId appends one row per lab value to a single
+#   SQLite table clustered on (patient, analyte, date) — WITHOUT ROWID, so a
+#   patient's HbA1c history sits contiguously on disk and a trend query is
+#   one index range scan, no matter how many reports the patient has or how
+#   many other patients share the file. Each row remembers the upload
+#   (fileId) it came from: analysing the same report again — detailed mode,
+#   a retry, a changed context — replaces that report's rows instead of
+#   adding a second set, and summary() leaves the report being analysed out
+#   of its own "previous results".
+#
+#   Test names are normalized through the knowledge table ("Glycated
+#   hemoglobin" and "HbA1c" are one series). summary() turns the previous
+#   values of the tests in the current report into a few compact lines for
+#   the Gemini prompt.
+#
+# ENVIRONMENT:
+#   LAB_HISTORY_DB     SQLite path (default data/lab_history.sqlite3)
+# ─────────────────────────────────────────────────────────────────────────────
+
+DB_PATH = os.getenv("LAB_HISTORY_DB", os.path.join("data", "lab_history.sqlite3"))
+
+SUMMARY_MAX_ANALYTES = 20     # tests described in the prompt summary
+SUMMARY_POINTS = 3            # previous values shown per test
+FLAT_TOLERANCE = 0.02         # |Δ| / previous below this counts as "stable"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS lab_values (
+    patient TEXT NOT NULL, analyte TEXT NOT NULL, ts TEXT NOT NULL,
+    analysis_id TEXT NOT NULL, value REAL NOT NULL,
+    unit TEXT, status TEXT, range TEXT, test_name TEXT, file_id TEXT,
+    PRIMARY KEY (patient, analyte, ts, analysis_id)) WITHOUT ROWID;
+"""
+_FILE_INDEX = "CREATE INDEX IF NOT EXISTS lab_values_file ON lab_values (patient, file_id)"
+
+
+def analyte_key(test_name):
+    return knowledge_base.canonical_name(test_name) or " ".join(str(test_name).split())
+
+
+def _direction(delta, previous):
+    if previous and abs(delta) / abs(previous) < FLAT_TOLERANCE:
+        return "stable"
+    return "rising" if delta > 0 else "falling" if delta < 0 else "stable"
+
+
+def describe_series(points):
+    """Trend statistics for one analyte's points (oldest first)."""
+    latest = points[-1]
+    trend = {
+        "count": len(points),
+        "unit": latest["unit"],
+        "latest": latest,
+        "min": min(p["value"] for p in points),
+        "max": max(p["value"] for p in points),
+        "points": points,
+    }
+    if len(points) > 1:
+        previous = points[-2]
+        delta = latest["value"] - previous["value"]
+        trend["previous"] = previous
+        trend["delta"] = round(delta, 4)
+        trend["deltaPct"] = round(delta / previous["value"] * 100, 1) if previous["value"] else None
+        trend["direction"] = _direction(delta, previous["value"])
+    streak = 0
+    for point in reversed(points):
+        if point["status"] in (None, "", "Normal"):
+            break
+        streak += 1
+    trend["outOfRangeStreak"] = streak
+    return trend
+
+
+class LabHistory:
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def _conn(self):
+        # One connection per thread and per process (never shared across fork).
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            if "file_id" not in {row[1] for row in conn.execute("PRAGMA table_info(lab_values)")}:
+                conn.execute("ALTER TABLE lab_values ADD COLUMN file_id TEXT")   # pre-fileId databases
+            conn.execute(_FILE_INDEX)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def append(self, patient_id, analysis_id, structured_data, taken_at=None, file_id=None):
+        """
+        Record one report's lab values. taken_at: ISO date/time (default: when
+        this fileId was first recorded, else now). With a file_id, the rows of
+        an earlier analysis of the same report are replaced.
+        """
+        if not patient_id or not structured_data:
+            return 0
+        rows = []
+        for item in structured_data:
+            try:
+                value = float(item["value"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            rows.append([str(patient_id), analyte_key(item["test"]), None, analysis_id, value,
+                         item.get("unit", ""), item.get("status", ""), item.get("range", ""), item["test"],
+                         file_id])
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            ts = taken_at
+            if file_id:
+                if ts is None:
+                    ts = conn.execute("SELECT MIN(ts) FROM lab_values WHERE patient = ? AND file_id = ?",
+                                      (str(patient_id), file_id)).fetchone()[0]
+                conn.execute("DELETE FROM lab_values WHERE patient = ? AND file_id = ?",
+                             (str(patient_id), file_id))
+            ts = ts or datetime.now().isoformat(timespec="seconds")
+            for row in rows:
+                row[2] = ts
+            conn.executemany("INSERT OR IGNORE INTO lab_values VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return len(rows)
+
+    def series(self, patient_id, analyte=None, since=None, before=None, exclude_file=None):
+        """
+        analyte → points (oldest first) for one patient, optionally some
+        analytes / a date window / without one report's rows.
+        """
+        query = ("SELECT analyte, ts, value, unit, status, range, analysis_id, file_id FROM lab_values "
+                 "WHERE patient = ?")
+        params = [str(patient_id)]
+        if isinstance(analyte, (list, tuple)):
+            query += f" AND analyte IN ({','.join('?' * len(analyte))})"
+            params += [analyte_key(a) for a in analyte]
+        elif analyte:
+            query += " AND analyte = ?"
+            params.append(analyte_key(analyte))
+        if since:
+            query += " AND ts >= ?"
+            params.append(since)
+        if before:
+            query += " AND ts < ?"
+            params.append(before)
+        if exclude_file:
+            query += " AND (file_id IS NULL OR file_id != ?)"
+            params.append(exclude_file)
+        out = {}
+        for name, ts, value, unit, status, rng, analysis_id, file_id in self._conn().execute(
+                query + " ORDER BY analyte, ts", params):
+            out.setdefault(name, []).append({"date": ts, "value": value, "unit": unit, "status": status,
+                                             "range": rng, "analysisId": analysis_id, "fileId": file_id})
+        return out
+
+    def trends(self, patient_id, analyte=None, since=None, limit=None):
+        """analyte → describe_series(); limit keeps only the newest N points per analyte."""
+        trends = {}
+        for name, points in self.series(patient_id, analyte, since).items():
+            trends[name] = describe_series(points[-limit:] if limit else points)
+        return trends
+
+    def summary(self, patient_id, structured_data, before=None, file_id=None):
+        """
+        Previous values of the tests in this report, one line per test:
+          "HbA1c (%): 6.4 (2025-11-02) → 6.9 (2026-03-14); rising, 2 report(s) in a row out of range"
+        file_id: the report being analysed — never its own previous result.
+        Empty string for new patients.
+        """
+        if not patient_id or not structured_data:
+            return ""
+        wanted = []
+        for item in structured_data:
+            key = analyte_key(item["test"])
+            if key not in wanted:
+                wanted.append(key)
+        history = self.series(patient_id, wanted, before=before, exclude_file=file_id)
+        lines = []
+        for key in wanted:
+            points = history.get(key)
+            if not points:
+                continue
+            trend = describe_series(points)
+            shown = " → ".join(f"{p['value']:g} ({p['date'][:10]})" for p in points[-SUMMARY_POINTS:])
+            unit = f" ({trend['unit']})" if trend["unit"] else ""
+            notes = [trend["direction"]] if "direction" in trend else []
+            if trend["outOfRangeStreak"]:
+                notes.append(f"{trend['outOfRangeStreak']} report(s) in a row out of range")
+            lines.append(f"{key}{unit}: {shown}" + (f"; {', '.join(notes)}" if notes else ""))
+            if len(lines) >= SUMMARY_MAX_ANALYTES:
+                break
+        return "\n".join(lines)
+
+
+lab_history = LabHistory()
@@ -1,10 +1,37 @@
 import os
 import re
 import json
-import google.generativeai as genai
-from dotenv import load_dotenv
+import asyncio
+import threading
+from instrumentation import span
+from log_setup import get_logger, log_payload
+from rate_limiter import limiter, estimate_tokens, RateLimitTimeout
 
-load_dotenv()
+logger = get_logger("llm")
+
+
+# ── LAZY IMPORTS ──────────────────────────────────────────────────────────────
+# google.generativeai pulls in grpc/protobuf (about a second of imports) and
+# .env is only needed for the key, so neither is touched until the first
+# Gemini call — server boot and /api/health don't pay for them.
+_genai_module = None
+_env_loaded = False
+
+
+def _genai():
+    global _genai_module
+    if _genai_module is None:
+        import google.generativeai
+        _genai_module = google.generativeai
+    return _genai_module
+
+
+def _load_env():
+    global _env_loaded
+    if not _env_loaded:
+        from dotenv import load_dotenv
+        load_dotenv()
+        _env_loaded = True
 
 # ── API KEY ───────────────────────────────────────────────────────────────────
 # Priority: .env file GEMINI_API_KEY  →  hardcoded below
@@ -44,7 +71,7 @@ def _extract_json_from_text(raw):
     start = text.find("{")
     end   = text.rfind("}")
     if start == -1 or end == -1 or end <= start:
-        print("ERROR: no { } block found in Gemini response")
+        logger.error("No { } block found in Gemini response")
         return None
 
     json_str = text[start:end + 1]
@@ -53,17 +80,15 @@ def _extract_json_from_text(raw):
     try:
         return json.loads(json_str)
     except json.JSONDecodeError as e:
-        print(f"Direct JSON parse failed ({e}). Trying repair...")
+        logger.info("Direct JSON parse failed, trying repair", extra={"error": str(e)})
 
     # 4. Repair trailing commas before } or ]  (most common Gemini error)
     repaired = re.sub(r",\s*([}\]])", r"\1", json_str)
     try:
         return json.loads(repaired)
     except json.JSONDecodeError as e:
-        print(f"Repaired JSON parse also failed ({e}).")
-        print("--- Raw Gemini output (first 1500 chars) ---")
-        print(raw[:1500])
-        print("--------------------------------------------")
+        logger.warning("Repaired JSON parse also failed", extra={"error": str(e)})
+        log_payload(logger, "Unparseable Gemini output", raw[:1500])
         return None
 
 
@@ -78,34 +103,47 @@ def _fill_defaults(data):
     return data
 
 
-def analyze_with_llm(text, patient_context, structured_data, file_paths=None):
-    """
-    Analyze medical report text using Google Gemini.
-    Returns a fully validated dict matching the frontend JSON shape,
-    or None to trigger the backend demo fallback.
-    """
+def _get_api_key():
+    """Configured Gemini key, or None when only the demo placeholder is available."""
+    _load_env()
     api_key = (os.getenv("GEMINI_API_KEY") or HARDCODED_API_KEY or "").strip()
-
     if not api_key or api_key == "AIzaSyDemoKeyReplaceWithYours":
-        print("No valid GEMINI_API_KEY — using backend demo fallback.")
         return None
+    return api_key
 
+
+def _discover_models():
+    """Names of models that support generateContent (empty list on failure)."""
+    available_models = []
     try:
-        genai.configure(api_key=api_key)
+        for m in _genai().list_models():
+            if "generateContent" in m.supported_generation_methods:
+                available_models.append(m.name)
+        logger.debug("Gemini model discovery", extra={"models": available_models})
+    except Exception as e:
+        logger.warning("list_models() failed", extra={"error": str(e)})
+    return available_models
+
+
+def warm_up():
+    """Import the Gemini SDK now (serve.py calls this before forking workers)."""
+    _load_env()
+    _genai()
 
-        # ── Discover available models ─────────────────────────────────────────
-        available_models = []
-        try:
-            print("Checking available Gemini models...")
-            for m in genai.list_models():
-                if "generateContent" in m.supported_generation_methods:
-                    available_models.append(m.name)
-            print(f"Found models: {', '.join(available_models) or 'none'}")
-        except Exception as e:
-            print(f"list_models() failed: {e}")
 
-        # ── Prompt ────────────────────────────────────────────────────────────
-        prompt = f"""
+def _build_contents(text, patient_context, structured_data, file_paths=None, history=None, entities=None):
+    """Prompt plus any attached report images, in generate_content() order."""
+    # Earlier results for the same patient (lab_history.summary), if any
+    history_section = f"""
+PREVIOUS RESULTS FOR THIS PATIENT (oldest → newest; compare and mention trends):
+{history}
+""" if history else ""
+    # Medications / extra values found by entity_extraction — no need to re-extract them
+    entities_section = f"""
+ENTITIES (pre-extracted from the document text):
+{entities}
+""" if entities else ""
+    prompt = f"""
 You are Dr.MeD-AI, an expert medical AI assistant.
 Analyze the following medical document (lab report or prescription).
 Return ONLY valid JSON — no explanation, no markdown fences, no extra text before or after.
@@ -119,8 +157,8 @@ DOCUMENT TEXT:
 {text[:8000]}
 
 STRUCTURED LAB VALUES (pre-extracted):
-{json.dumps(structured_data, indent=2)}
-
+{json.dumps(structured_data, separators=(",", ":"))}
+{entities_section}{history_section}
 Return ONLY this JSON (all fields required, no fields skipped):
 {{
     "patient_summary": "Patient name, age, gender extracted from the document.",
@@ -139,71 +177,259 @@ Return ONLY this JSON (all fields required, no fields skipped):
 }}
 """
 
-        # ── Optional: attach images ────────────────────────────────────────────
-        contents = [prompt]
-        if file_paths:
-            for path in file_paths:
-                if path.lower().endswith(('.png', '.jpg', '.jpeg', '.webp', '.heic', '.heif')):
-                    try:
-                        import PIL.Image
-                        contents.append(PIL.Image.open(path))
-                        print(f"Added image: {os.path.basename(path)}")
-                    except ImportError:
-                        print("PIL not installed — image skipped.")
-                    except Exception as e:
-                        print(f"Could not load image {path}: {e}")
-
-        # ── Select models ──────────────────────────────────────────────────────
-        models_to_try = []
-        if available_models:
-            models_to_try += [m for m in available_models if "flash" in m.lower()]
-            models_to_try += [m for m in available_models if "pro" in m.lower() and m not in models_to_try]
-            models_to_try += [m for m in available_models if m not in models_to_try]
-        if not models_to_try:
-            models_to_try = [
-                "models/gemini-1.5-flash",
-                "models/gemini-2.0-flash",
-                "models/gemini-1.5-pro",
-                "models/gemini-pro",
-            ]
+    # ── Optional: attach images ────────────────────────────────────────────────
+    contents = [prompt]
+    if file_paths:
+        for path in file_paths:
+            if path.lower().endswith(('.png', '.jpg', '.jpeg', '.webp', '.heic', '.heif')):
+                try:
+                    import PIL.Image
+                    contents.append(PIL.Image.open(path))
+                    logger.debug("Added image", extra={"file": os.path.basename(path)})
+                except ImportError:
+                    logger.warning("PIL not installed — image skipped.")
+                except Exception as e:
+                    logger.warning("Could not load image", extra={"file": path, "error": str(e)})
+    return contents
+
+
+def _select_models(available_models):
+    """Flash models first (fast/cheap), then pro, then anything else."""
+    models_to_try = []
+    if available_models:
+        models_to_try += [m for m in available_models if "flash" in m.lower()]
+        models_to_try += [m for m in available_models if "pro" in m.lower() and m not in models_to_try]
+        models_to_try += [m for m in available_models if m not in models_to_try]
+    if not models_to_try:
+        models_to_try = [
+            "models/gemini-1.5-flash",
+            "models/gemini-2.0-flash",
+            "models/gemini-1.5-pro",
+            "models/gemini-pro",
+        ]
+    return models_to_try
+
+
+# A 429 is quota, not a broken model: back off on the same model instead of
+# spilling the burst onto the next one.
+QUOTA_RETRIES = int(os.getenv("LLM_QUOTA_RETRIES", "1"))
+
+
+def _is_quota_error(e):
+    return (getattr(e, "code", None) == 429 or type(e).__name__ == "ResourceExhausted"
+            or "429" in str(e))
+
+
+def _generate(m_name, contents, est_tokens, priority):
+    """One model, rate limited, with quota-aware retry. Returns raw text or None."""
+    for attempt in range(QUOTA_RETRIES + 1):
+        try:
+            limiter.acquire(m_name, est_tokens, priority)
+            logger.debug("Trying model", extra={"model": m_name})
+            model    = _genai().GenerativeModel(m_name)
+            with span("llm_call", model=m_name):
+                response = model.generate_content(contents)
+            if response and response.text:
+                logger.info("Got Gemini response", extra={"model": m_name, "chars": len(response.text)})
+                return response.text
+            return None
+        except RateLimitTimeout as e:
+            logger.warning("Gemini quota wait timed out", extra={"model": m_name, "error": str(e)})
+            return None
+        except Exception as e:
+            if _is_quota_error(e) and attempt < QUOTA_RETRIES:
+                logger.warning("Gemini 429 — backing off", extra={"model": m_name})
+                limiter.penalize(m_name)
+                continue
+            logger.warning("Gemini model failed", extra={"model": m_name, "error": str(e)})
+            return None
+
+
+def _parse_response(raw_text):
+    """Raw Gemini text → validated result dict, or None for the demo fallback."""
+    # ── Raw response: full at DEBUG, sampled otherwise ─────────────────────────
+    log_payload(logger, "Raw Gemini response", raw_text[:3000])
+
+    with span("json_parse"):
+        result = _extract_json_from_text(raw_text)
+    if result is None:
+        logger.warning("JSON parsing failed — using demo fallback.")
+        return None
+
+    result = _fill_defaults(result)
+    logger.debug("LLM result parsed OK", extra={"keys": list(result.keys())})
+    return result
+
+
+def analyze_with_llm(text, patient_context, structured_data, file_paths=None, priority="interactive",
+                     history=None, entities=None):
+    """
+    Analyze medical report text using Google Gemini.
+    Returns a fully validated dict matching the frontend JSON shape,
+    or None to trigger the backend demo fallback.
+    priority ("interactive" / "batch") orders callers waiting for quota.
+    history is the patient's previous-results summary for the prompt,
+    entities the medications/values entity_extraction already found.
+    """
+    api_key = _get_api_key()
+    if not api_key:
+        logger.warning("No valid GEMINI_API_KEY — using backend demo fallback.")
+        return None
+
+    try:
+        _genai().configure(api_key=api_key)
+        available_models = _discover_models()
+        contents = _build_contents(text, patient_context, structured_data, file_paths, history, entities)
 
         # ── Call Gemini ────────────────────────────────────────────────────────
         raw_text = None
-        for m_name in models_to_try:
-            try:
-                print(f"Trying model: {m_name}...")
-                model    = genai.GenerativeModel(m_name)
-                response = model.generate_content(contents)
-                if response and response.text:
-                    raw_text = response.text
-                    print(f"Got response from: {m_name}")
-                    break
-            except Exception as e:
-                print(f"{m_name} failed: {e}")
+        est_tokens = estimate_tokens(contents[0])
+        for m_name in _select_models(available_models):
+            raw_text = _generate(m_name, contents, est_tokens, priority)
+            if raw_text:
+                break
 
         if not raw_text:
-            print("All Gemini models failed.")
+            logger.error("All Gemini models failed.")
             return None
 
-        # ── Always print raw response to terminal ──────────────────────────────
-        print("\n" + "=" * 60)
-        print("RAW GEMINI RESPONSE:")
-        print("=" * 60)
-        print(raw_text[:3000])
-        print("=" * 60 + "\n")
+        return _parse_response(raw_text)
 
-        # ── Parse JSON ─────────────────────────────────────────────────────────
-        result = _extract_json_from_text(raw_text)
-        if result is None:
-            print("JSON parsing failed — using demo fallback.")
+    except Exception as e:
+        logger.exception("LLM crashed")
+        return None
+
+
+LITERACY_STYLES = {
+    "low": "a patient with no medical background: short sentences, everyday words, no jargon",
+    "medium": "an educated patient: plain language, medical terms briefly explained",
+    "high": "a medical professional: precise clinical terminology, concise",
+}
+
+
+def rewrite_for_literacy(text, literacy_level, priority="interactive"):
+    """
+    Re-express an existing analysis narrative for another literacy level.
+    Much smaller than a full analysis (no document, no JSON); returns the
+    rewritten text, or None so the caller keeps the original wording.
+    """
+    api_key = _get_api_key()
+    if not api_key or not text:
+        return None
+
+    style = LITERACY_STYLES.get(literacy_level, LITERACY_STYLES["medium"])
+    prompt = (f"Rewrite the following medical report explanation for {style}. "
+              "Keep every finding, number and recommendation; add nothing new. "
+              f"Return only the rewritten text.\n\n{text[:4000]}")
+    try:
+        _genai().configure(api_key=api_key)
+        est_tokens = estimate_tokens(prompt, expected_output=len(text) // 3 + 256)
+        for m_name in _select_models([]):
+            raw_text = _generate(m_name, [prompt], est_tokens, priority)
+            if raw_text:
+                return raw_text.strip()
+        return None
+    except Exception:
+        logger.exception("Literacy rewrite crashed")
+        return None
+
+
+# ── ASYNC VARIANT ─────────────────────────────────────────────────────────────
+# Same prompt, model order and parsing, but the Gemini call is awaited
+# (generate_content_async) so one event loop can hold many in-flight
+# analyses. Blocking helpers (model discovery, image loading) run in a
+# thread via asyncio.to_thread, which also carries the request's
+# contextvars (request id, timings) across.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+
+SLOT_POLL_SECONDS = 0.01
+
+
+class _ModelSlots:
+    """
+    Per-model concurrency bound shared by every event loop of the process —
+    plain Flask runs each async view on a loop of its own, so an
+    asyncio.Semaphore (bound to one loop) would limit nothing there. Waiting
+    polls a threading semaphore without blocking, so a cancelled waiter
+    never holds a slot.
+    """
+
+    def __init__(self, limit):
+        self._semaphore = threading.BoundedSemaphore(limit)
+
+    async def __aenter__(self):
+        while not self._semaphore.acquire(blocking=False):
+            await asyncio.sleep(SLOT_POLL_SECONDS)
+
+    async def __aexit__(self, *exc):
+        self._semaphore.release()
+
+
+_model_slots = {}
+_model_slots_lock = threading.Lock()
+
+
+def _model_semaphore(m_name):
+    """Per-model concurrency bound (LLM_MAX_CONCURRENCY), process-wide."""
+    with _model_slots_lock:
+        if m_name not in _model_slots:
+            _model_slots[m_name] = _ModelSlots(LLM_MAX_CONCURRENCY)
+        return _model_slots[m_name]
+
+
+async def _generate_async(m_name, contents, est_tokens, priority):
+    """Awaitable _generate()."""
+    for attempt in range(QUOTA_RETRIES + 1):
+        try:
+            await limiter.acquire_async(m_name, est_tokens, priority)
+            logger.debug("Trying model", extra={"model": m_name})
+            model = _genai().GenerativeModel(m_name)
+            async with _model_semaphore(m_name):
+                with span("llm_call", model=m_name):
+                    response = await model.generate_content_async(contents)
+            if response and response.text:
+                logger.info("Got Gemini response", extra={"model": m_name, "chars": len(response.text)})
+                return response.text
+            return None
+        except RateLimitTimeout as e:
+            logger.warning("Gemini quota wait timed out", extra={"model": m_name, "error": str(e)})
+            return None
+        except Exception as e:
+            if _is_quota_error(e) and attempt < QUOTA_RETRIES:
+                logger.warning("Gemini 429 — backing off", extra={"model": m_name})
+                await asyncio.to_thread(limiter.penalize, m_name)
+                continue
+            logger.warning("Gemini model failed", extra={"model": m_name, "error": str(e)})
+            return None
+
+
+async def analyze_with_llm_async(text, patient_context, structured_data, file_paths=None, priority="interactive",
+                                 history=None, entities=None):
+    """Awaitable analyze_with_llm(); same return contract."""
+    api_key = _get_api_key()
+    if not api_key:
+        logger.warning("No valid GEMINI_API_KEY — using backend demo fallback.")
+        return None
+
+    try:
+        _genai().configure(api_key=api_key)
+        available_models = await asyncio.to_thread(_discover_models)
+        contents = await asyncio.to_thread(_build_contents, text, patient_context, structured_data,
+                                           file_paths, history, entities)
+
+        raw_text = None
+        est_tokens = estimate_tokens(contents[0])
+        for m_name in _select_models(available_models):
+            raw_text = await _generate_async(m_name, contents, est_tokens, priority)
+            if raw_text:
+                break
+
+        if not raw_text:
+            logger.error("All Gemini models failed.")
             return None
 
-        result = _fill_defaults(result)
-        print("LLM result parsed OK. Keys:", list(result.keys()))
-        return result
+        return _parse_response(raw_text)
 
     except Exception as e:
-        print(f"LLM crashed: {e}")
-        import traceback
-        traceback.print_exc()
-        return None
\ No newline at end of file
+        logger.exception("LLM crashed")
+        return None
@@ -0,0 +1,157 @@
+import os
+import sys
+import copy
+import json
+import queue
+import random
+import atexit
+import logging
+import contextvars
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Structured, non-blocking logging for the request path.
+#
+# HOW IT WORKS:
+#   Request threads only push LogRecords onto a bounded in-memory queue
+#   (microseconds). A single background QueueListener thread formats them
+#   and does the actual stdout/stderr I/O, so slow terminals or log shippers
+#   never stall a request and lines from concurrent requests never interleave.
+#
+# ENVIRONMENT:
+#   LOG_LEVEL                 DEBUG / INFO / WARNING ...        (default INFO)
+#   LOG_FORMAT                json | text                       (default text)
+#   LOG_PAYLOAD_SAMPLE_RATE   fraction of large payloads logged (default 0.0)
+#   LOG_PAYLOAD_MAX_CHARS     truncate sampled payloads to this (default 500)
+#   LOG_QUEUE_SIZE            max buffered records, extra are dropped (10000)
+# ─────────────────────────────────────────────────────────────────────────────
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.0"))
+PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "500"))
+QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+request_id_var = contextvars.ContextVar("drmed_request_id", default="-")
+
+# Attributes every LogRecord has — anything else came in through extra={...}.
+_STANDARD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id"}
+
+
+class _RequestIdFilter(logging.Filter):
+    """Stamp the caller's request id onto the record before it leaves the thread."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks and keeps extra={...} fields intact."""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _NonBlockingQueueHandler.dropped += 1
+
+    def prepare(self, record):
+        # Resolve %-args and tracebacks now (cheap), leave formatting to the listener.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, request_id, msg + extra fields."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable single line, extra fields appended as key=value."""
+
+    def format(self, record):
+        line = (f"{datetime.fromtimestamp(record.created).strftime('%H:%M:%S.%f')[:-3]} "
+                f"{record.levelname:<7} [{getattr(record, 'request_id', '-')}] "
+                f"{record.name}: {record.getMessage()}")
+        extras = " ".join(f"{k}={v}" for k, v in record.__dict__.items() if k not in _STANDARD_ATTRS)
+        if extras:
+            line += f"  {extras}"
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+# ── One-time setup of the "drmed" logger tree ────────────────────────────────
+_queue = queue.Queue(maxsize=QUEUE_SIZE)
+_stream = logging.StreamHandler(sys.stderr)
+_stream.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+_listener = QueueListener(_queue, _stream, respect_handler_level=False)
+
+_handler = _NonBlockingQueueHandler(_queue)
+_handler.addFilter(_RequestIdFilter())
+
+_root = logging.getLogger("drmed")
+_root.setLevel(LOG_LEVEL)
+_root.addHandler(_handler)
+_root.propagate = False
+
+_listener.start()
+atexit.register(lambda: _listener.stop())
+
+
+def _restart_after_fork():
+    # Threads don't survive fork(): a preforked server worker gets a fresh
+    # queue and its own listener thread instead of the parent's dead one.
+    global _queue, _listener
+    _queue = queue.Queue(maxsize=QUEUE_SIZE)
+    _handler.queue = _queue
+    _listener = QueueListener(_queue, _stream, respect_handler_level=False)
+    _listener.start()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def get_logger(name):
+    """Module logger under the shared 'drmed' tree, e.g. get_logger('llm')."""
+    return _root.getChild(name)
+
+
+def log_payload(logger, label, payload):
+    """
+    Log a large payload (raw LLM output, summaries) without paying for it on
+    every request: always at DEBUG, otherwise only a sampled, truncated copy.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(label, extra={"payload": payload})
+    elif PAYLOAD_SAMPLE_RATE > 0 and random.random() < PAYLOAD_SAMPLE_RATE:
+        text = payload if isinstance(payload, str) else json.dumps(payload, default=str)
+        logger.info(label, extra={"payload": text[:PAYLOAD_MAX_CHARS], "sampled": True})
+
+
+def dropped_records():
+    """Records discarded because the log queue was full (exposed for health checks)."""
+    return _NonBlockingQueueHandler.dropped
@@ -0,0 +1,155 @@
+import os
+import json
+import queue
+import atexit
+import threading
+from collections import deque, OrderedDict
+from instrumentation import span
+from log_setup import get_logger
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Write-behind JSON persistence — keeps disk latency off the request thread.
+#
+# HOW IT WORKS:
+#   save_json(path, obj) only enqueues (path, obj) and returns immediately.
+#   A single writer thread drains the queue in batches, keeps the last write
+#   per path (so a burst of updates to one file costs one write), encodes
+#   compactly and writes each file via tmp-file + os.replace, so readers
+#   never see a half-written record. pending(path) serves an object that is
+#   queued but not yet written, so a read right after save_json never has to
+#   wait for the writer.
+#
+#   DebugRing replaces the old shared _debug_last.json: each analyze call
+#   stores its debug payload in memory under its request id, so concurrent
+#   requests no longer overwrite each other's file.
+# ─────────────────────────────────────────────────────────────────────────────
+
+logger = get_logger("persistence")
+
+BATCH_SIZE = 64           # max records written per batch
+FLUSH_INTERVAL = 0.25     # seconds the writer waits to fill a batch
+
+
+def _atomic_write_json(path, obj):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, separators=(",", ":"), ensure_ascii=False, default=str)
+    os.replace(tmp_path, path)
+
+
+class WriteBehindQueue:
+    """Background batching writer for JSON records."""
+
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._unwritten = {}      # path → newest obj submitted but not on disk yet
+
+    def _ensure_started(self):
+        # Started lazily so forked server workers each get their own writer thread.
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                    self._thread.start()
+
+    def reset(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._unwritten = {}
+
+    def submit(self, path, obj):
+        self._ensure_started()
+        with self._lock:
+            self._unwritten[path] = obj
+        self._queue.put((path, obj))
+
+    def pending(self, path):
+        """The object queued for path that this process hasn't written yet, or None."""
+        with self._lock:
+            return self._unwritten.get(path)
+
+    def flush(self, timeout=None):
+        """Block until everything submitted so far is on disk."""
+        if self._thread is not None and self._thread.is_alive():
+            done = threading.Event()
+            self._queue.put(done)
+            done.wait(timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            batch = [item]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get(timeout=self.flush_interval))
+            except queue.Empty:
+                pass
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        pending = OrderedDict()
+        waiters = []
+        for item in batch:
+            if isinstance(item, threading.Event):
+                waiters.append(item)
+            else:
+                path, obj = item
+                pending.pop(path, None)
+                pending[path] = obj
+        if pending:
+            with span("persistence_flush"):
+                for path, obj in pending.items():
+                    try:
+                        _atomic_write_json(path, obj)
+                    except Exception as e:
+                        logger.warning("Write-behind failed", extra={"file": path, "error": str(e)})
+                    with self._lock:
+                        if self._unwritten.get(path) is obj:    # not re-submitted meanwhile
+                            del self._unwritten[path]
+        for done in waiters:
+            done.set()
+
+
+class DebugRing:
+    """Last N per-request debug payloads, newest last, looked up by request id."""
+
+    def __init__(self, size=50):
+        self._items = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, request_id, payload):
+        with self._lock:
+            self._items.append((request_id, payload))
+
+    def get(self, request_id=None):
+        with self._lock:
+            items = list(self._items)
+        if request_id is None:
+            return items[-1][1] if items else None
+        for rid, payload in reversed(items):
+            if rid == request_id:
+                return payload
+        return None
+
+    def request_ids(self):
+        with self._lock:
+            return [rid for rid, _ in self._items]
+
+
+writer = WriteBehindQueue()
+debug_ring = DebugRing(size=int(os.getenv("DEBUG_RING_SIZE", "50")))
+atexit.register(writer.flush, 5.0)
+
+if hasattr(os, "register_at_fork"):
+    # Forked server workers start with an empty queue and their own writer thread.
+    os.register_at_fork(after_in_child=writer.reset)
+
+
+def save_json(path, obj):
+    """Persist obj as JSON at path, off the request thread."""
+    writer.submit(path, obj)
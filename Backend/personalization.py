@@ -0,0 +1,237 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+import knowledge_base
+from explanation_engine import rule_based_analysis
+from instrumentation import span
+from log_setup import get_logger
+from persistence import save_json, writer
+from singleflight import SingleFlight
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Literacy personalization as a post-processing stage.
+#
+# HOW IT WORKS:
+#   /api/analyze produces ONE canonical analysis, written for the literacy
+#   level the patient picked. Other levels are derived from it on first
+#   request and cached per (analysisId, level):
+#     - findings with a known test   → knowledge table phrasing (templates)
+#     - rule-engine analyses         → rule engine re-run at the new level
+#     - LLM narrative (free text)    → one short Gemini rewrite, nothing else
+#   The canonical level is served from the stored record as-is, and every
+#   variant is persisted next to the analysis record, so toggling literacy
+#   in the UI is a dict hit after the first switch — never a new analysis.
+#
+# ENVIRONMENT:
+#   PERSONALIZATION_CACHE_SIZE   in-memory variants/records kept (default 1024)
+# ─────────────────────────────────────────────────────────────────────────────
+
+logger = get_logger("personalization")
+
+CACHE_SIZE = int(os.getenv("PERSONALIZATION_CACHE_SIZE", "1024"))
+TEXT_FIELDS = ("patient_summary", "test_report_summary", "clinical_interpretation",
+               "known_information", "unclear_information")
+
+
+class _LRU:
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+
+def structured_from_findings(findings):
+    """Frontend findings → explanation_engine items (for records without structuredData)."""
+    items = []
+    for finding in findings:
+        try:
+            value = float(finding["value"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        items.append({"test": finding.get("label", ""), "value": value,
+                      "status": str(finding.get("status", "normal")).capitalize(),
+                      "range": finding.get("normalRange", ""), "unit": finding.get("unit", "")})
+    return items
+
+
+def personalize_text(content, literacy, rewrite=None):
+    """
+    Ad-hoc content (no analysisId): knowledge table phrasing when it names a
+    known test ("HbA1c: 6.2%"), otherwise an LLM rewrite, otherwise unchanged.
+    """
+    content = str(content or "")
+    test = content.split(":", 1)[0]
+    if knowledge_base.is_known(test):
+        return f"{content.strip()} — {knowledge_base.meaning(test, literacy)}"
+    if rewrite and content.strip():
+        return rewrite(content, knowledge_base.literacy_key(literacy)) or content
+    return content
+
+
+class Personalizer:
+    """Lazily built, cached per-literacy views of stored analyses."""
+
+    def __init__(self, analysis_folder, rewrite=None, cache_size=CACHE_SIZE, load_archived=None):
+        self.analysis_folder = analysis_folder
+        self.variant_folder = os.path.join(analysis_folder, "personalized")
+        self.rewrite = rewrite          # (text, level) → text or None
+        self.load_archived = load_archived  # analysisId → record or None (storage_lifecycle archive)
+        self._records = _LRU(cache_size)
+        self._variants = _LRU(cache_size)
+        self._inflight = SingleFlight()
+
+    # ── Canonical records ────────────────────────────────────────────────────
+    def remember(self, record):
+        """Called by /api/analyze so the first toggle doesn't wait on disk."""
+        self._records.put(record["analysisId"], record)
+        level = knowledge_base.literacy_key(record.get("patientContext", {}).get("literacyLevel"))
+        self._variants.put((record["analysisId"], level), self._canonical_view(record, level))
+
+    def _load_record(self, analysis_id):
+        record = self._records.get(analysis_id)
+        if record is not None:
+            return record
+        path = os.path.join(self.analysis_folder, f"{os.path.basename(analysis_id)}.json")
+        # Just analysed by this process: still queued in the write-behind writer
+        record = writer.pending(path)
+        if record is None:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                record = self.load_archived(analysis_id) if self.load_archived else None
+                if record is None:
+                    return None
+        self._records.put(analysis_id, record)
+        return record
+
+    # ── Variants ─────────────────────────────────────────────────────────────
+    def get(self, analysis_id, literacy):
+        """
+        (variant, cached) for this analysis at this literacy level, or
+        (None, False) when the analysis does not exist.
+        """
+        level = knowledge_base.literacy_key(literacy)
+        key = (analysis_id, level)
+        variant = self._variants.get(key)
+        if variant is not None:
+            return variant, True
+
+        variant = self._load_variant(analysis_id, level)
+        if variant is not None:
+            self._variants.put(key, variant)
+            return variant, True
+
+        variant, _ = self._inflight.do(key, self._build, analysis_id, level)
+        return variant, False
+
+    def _variant_path(self, analysis_id, level):
+        return os.path.join(self.variant_folder, f"{os.path.basename(analysis_id)}.{level}.json")
+
+    def _load_variant(self, analysis_id, level):
+        try:
+            with open(self._variant_path(analysis_id, level), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _build(self, analysis_id, level):
+        record = self._load_record(analysis_id)
+        if record is None:
+            return None
+        with span("personalize", level=level):
+            canonical = knowledge_base.literacy_key(record.get("patientContext", {}).get("literacyLevel"))
+            if level == canonical:
+                variant, complete = self._canonical_view(record, level), True
+            else:
+                variant, complete = self._derive(record, level)
+
+        if not complete:
+            # The LLM rewrite failed: serve the original narrative this time, but
+            # don't cache it — the next request tries the rewrite again
+            logger.warning("Literacy rewrite failed, variant not cached",
+                           extra={"analysisId": analysis_id, "level": level})
+            return variant
+        self._variants.put((analysis_id, level), variant)
+        os.makedirs(self.variant_folder, exist_ok=True)
+        save_json(self._variant_path(analysis_id, level), variant)
+        logger.info("Built literacy variant", extra={"analysisId": analysis_id, "level": level,
+                                                     "sources": variant["sources"]})
+        return variant
+
+    @staticmethod
+    def _view(record, level, ai_response, findings, recommendations, sources):
+        return {
+            "analysisId": record["analysisId"],
+            "literacyLevel": level,
+            "aiResponse": ai_response,
+            "analysis": ai_response.get("clinical_interpretation", ""),
+            "findings": findings,
+            "recommendations": recommendations,
+            "sources": sources,
+        }
+
+    @staticmethod
+    def _explained_findings(findings, level, sources):
+        explained = []
+        for finding in findings:
+            finding = dict(finding)
+            test = finding.get("label", "")
+            if knowledge_base.is_known(test):
+                finding["explanation"] = knowledge_base.explain(
+                    test, str(finding.get("status", "normal")).capitalize(), level)
+                sources["templates"] += 1
+            explained.append(finding)
+        return explained
+
+    def _canonical_view(self, record, level):
+        result = record["result"]
+        sources = {"canonical": True, "templates": 0, "llm": 0}
+        findings = self._explained_findings(result.get("findings", []), level, sources)
+        return self._view(record, level, result.get("aiResponse", {}), findings,
+                          result.get("recommendations", []), sources)
+
+    def _derive(self, record, level):
+        """(variant, complete) — complete is False when the narrative rewrite failed."""
+        result = record["result"]
+        structured = record.get("structuredData") or structured_from_findings(result.get("findings", []))
+        sources = {"canonical": False, "templates": 0, "llm": 0}
+        findings = self._explained_findings(result.get("findings", []), level, sources)
+
+        ai_response = dict(result.get("aiResponse", {}))
+        recommendations = result.get("recommendations", [])
+        tier = result.get("analysisTier")
+        complete = True
+
+        if tier == "rules" and structured:
+            # Fully templated: re-run the rule engine at the requested level
+            rules = rule_based_analysis(structured, {**record.get("patientContext", {}), "literacyLevel": level})
+            ai_response = {key: rules[key] for key in TEXT_FIELDS}
+            recommendations = rules["recommendations"]
+        elif tier == "llm" and self.rewrite:
+            # Residual free text: only the narrative needs the LLM
+            narrative = ai_response.get("clinical_interpretation")
+            rewritten = self.rewrite(narrative, level) if narrative else None
+            if rewritten:
+                ai_response["clinical_interpretation"] = rewritten
+                sources["llm"] += 1
+            elif narrative:
+                complete = False
+
+        return self._view(record, level, ai_response, findings, recommendations, sources), complete
@@ -1,29 +1,182 @@
-from sentence_transformers import SentenceTransformer
-import faiss
 import os
+import json
+import socket
+import threading
 import numpy as np
 
-model = SentenceTransformer("all-MiniLM-L6-v2")
+# ─────────────────────────────────────────────────────────────────────────────
+# Retrieval over the reference documents (SentenceTransformer + FAISS).
+#
+# HOW IT WORKS:
+#   In-process (default): the embedding model is loaded on first use and the
+#   FAISS index lives in this process — fine for the Streamlit app or a
+#   single server process.
+#
+#   Shared (RAG_SOCKET set): model and indexes live once per node in the
+#   embedding sidecar (embedding_service.py), and every worker talks to it
+#   over that Unix socket. create_vector_store() sends the documents once;
+#   the sidecar keys the index by their content hash, so N workers with the
+#   same corpus share one index. Memory per node stays at one model + one
+#   index no matter how many workers run, and concurrent queries from all
+#   workers are encoded and searched together in micro-batches.
+#
+#   Both modes expose the same functions, so callers don't care which one
+#   is active:  index, docs = create_vector_store(load_documents(folder))
+#               retrieve(query, index, docs)
+#
+# ENVIRONMENT:
+#   RAG_MODEL     SentenceTransformer name (default all-MiniLM-L6-v2)
+#   RAG_SOCKET    embedding sidecar socket; unset = in-process
+# ─────────────────────────────────────────────────────────────────────────────
+
+MODEL_NAME = os.getenv("RAG_MODEL", "all-MiniLM-L6-v2")
+RAG_SOCKET = os.getenv("RAG_SOCKET")
+DOCUMENT_EXTENSIONS = (".txt", ".md")
+UNKNOWN_INDEX = "unknown index"     # sidecar error for an index it doesn't hold (restarted)
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """The SentenceTransformer, imported and loaded on first use."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                from sentence_transformers import SentenceTransformer
+                _model = SentenceTransformer(MODEL_NAME)
+    return _model
+
 
 def load_documents(folder_path):
     documents = []
-    for file in os.listdir(folder_path):
-        with open(os.path.join(folder_path, file), "r", encoding="utf-8") as f:
-            documents.append(f.read())
+    for file in sorted(os.listdir(folder_path)):
+        path = os.path.join(folder_path, file)
+        # data/ also holds the server's databases and record folders
+        if not os.path.isfile(path) or not file.lower().endswith(DOCUMENT_EXTENSIONS):
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        if text.strip():
+            documents.append(text)
     return documents
 
+
+def build_index(embeddings):
+    import faiss
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    index = faiss.IndexFlatL2(embeddings.shape[1])
+    index.add(embeddings)
+    return index
+
+
+class RemoteIndex:
+    """
+    Handle to an index held by the embedding sidecar. Keeps the documents so
+    the index can be registered again when the sidecar restarts empty.
+    """
+
+    def __init__(self, client, index_id, documents):
+        self.client = client
+        self.index_id = index_id
+        self.documents = documents
+        self.ntotal = len(documents)
+
+    def search_text(self, query, top_k):
+        request = {"op": "search", "index": self.index_id, "query": query, "top_k": top_k}
+        try:
+            reply = self.client.call(request)
+        except RuntimeError as e:
+            if UNKNOWN_INDEX not in str(e):
+                raise
+            # Sidecar restarted since the index was registered: register again, retry once
+            self.index_id = request["index"] = self.client.register(self.documents)
+            reply = self.client.call(request)
+        return reply["distances"], reply["indices"]
+
+
+class EmbeddingClient:
+    """Line-delimited JSON over the sidecar's Unix socket, one connection per thread."""
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+            conn = self._local.conn = sock.makefile("rwb")
+            self._local.pid = os.getpid()
+        return conn
+
+    def call(self, request):
+        for attempt in (1, 2):
+            try:
+                conn = self._connection()
+                conn.write(json.dumps(request).encode("utf-8") + b"\n")
+                conn.flush()
+                line = conn.readline()
+                if not line:
+                    raise ConnectionError("embedding service closed the connection")
+                break
+            except OSError:
+                self._local.conn = None     # sidecar restarted: reconnect once
+                if attempt == 2:
+                    raise
+        reply = json.loads(line)
+        if "error" in reply:
+            raise RuntimeError(f"embedding service: {reply['error']}")
+        return reply
+
+    def encode(self, texts):
+        return np.array(self.call({"op": "encode", "texts": list(texts)})["embeddings"], dtype=np.float32)
+
+    def register(self, documents):
+        return self.call({"op": "index", "documents": list(documents)})["index"]
+
+    def create_index(self, documents):
+        documents = list(documents)
+        return RemoteIndex(self, self.register(documents), documents)
+
+
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None and RAG_SOCKET:
+        _client = EmbeddingClient(RAG_SOCKET)
+    return _client
+
+
+def encode(texts):
+    client = get_client()
+    if client is not None:
+        return client.encode(texts)
+    return get_model().encode(list(texts))
+
+
 def create_vector_store(documents):
-    embeddings = model.encode(documents)
-    dimension = embeddings.shape[1]
-    
-    index = faiss.IndexFlatL2(dimension)
-    index.add(np.array(embeddings))
-    
-    return index, documents
+    client = get_client()
+    if client is not None:
+        return client.create_index(documents), documents
+    return build_index(encode(documents)), documents
+
+
+def search(query, index, documents, top_k=2):
+    """[(document, L2 distance)], nearest first."""
+    if isinstance(index, RemoteIndex):
+        distances, indices = index.search_text(query, top_k)
+    else:
+        query_embedding = np.asarray(encode([query]), dtype=np.float32)
+        distances, indices = index.search(query_embedding, top_k)
+        distances, indices = distances[0].tolist(), indices[0].tolist()
+    # FAISS pads with -1 when top_k exceeds the number of documents
+    return [(documents[i], d) for i, d in zip(indices, distances) if i >= 0]
+
 
 def retrieve(query, index, documents, top_k=2):
-    query_embedding = model.encode([query])
-    distances, indices = index.search(np.array(query_embedding), top_k)
-    
-    results = [documents[i] for i in indices[0]]
-    return results
\ No newline at end of file
+    return [document for document, _ in search(query, index, documents, top_k)]
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+import itertools
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Cross-worker token buckets for Gemini quota (requests/min + tokens/min).
+#
+# HOW IT WORKS:
+#   Bucket state lives in one SQLite file (WAL mode), so every worker process
+#   on the node draws from the same budget. acquire(model, tokens, priority)
+#   registers as a waiter, then repeatedly — inside BEGIN IMMEDIATE — checks
+#   that no higher-priority (or older same-priority) waiter is ahead of it for
+#   that model, refills both buckets for the elapsed time and takes one
+#   request + the estimated tokens if both have enough. Otherwise it sleeps
+#   until the buckets should have refilled and tries again.
+#
+#   "interactive" callers (the analyze button) always go before "batch" ones.
+#   A 429 from Gemini empties the model's request bucket (penalize), so every
+#   worker backs off together instead of hammering the next model.
+#
+# ENVIRONMENT:
+#   LLM_RPM / LLM_TPM      default per-model limits (15 / 1,000,000)
+#   LLM_RATE_LIMITS        JSON overrides, {"models/gemini-1.5-pro": {"rpm": 2, "tpm": 32000}}
+#   LLM_QUEUE_TIMEOUT      max seconds to wait for quota (default 60)
+#   RATE_LIMIT_DB          SQLite path (default data/ratelimit.sqlite3)
+# ─────────────────────────────────────────────────────────────────────────────
+
+PRIORITIES = {"interactive": 0, "batch": 1}
+
+DEFAULT_RPM = float(os.getenv("LLM_RPM", "15"))
+DEFAULT_TPM = float(os.getenv("LLM_TPM", "1000000"))
+MODEL_LIMITS = json.loads(os.getenv("LLM_RATE_LIMITS", "{}"))
+QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "60"))
+DB_PATH = os.getenv("RATE_LIMIT_DB", os.path.join("data", "ratelimit.sqlite3"))
+
+WAITER_TTL = 5.0        # a waiter that stops polling for this long is ignored
+MAX_POLL = 0.25         # never sleep longer than this between attempts
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    model TEXT NOT NULL, kind TEXT NOT NULL,
+    tokens REAL NOT NULL, updated REAL NOT NULL,
+    PRIMARY KEY (model, kind));
+CREATE TABLE IF NOT EXISTS waiters (
+    id TEXT PRIMARY KEY, model TEXT NOT NULL, priority INTEGER NOT NULL,
+    enqueued REAL NOT NULL, expires REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS stats (
+    model TEXT NOT NULL, name TEXT NOT NULL, value REAL NOT NULL,
+    PRIMARY KEY (model, name));
+"""
+
+
+class RateLimitTimeout(Exception):
+    """Quota did not free up within LLM_QUEUE_TIMEOUT."""
+
+
+def limits_for(model):
+    """(requests per minute, tokens per minute) for a model."""
+    override = MODEL_LIMITS.get(model, {})
+    return float(override.get("rpm", DEFAULT_RPM)), float(override.get("tpm", DEFAULT_TPM))
+
+
+def estimate_tokens(text, expected_output=1024):
+    """Rough Gemini token estimate (~4 chars/token) plus room for the JSON answer."""
+    return len(text) // 4 + expected_output
+
+
+class TokenBucketLimiter:
+
+    def __init__(self, db_path=DB_PATH, timeout=QUEUE_TIMEOUT):
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._ids = itertools.count()
+
+    # ── SQLite plumbing ──────────────────────────────────────────────────────
+    def _conn(self):
+        # One connection per thread and per process (never shared across fork).
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @staticmethod
+    def _bump(conn, model, name, amount=1):
+        conn.execute(
+            "INSERT INTO stats (model, name, value) VALUES (?, ?, ?) "
+            "ON CONFLICT(model, name) DO UPDATE SET value = value + excluded.value",
+            (model, name, amount))
+
+    @staticmethod
+    def _refill(conn, model, kind, per_minute, now):
+        row = conn.execute("SELECT tokens, updated FROM buckets WHERE model=? AND kind=?",
+                           (model, kind)).fetchone()
+        if row is None:
+            return per_minute
+        tokens, updated = row
+        return min(per_minute, tokens + (now - updated) * per_minute / 60.0)
+
+    # ── Core step ────────────────────────────────────────────────────────────
+    def _try_acquire(self, waiter_id, model, tokens, priority):
+        """
+        One attempt. Returns 0 when acquired, otherwise seconds to wait
+        before the next attempt.
+        """
+        rpm, tpm = limits_for(model)
+        tokens = min(tokens, tpm)   # a single huge prompt must still fit eventually
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT OR REPLACE INTO waiters (id, model, priority, enqueued, expires) "
+                         "VALUES (?, ?, ?, COALESCE((SELECT enqueued FROM waiters WHERE id=?), ?), ?)",
+                         (waiter_id, model, priority, waiter_id, now, now + WAITER_TTL))
+            enqueued = conn.execute("SELECT enqueued FROM waiters WHERE id=?", (waiter_id,)).fetchone()[0]
+            ahead = conn.execute(
+                "SELECT COUNT(*) FROM waiters WHERE model=? AND id<>? AND expires>? "
+                "AND (priority<? OR (priority=? AND enqueued<?))",
+                (model, waiter_id, now, priority, priority, enqueued)).fetchone()[0]
+            if ahead:
+                conn.execute("COMMIT")
+                return 0.05
+
+            req_tokens = self._refill(conn, model, "rpm", rpm, now)
+            tok_tokens = self._refill(conn, model, "tpm", tpm, now)
+            if req_tokens >= 1 and tok_tokens >= tokens:
+                req_tokens -= 1
+                tok_tokens -= tokens
+                conn.execute("DELETE FROM waiters WHERE id=?", (waiter_id,))
+                self._bump(conn, model, "acquired")
+                self._bump(conn, model, "tokens_reserved", tokens)
+                wait = 0.0
+            else:
+                wait = max((1 - req_tokens) * 60.0 / rpm, (tokens - tok_tokens) * 60.0 / tpm, 0.01)
+                self._bump(conn, model, "throttled_polls")
+
+            conn.executemany(
+                "INSERT OR REPLACE INTO buckets (model, kind, tokens, updated) VALUES (?, ?, ?, ?)",
+                [(model, "rpm", req_tokens, now), (model, "tpm", tok_tokens, now)])
+            conn.execute("COMMIT")
+            return wait
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _new_waiter(self):
+        return f"{os.getpid()}:{threading.get_ident()}:{next(self._ids)}"
+
+    def _give_up(self, waiter_id, model):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM waiters WHERE id=?", (waiter_id,))
+        self._bump(conn, model, "timeouts")
+        conn.execute("COMMIT")
+        raise RateLimitTimeout(f"No {model} quota within {self.timeout:.0f}s")
+
+    # ── Public API ───────────────────────────────────────────────────────────
+    def acquire(self, model, tokens, priority="interactive"):
+        """Block until one request + `tokens` are available for `model`."""
+        waiter_id = self._new_waiter()
+        prio = PRIORITIES.get(priority, PRIORITIES["interactive"])
+        deadline = time.time() + self.timeout
+        while True:
+            wait = self._try_acquire(waiter_id, model, tokens, prio)
+            if wait == 0:
+                return
+            if time.time() + wait > deadline + MAX_POLL:
+                self._give_up(waiter_id, model)
+            time.sleep(min(wait, MAX_POLL))
+
+    async def acquire_async(self, model, tokens, priority="interactive"):
+        """acquire() without blocking the event loop."""
+        waiter_id = self._new_waiter()
+        prio = PRIORITIES.get(priority, PRIORITIES["interactive"])
+        deadline = time.time() + self.timeout
+        while True:
+            wait = await asyncio.to_thread(self._try_acquire, waiter_id, model, tokens, prio)
+            if wait == 0:
+                return
+            if time.time() + wait > deadline + MAX_POLL:
+                await asyncio.to_thread(self._give_up, waiter_id, model)
+            await asyncio.sleep(min(wait, MAX_POLL))
+
+    def penalize(self, model):
+        """Gemini answered 429: empty the request bucket so all workers back off."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("INSERT OR REPLACE INTO buckets (model, kind, tokens, updated) VALUES (?, 'rpm', 0, ?)",
+                     (model, time.time()))
+        self._bump(conn, model, "http_429")
+        conn.execute("COMMIT")
+
+    def stats(self):
+        """Per-model limits, current bucket levels, queue depth and counters."""
+        conn = self._conn()
+        now = time.time()
+        out = {}
+        for model, kind, tokens, updated in conn.execute("SELECT model, kind, tokens, updated FROM buckets"):
+            rpm, tpm = limits_for(model)
+            per_minute = rpm if kind == "rpm" else tpm
+            entry = out.setdefault(model, {"limits": {"rpm": rpm, "tpm": tpm}})
+            entry[f"{kind}_available"] = round(min(per_minute, tokens + (now - updated) * per_minute / 60.0), 2)
+        for model, priority, count in conn.execute(
+                "SELECT model, priority, COUNT(*) FROM waiters WHERE expires>? GROUP BY model, priority", (now,)):
+            name = next((k for k, v in PRIORITIES.items() if v == priority), str(priority))
+            out.setdefault(model, {}).setdefault("waiting", {})[name] = count
+        for model, name, value in conn.execute("SELECT model, name, value FROM stats"):
+            out.setdefault(model, {}).setdefault("counters", {})[name] = value
+        return out
+
+
+limiter = TokenBucketLimiter()
@@ -0,0 +1,208 @@
+import os
+import json
+import threading
+import numpy as np
+import knowledge_base
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Risk scoring + condition classification on the normalized lab vector.
+#
+# HOW IT WORKS:
+#   Each patient becomes one row of a feature matrix: age, sex, history flags
+#   from the condition field, and one column per analyte (report names are
+#   mapped through the knowledge table, so "SGPT" and "ALT" land together).
+#   Columns are standardized with the artifact's center/scale; a missing lab
+#   gets z = 0, i.e. it neither raises nor lowers any score.
+#
+#   The artifact is in the knowledge table's units (creatinine mg/dL, HbA1c
+#   %). A lab reported with another unit is converted when the factor is
+#   known (SI_CONVERSIONS: µmol/L, mmol/L, g/L, mmol/mol) and otherwise
+#   treated as missing — 80 µmol/L of creatinine must never be read as
+#   80 mg/dL. Labs without a unit are taken to be in the table's unit.
+#
+#   Every outcome is a logistic score, so the whole batch is one matrix
+#   product:  P = sigmoid(Z @ W + b)   — thousands of patients per call.
+#   "overall" is the chance of at least one outcome, 1 - Π(1 - p).
+#
+#   The artifact (knowledge/risk_model.json) is loaded on first use. serve.py
+#   warms it in the gunicorn master before forking, so every worker shares
+#   the same arrays copy-on-write.
+#
+# ENVIRONMENT:
+#   RISK_MODEL_FILE        path to the artifact (default knowledge/risk_model.json)
+#   RISK_CLASSIFY_THRESHOLD  probability above which classify names a condition (0.5)
+# ─────────────────────────────────────────────────────────────────────────────
+
+RISK_MODEL_FILE = os.getenv(
+    "RISK_MODEL_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge", "risk_model.json"))
+CLASSIFY_THRESHOLD = float(os.getenv("RISK_CLASSIFY_THRESHOLD", "0.5"))
+
+Z_CLIP = 4.0
+# (analyte, unit) → (factor, offset) into the knowledge table's unit: x * factor + offset
+SI_CONVERSIONS = {
+    ("Glucose", "mmol/l"): (18.016, 0.0),
+    ("Total cholesterol", "mmol/l"): (38.67, 0.0),
+    ("LDL", "mmol/l"): (38.67, 0.0),
+    ("HDL", "mmol/l"): (38.67, 0.0),
+    ("Triglycerides", "mmol/l"): (88.57, 0.0),
+    ("Creatinine", "umol/l"): (1 / 88.42, 0.0),
+    ("Urea", "mmol/l"): (2.801, 0.0),            # urea mmol/L → BUN mg/dL
+    ("Bilirubin", "umol/l"): (1 / 17.1, 0.0),
+    ("Albumin", "g/l"): (0.1, 0.0),
+    ("Hemoglobin", "g/l"): (0.1, 0.0),
+    ("Hemoglobin", "mmol/l"): (1.611, 0.0),
+    ("HbA1c", "mmol/mol"): (0.0915, 2.15),       # IFCC → NGSP
+    ("TSH", "uiu/ml"): (1.0, 0.0),
+    ("TSH", "miu/ml"): (1000.0, 0.0),
+    ("ALT", "iu/l"): (1.0, 0.0),
+    ("AST", "iu/l"): (1.0, 0.0),
+}
+
+HISTORY_FLAGS = {
+    "diabetes_history": ("diabet",),
+    "hypertension_history": ("hypertens", "blood pressure"),
+    "heart_history": ("heart", "cardiac", "coronary"),
+}
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _unit_key(unit):
+    unit = " ".join(str(unit or "").split()).lower().replace(" ", "")
+    for a, b in (("μ", "u"), ("µ", "u"), ("mcg", "ug"), ("gm", "g"), ("²", "2")):
+        unit = unit.replace(a, b)
+    return unit
+
+
+def _in_table_unit(analyte, value, unit):
+    """value converted into the knowledge table's unit for analyte, NaN if that's not possible."""
+    value = _number(value)
+    unit = _unit_key(unit)
+    table_unit = _unit_key((knowledge_base.table.record(analyte) or {}).get("unit"))
+    if not unit or unit == table_unit:
+        return value
+    factor, offset = SI_CONVERSIONS.get((analyte, unit), (np.nan, 0.0))
+    return value * factor + offset
+
+
+def _labs(patient):
+    """
+    (test, value, unit) triples from any of:
+      "labs": [{"test": "HbA1c", "value": 6.2}, ...]   (structured_data)
+      "labs": {"HbA1c": 6.2, ...}
+      top-level keys, {"hba1c": 6.2, "glucose": 105, "age": 45}
+    Names the knowledge table doesn't know are ignored by featurize().
+    """
+    labs = patient.get("labs") or patient.get("structuredData") or []
+    if isinstance(labs, dict):
+        triples = [(test, value, None) for test, value in labs.items()]
+    else:
+        triples = [(item.get("test") or item.get("label"), item.get("value"), item.get("unit")) for item in labs]
+    return triples + [(key, value, None) for key, value in patient.items()
+                      if isinstance(value, (int, float, str))]
+
+
+class RiskModel:
+
+    def __init__(self, path=RISK_MODEL_FILE):
+        self.path = path
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._loaded:
+            return self
+        with self._lock:
+            if not self._loaded:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    artifact = json.load(f)
+                self.features = list(artifact["features"])
+                self.outcomes = list(artifact["outcomes"])
+                self.conditions = artifact.get("conditions", {})
+                self.version = artifact.get("version")
+                self._column = {name: i for i, name in enumerate(self.features)}
+                center_scale = np.array([artifact["features"][f] for f in self.features], dtype=np.float64)
+                self.center, self.scale = center_scale[:, 0], center_scale[:, 1]
+                self.weights = np.zeros((len(self.features), len(self.outcomes)))
+                self.intercepts = np.array([artifact["outcomes"][o]["intercept"] for o in self.outcomes])
+                for j, outcome in enumerate(self.outcomes):
+                    for feature, weight in artifact["outcomes"][outcome]["weights"].items():
+                        self.weights[self._column[feature], j] = weight
+                self._loaded = True
+        return self
+
+    # ── Feature matrix ───────────────────────────────────────────────────────
+    def featurize(self, patients):
+        """Patients (dicts) → raw feature matrix, NaN where a value is missing."""
+        self.load()
+        X = np.full((len(patients), len(self.features)), np.nan)
+        column = self._column
+        for i, patient in enumerate(patients):
+            row = X[i]
+            if "age" in column:
+                row[column["age"]] = _number(patient.get("age"))
+            if "male" in column:
+                sex = str(patient.get("sex") or patient.get("gender") or "").strip().lower()[:1]
+                row[column["male"]] = {"m": 1.0, "f": 0.0}.get(sex, np.nan)
+            condition = str(patient.get("condition") or "").lower()
+            for flag, needles in HISTORY_FLAGS.items():
+                if flag in column:
+                    row[column[flag]] = 1.0 if any(n in condition for n in needles) else 0.0
+            for test, value, unit in _labs(patient):
+                analyte = knowledge_base.canonical_name(test or "")
+                j = column.get(analyte)
+                if j is None:
+                    continue
+                value = _in_table_unit(analyte, value, unit)
+                if not np.isnan(value) or np.isnan(row[j]):   # an unconvertible unit never overwrites
+                    row[j] = value
+        return X
+
+    def _standardize(self, X):
+        Z = (X - self.center) / self.scale
+        return np.clip(np.nan_to_num(Z, nan=0.0), -Z_CLIP, Z_CLIP)
+
+    # ── Batch inference ──────────────────────────────────────────────────────
+    def predict_proba(self, patients):
+        """(n_patients × n_outcomes) probabilities in one vectorized pass."""
+        self.load()
+        if not patients:
+            return np.empty((0, len(self.outcomes)))
+        logits = self._standardize(self.featurize(patients)) @ self.weights + self.intercepts
+        return 1.0 / (1.0 + np.exp(-logits))
+
+    def assess(self, patients):
+        """Risk dicts in the /api/models/risk-assessment shape, one per patient."""
+        P = self.predict_proba(patients)
+        overall = 1.0 - np.prod(1.0 - P, axis=1)
+        P, overall = np.round(P, 3), np.round(overall, 3)
+        names = self.outcomes
+        return [dict(zip(names, row.tolist()), overall=float(total)) for row, total in zip(P, overall)]
+
+    def classify(self, patients):
+        """Most likely condition per patient (or none above the threshold)."""
+        P = self.predict_proba(patients)
+        if not len(P):
+            return []
+        best = np.argmax(P, axis=1)
+        best_p = P[np.arange(len(P)), best]
+        severity = np.where(best_p >= 0.8, "severe", np.where(best_p >= 0.65, "moderate", "mild"))
+        results = []
+        for j, p, sev in zip(best.tolist(), best_p.tolist(), severity.tolist()):
+            if p >= CLASSIFY_THRESHOLD:
+                outcome = self.outcomes[j]
+                results.append({"condition": self.conditions.get(outcome, outcome), "category": outcome,
+                                "confidence": round(p, 3), "severity": sev})
+            else:
+                results.append({"condition": "No significant condition detected", "category": None,
+                                "confidence": round(1.0 - p, 3), "severity": "none"})
+        return results
+
+
+model = RiskModel()
@@ -0,0 +1,134 @@
+import os
+import sys
+import time
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Production entry point — multi-worker serving instead of the debug server.
+#
+#   Development (unchanged):  python backend_server.py
+#       single process, Werkzeug reloader, opens the browser.
+#
+#   Production:               python serve.py
+#       Linux/macOS → gunicorn, WEB_WORKERS forked processes × WEB_THREADS
+#                     threads each (gthread worker, keep-alive). The app and
+#                     its heavy libraries are imported ONCE in the master
+#                     (preload) and shared copy-on-write by every worker.
+#       Windows / no gunicorn → waitress, one process × WEB_THREADS threads.
+#
+#   SIGTERM → workers stop accepting, finish in-flight requests for up to
+#   WEB_GRACEFUL_TIMEOUT seconds, flush pending record writes, then exit.
+#
+# ENVIRONMENT:
+#   PORT                  (default 5001)
+#   WEB_WORKERS           (default 2 × CPU + 1)
+#   WEB_THREADS           (default 4)
+#   WEB_TIMEOUT           request timeout in seconds (default 120 — Gemini is slow)
+#   WEB_GRACEFUL_TIMEOUT  (default 30)
+#   WEB_KEEPALIVE         keep-alive seconds (default 5)
+#   PREWARM               1 (default): import pdfplumber / Gemini SDK / NumPy and
+#                         load model files in the master before forking; 0: lazy
+#   RAG_SOCKET            when set, the embedding sidecar (embedding_service.py)
+#                         is started on this socket unless one is already
+#                         listening — one embedding model per node, not per worker
+# ─────────────────────────────────────────────────────────────────────────────
+
+PORT = int(os.environ.get('PORT', 5001))
+WORKERS = int(os.environ.get('WEB_WORKERS', (os.cpu_count() or 1) * 2 + 1))
+THREADS = int(os.environ.get('WEB_THREADS', 4))
+TIMEOUT = int(os.environ.get('WEB_TIMEOUT', 120))
+GRACEFUL_TIMEOUT = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+KEEPALIVE = int(os.environ.get('WEB_KEEPALIVE', 5))
+PREWARM = os.environ.get('PREWARM', '1') != '0'
+RAG_SOCKET = os.environ.get('RAG_SOCKET')
+SIDECAR_START_TIMEOUT = 120     # first start downloads/loads the embedding model
+
+
+def _worker_exit(server, worker):
+    # Don't lose analysis records still sitting in the write-behind queue.
+    from persistence import writer
+    writer.flush(GRACEFUL_TIMEOUT)
+
+
+def start_embedding_sidecar(socket_path):
+    """Start embedding_service.py unless something already answers on the socket."""
+    import socket
+    import atexit
+    import subprocess
+
+    def listening():
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.connect(socket_path)
+            return True
+        except OSError:
+            return False
+
+    if listening():
+        return None
+    here = os.path.dirname(os.path.abspath(__file__))
+    sidecar = subprocess.Popen([sys.executable, os.path.join(here, 'embedding_service.py'), socket_path])
+    atexit.register(sidecar.terminate)
+    deadline = time.monotonic() + SIDECAR_START_TIMEOUT
+    while not listening():
+        if sidecar.poll() is not None:
+            raise RuntimeError(f"embedding service exited with code {sidecar.returncode}")
+        if time.monotonic() > deadline:
+            break       # workers reconnect on their first query
+        time.sleep(0.2)
+    return sidecar
+
+
+def run_gunicorn(app):
+    from gunicorn.app.base import BaseApplication
+
+    class DrMedApplication(BaseApplication):
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+    options = {
+        'bind': f'0.0.0.0:{PORT}',
+        'workers': WORKERS,
+        'threads': THREADS,
+        'worker_class': 'gthread',
+        'timeout': TIMEOUT,
+        'graceful_timeout': GRACEFUL_TIMEOUT,
+        'keepalive': KEEPALIVE,
+        'preload_app': True,
+        'worker_exit': _worker_exit,
+    }
+    DrMedApplication(app, options).run()
+
+
+def run_waitress(app):
+    from waitress import serve
+    serve(app, host='0.0.0.0', port=PORT, threads=THREADS, channel_timeout=TIMEOUT)
+
+
+if __name__ == '__main__':
+    # Imported (and pre-warmed) here, before any fork, so models/libraries are loaded once.
+    from backend_server import app, warm_up
+    if PREWARM:
+        warm_up()
+    if RAG_SOCKET and sys.platform != 'win32':
+        start_embedding_sidecar(RAG_SOCKET)
+
+    try:
+        if sys.platform == 'win32':
+            raise ImportError("gunicorn does not run on Windows")
+        import gunicorn  # noqa: F401
+    except ImportError:
+        print(f"Dr.MeD production server (waitress): http://0.0.0.0:{PORT}  threads={THREADS}")
+        run_waitress(app)
+    else:
+        print(f"Dr.MeD production server (gunicorn): http://0.0.0.0:{PORT}  "
+              f"workers={WORKERS} threads={THREADS}")
+        run_gunicorn(app)
@@ -0,0 +1,94 @@
+import asyncio
+import threading
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Single-flight deduplication of identical in-flight work.
+#
+# HOW IT WORKS:
+#   The first caller for a key (the leader) runs the function; anyone asking
+#   for the same key while it is still running waits for, and receives, the
+#   leader's result (or exception) instead of starting a second computation.
+#   The key is forgotten as soon as the leader finishes, so this coalesces
+#   concurrent duplicates only — it is not a result cache.
+#
+#   Scope is one worker process (one event loop for the async variant).
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "followers")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._async_calls = {}   # (event loop, key) → asyncio.Future
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) once per key among concurrent callers.
+        Returns (result, shared) — shared is True for callers that attached
+        to someone else's run.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.followers += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    async def do_async(self, key, coro_fn, *args, **kwargs):
+        """Awaitable do(): coalesces coroutines running on the same event loop."""
+        loop_key = (asyncio.get_running_loop(), key)
+        future = self._async_calls.get(loop_key)
+        if future is not None:
+            # shield: a follower that disconnects must not cancel the leader's work
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._async_calls[loop_key] = future
+        try:
+            result = await coro_fn(*args, **kwargs)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()   # mark retrieved when there are no followers
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self._async_calls[loop_key]
+        return result, False
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls) + len(self._async_calls)
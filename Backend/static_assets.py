@@ -0,0 +1,113 @@
+import os
+import gzip
+import hashlib
+import threading
+from flask import Response, request
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Precompressed, revalidatable frontend pages.
+#
+# HOW IT WORKS:
+#   Each page (medical-ai.html, report-summary.html) is read once and kept in
+#   memory as identity, gzip and — when the optional `brotli` package is
+#   installed — brotli bodies, compressed at the highest level because it
+#   happens once per file, not per request. The strong ETag is a hash of the
+#   file bytes plus the encoding ("<sha>-br"), so a cache never mixes
+#   variants.
+#
+#   A request picks the best encoding the client accepts (br > gzip >
+#   identity) and gets a 304 with no body when its If-None-Match still
+#   matches. Cache-Control lets browsers reuse the page for STATIC_MAX_AGE
+#   and keep showing it (while revalidating in the background) for
+#   STATIC_STALE_SECONDS, so a repeat visit costs at most one tiny 304.
+#
+#   Files are stat()ed on every request (microseconds) and rebuilt when the
+#   mtime/size changes, so editing the HTML needs no server restart.
+#
+# ENVIRONMENT:
+#   STATIC_MAX_AGE         seconds a page is fresh in the browser (default 300)
+#   STATIC_STALE_SECONDS   stale-while-revalidate window (default 86400)
+# ─────────────────────────────────────────────────────────────────────────────
+
+MAX_AGE = int(os.getenv("STATIC_MAX_AGE", "300"))
+STALE_SECONDS = int(os.getenv("STATIC_STALE_SECONDS", "86400"))
+MIN_COMPRESS_BYTES = 1024     # below this, compression isn't worth a header
+
+try:
+    import brotli
+except ImportError:           # optional: gzip only
+    brotli = None
+
+MIMETYPES = {".html": "text/html; charset=utf-8", ".css": "text/css; charset=utf-8",
+             ".js": "text/javascript; charset=utf-8", ".json": "application/json",
+             ".svg": "image/svg+xml"}
+
+
+class _Asset:
+    """One file's bytes, its compressed variants and their ETags."""
+
+    def __init__(self, path):
+        stat = os.stat(path)
+        self.signature = (stat.st_mtime_ns, stat.st_size)
+        with open(path, "rb") as f:
+            body = f.read()
+        digest = hashlib.sha256(body).hexdigest()[:20]
+        self.content_type = MIMETYPES.get(os.path.splitext(path)[1].lower(), "application/octet-stream")
+        self.bodies = {"identity": body}
+        if len(body) >= MIN_COMPRESS_BYTES:
+            self.bodies["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.bodies["br"] = brotli.compress(body, quality=11)
+        self.etags = {encoding: f'"{digest}-{encoding}"' for encoding in self.bodies}
+        self.etags["identity"] = f'"{digest}"'
+
+
+class StaticAssets:
+    """Serves files from one folder with precompressed variants and ETags."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._assets = {}
+        self._lock = threading.Lock()
+
+    def _asset(self, name):
+        path = os.path.join(self.folder, name)
+        stat = os.stat(path)
+        asset = self._assets.get(name)
+        if asset is None or asset.signature != (stat.st_mtime_ns, stat.st_size):
+            with self._lock:
+                asset = self._assets.get(name)
+                if asset is None or asset.signature != (stat.st_mtime_ns, stat.st_size):
+                    asset = self._assets[name] = _Asset(path)
+        return asset
+
+    def preload(self, *names):
+        """Build the variants ahead of the first request (serve.py warm-up)."""
+        for name in names:
+            self._asset(name)
+
+    @staticmethod
+    def _encoding(asset):
+        accepted = request.accept_encodings
+        for encoding in ("br", "gzip"):
+            if encoding in asset.bodies and accepted.quality(encoding) > 0:
+                return encoding
+        return "identity"
+
+    def send(self, name):
+        """Response for GET/HEAD of `name`: 200 with the best encoding or 304."""
+        asset = self._asset(name)
+        encoding = self._encoding(asset)
+        etag = asset.etags[encoding]
+
+        if request.if_none_match.contains_weak(etag.strip('"')):
+            response = Response(status=304)
+        else:
+            response = Response(asset.bodies[encoding], content_type=asset.content_type)
+            if encoding != "identity":
+                response.headers["Content-Encoding"] = encoding
+        response.headers["ETag"] = etag
+        response.headers["Vary"] = "Accept-Encoding"
+        response.headers["Cache-Control"] = (
+            f"public, max-age={MAX_AGE}, stale-while-revalidate={STALE_SECONDS}")
+        return response
@@ -0,0 +1,388 @@
+import os
+import re
+import json
+import time
+import zlib
+import sqlite3
+import threading
+from datetime import datetime
+from log_setup import get_logger
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Storage lifecycle: retention, archival of analysis records, orphan cleanup.
+#
+# HOW IT WORKS:
+#   A background sweep (one per node — it starts inside an SQLite write lock
+#   and records its start time in the archive index, so a worker that finds
+#   the lock taken, or a sweep younger than LIFECYCLE_INTERVAL, skips its
+#   turn; only the winner goes on to the file scans) keeps the flat
+#   directories small:
+#
+#   1. Analysis records older than ARCHIVE_AFTER_DAYS move from
+#      data/analysis/<id>.json into append-only segment files under
+#      data/analysis/archive/. Each record is zlib-compressed on its own and
+#      appended to the current segment; the SQLite index maps analysisId →
+#      (segment, offset, length) and keeps patientId / date / summary, so the
+#      history API lists archived records without decompressing anything and
+#      a single record is one seek + read. A segment is closed at
+#      ARCHIVE_SEGMENT_MB. Records are indexed before the JSON is removed, so
+#      a crash leaves at worst a few unreferenced bytes, never a lost record.
+#
+#   2. Retention: upload files + metadata older than RETENTION_UPLOAD_DAYS,
+#      analysis records (live or archived) older than
+#      RETENTION_ANALYSIS_DAYS (0 = keep forever) and literacy variants older
+#      than RETENTION_VARIANT_DAYS are deleted. A segment is unlinked once
+#      none of its records is left in the index.
+#
+#   3. Orphans: uploads/<fileId>_* without data/uploads/<fileId>.json,
+#      metadata whose files are gone, blobs no upload links to any more
+#      (link count 1) and .part leftovers of aborted uploads. Everything
+#      younger than ORPHAN_GRACE_SECONDS is left alone — metadata is written
+#      behind, so a fresh upload can briefly look orphaned.
+#
+#   Directories are walked with os.scandir (one stat per entry, no glob).
+#
+# ENVIRONMENT:
+#   LIFECYCLE_INTERVAL        seconds between sweeps, 0 disables (default 3600)
+#   ARCHIVE_AFTER_DAYS        live analysis records older than this are archived (7)
+#   ARCHIVE_SEGMENT_MB        segment size before a new one is started (64)
+#   RETENTION_ANALYSIS_DAYS   delete analysis records older than this, 0 = never (0)
+#   RETENTION_UPLOAD_DAYS     delete uploaded reports older than this, 0 = never (90)
+#   RETENTION_VARIANT_DAYS    delete cached literacy variants older than this (30)
+#   ORPHAN_GRACE_SECONDS      minimum age before a file counts as orphaned (3600)
+# ─────────────────────────────────────────────────────────────────────────────
+
+logger = get_logger("lifecycle")
+
+INTERVAL = float(os.getenv("LIFECYCLE_INTERVAL", "3600"))
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "7"))
+SEGMENT_BYTES = int(float(os.getenv("ARCHIVE_SEGMENT_MB", "64")) * 1024 * 1024)
+RETENTION_ANALYSIS_DAYS = float(os.getenv("RETENTION_ANALYSIS_DAYS", "0"))
+RETENTION_UPLOAD_DAYS = float(os.getenv("RETENTION_UPLOAD_DAYS", "90"))
+RETENTION_VARIANT_DAYS = float(os.getenv("RETENTION_VARIANT_DAYS", "30"))
+ORPHAN_GRACE_SECONDS = float(os.getenv("ORPHAN_GRACE_SECONDS", "3600"))
+
+ARCHIVE_BATCH = 500           # records per segment write/fsync
+DAY = 86400
+# generate_file_id(): report_<hex>_<unix ts>; files are <fileId>_report_<name> etc.
+_FILE_ID = re.compile(r"^(report_[0-9a-f]+_\d+)_")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    analysis_id TEXT PRIMARY KEY, patient_id TEXT, ts TEXT NOT NULL,
+    summary TEXT, segment TEXT NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS records_patient ON records (patient_id, ts);
+CREATE INDEX IF NOT EXISTS records_segment ON records (segment);
+CREATE TABLE IF NOT EXISTS sweeps (id INTEGER PRIMARY KEY CHECK (id = 1), started REAL NOT NULL);
+"""
+
+
+def history_entry(record):
+    """The /api/patient/history item for one analysis record."""
+    return {
+        "date": record['timestamp'].split('T')[0],
+        "reportType": "Medical Report",
+        "analysisId": record['analysisId'],
+        "summary": record['result'].get('analysis', '')[:100] + "...",
+    }
+
+
+def _older_than(entry, days, now):
+    return days > 0 and now - entry.stat().st_mtime > days * DAY
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return 1
+    except FileNotFoundError:
+        return 0
+
+
+def _file_id(name, known_ids):
+    """fileId an uploads/ file belongs to, or None for files we didn't write."""
+    match = _FILE_ID.match(name)
+    if match:
+        return match.group(1)
+    for file_id in known_ids:      # ids of another shape: match by metadata prefix
+        if name.startswith(file_id + "_"):
+            return file_id
+    return None
+
+
+def _json_files(folder):
+    try:
+        with os.scandir(folder) as entries:
+            return [e for e in entries if e.is_file() and e.name.endswith(".json")]
+    except FileNotFoundError:
+        return []
+
+
+class RecordArchive:
+    """Compressed, append-only segments of analysis records + an SQLite offset index."""
+
+    def __init__(self, analysis_folder, segment_bytes=SEGMENT_BYTES):
+        self.folder = os.path.join(analysis_folder, "archive")
+        self.segment_bytes = segment_bytes
+        self._local = threading.local()
+
+    def _conn(self):
+        # One connection per thread and per process (never shared across fork).
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(self.folder, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.folder, "index.sqlite3"), timeout=10,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    # ── Reads ────────────────────────────────────────────────────────────────
+    def load(self, analysis_id):
+        """The archived record, or None."""
+        row = self._conn().execute("SELECT segment, offset, length FROM records WHERE analysis_id = ?",
+                                   (analysis_id,)).fetchone()
+        if row is None:
+            return None
+        segment, offset, length = row
+        try:
+            with open(os.path.join(self.folder, segment), "rb") as f:
+                f.seek(offset)
+                return json.loads(zlib.decompress(f.read(length)))
+        except (OSError, ValueError, zlib.error):
+            logger.warning("Unreadable archived record", extra={"analysisId": analysis_id, "segment": segment})
+            return None
+
+    def history(self, patient_id=None):
+        """History entries from the index alone (no segment reads)."""
+        query = "SELECT analysis_id, ts, summary FROM records"
+        params = ()
+        if patient_id:
+            query += " WHERE patient_id = ?"
+            params = (patient_id,)
+        return [{"date": ts.split('T')[0], "reportType": "Medical Report", "analysisId": analysis_id,
+                 "summary": summary}
+                for analysis_id, ts, summary in self._conn().execute(query, params)]
+
+    # ── Writes (called by the lifecycle sweep, inside its lock) ─────────────
+    def _current_segment(self, conn):
+        row = conn.execute("SELECT segment FROM records ORDER BY segment DESC LIMIT 1").fetchone()
+        name = row[0] if row else "segment-000001.z"
+        path = os.path.join(self.folder, name)
+        if os.path.exists(path) and os.path.getsize(path) >= self.segment_bytes:
+            name = f"segment-{int(name[8:14]) + 1:06d}.z"
+        return name
+
+    def append(self, conn, entries):
+        """Append live record files to the current segment; returns the paths now indexed."""
+        segment = self._current_segment(conn)
+        moved = []
+        out = open(os.path.join(self.folder, segment), "ab")
+        try:
+            for entry in entries:
+                try:
+                    with open(entry.path, "rb") as f:
+                        raw = f.read()
+                    record = json.loads(raw)
+                    summary = history_entry(record)["summary"]
+                except (OSError, ValueError, KeyError, AttributeError):
+                    continue        # half-written or foreign file: leave it
+                blob = zlib.compress(raw, 9)
+                offset = out.seek(0, os.SEEK_END)
+                out.write(blob)
+                conn.execute("INSERT OR IGNORE INTO records VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (record['analysisId'], record.get('patientId'), record['timestamp'],
+                              summary, segment, offset, len(blob)))
+                moved.append(entry.path)
+                if out.tell() >= self.segment_bytes:
+                    out.close()
+                    segment = f"segment-{int(segment[8:14]) + 1:06d}.z"
+                    out = open(os.path.join(self.folder, segment), "ab")
+            out.flush()
+            os.fsync(out.fileno())
+        finally:
+            out.close()
+        return moved
+
+    def expire(self, conn, before_ts):
+        """Drop index entries older than before_ts and unlink segments left empty."""
+        segments = [row[0] for row in conn.execute("SELECT DISTINCT segment FROM records WHERE ts < ?",
+                                                   (before_ts,))]
+        deleted = conn.execute("DELETE FROM records WHERE ts < ?", (before_ts,)).rowcount
+        live = {row[0] for row in conn.execute("SELECT DISTINCT segment FROM records")}
+        return deleted, [s for s in segments if s not in live]
+
+
+class LifecycleManager:
+    """Periodic retention / archival / orphan sweep for one data directory."""
+
+    def __init__(self, upload_folder, data_folder, blob_folder, interval=INTERVAL):
+        self.upload_folder = upload_folder
+        self.metadata_folder = os.path.join(data_folder, "uploads")
+        self.analysis_folder = os.path.join(data_folder, "analysis")
+        self.variant_folder = os.path.join(self.analysis_folder, "personalized")
+        self.blob_folder = blob_folder
+        self.interval = interval
+        self.archive = RecordArchive(self.analysis_folder)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # ── Background thread ────────────────────────────────────────────────────
+    def ensure_started(self):
+        # Started lazily so forked server workers each get their own thread.
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="storage-lifecycle", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.warning("Storage sweep failed", extra={"error": str(e)})
+            time.sleep(self.interval)
+
+    # ── Reads used by the API ────────────────────────────────────────────────
+    def load_record(self, analysis_id):
+        """Live record file first, then the archive."""
+        path = os.path.join(self.analysis_folder, f"{os.path.basename(analysis_id)}.json")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return self.archive.load(analysis_id)
+
+    def history(self, patient_id=None):
+        """History entries for live and archived records (newest first)."""
+        history = {}
+        for entry in _json_files(self.analysis_folder):
+            try:
+                with open(entry.path, "r", encoding="utf-8") as f:
+                    record = json.load(f)
+                if patient_id and record.get('patientId') != patient_id:
+                    continue
+                history[record['analysisId']] = history_entry(record)
+            except (OSError, ValueError, KeyError, AttributeError):
+                continue
+        for item in self.archive.history(patient_id):
+            history.setdefault(item["analysisId"], item)
+        return sorted(history.values(), key=lambda x: x['date'], reverse=True)
+
+    # ── Sweep ────────────────────────────────────────────────────────────────
+    def sweep(self, now=None, force=False):
+        """
+        One lifecycle pass. Returns counts, or None if another worker holds the
+        lock or already swept within the interval (force=True ignores the latter).
+        """
+        now = now or time.time()
+        conn = self.archive._conn()
+        try:
+            conn.execute("PRAGMA busy_timeout = 0")
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            return None         # another worker is sweeping
+        finally:
+            conn.execute("PRAGMA busy_timeout = 10000")
+        started = time.perf_counter()
+        try:
+            row = conn.execute("SELECT started FROM sweeps WHERE id = 1").fetchone()
+            if not force and row and now - row[0] < self.interval:
+                conn.execute("ROLLBACK")
+                return None     # another worker swept this interval
+            # Claim the interval before the lock is released, so the file scans
+            # below (after COMMIT) run in this worker only
+            conn.execute("INSERT OR REPLACE INTO sweeps VALUES (1, ?)", (now,))
+            moved = self._archive_records(conn, now)
+            report = self._expire_records(conn, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        # Only now that the index is committed may the live copies go away
+        report["archived"] = sum(_remove(path) for path in moved)
+        report["variantsDeleted"] = self._expire_variants(now)
+        report.update(self._expire_uploads(now))
+        report["durationMs"] = round((time.perf_counter() - started) * 1000, 1)
+        if any(v for k, v in report.items() if k != "durationMs"):
+            logger.info("Storage sweep", extra=report)
+        return report
+
+    def _archive_records(self, conn, now):
+        """Append old live records to the archive; returns the files to remove after COMMIT."""
+        if ARCHIVE_AFTER_DAYS <= 0:
+            return []
+        old = [e for e in _json_files(self.analysis_folder) if _older_than(e, ARCHIVE_AFTER_DAYS, now)]
+        old.sort(key=lambda e: e.stat().st_mtime)     # segments stay in time order → expire whole
+        moved = []
+        for i in range(0, len(old), ARCHIVE_BATCH):
+            moved += self.archive.append(conn, old[i:i + ARCHIVE_BATCH])
+        return moved
+
+    def _expire_records(self, conn, now):
+        if RETENTION_ANALYSIS_DAYS <= 0:
+            return {"recordsDeleted": 0, "segmentsDeleted": 0}
+        deleted = sum(_remove(e.path) for e in _json_files(self.analysis_folder)
+                      if _older_than(e, RETENTION_ANALYSIS_DAYS, now))
+        cutoff = datetime.fromtimestamp(now - RETENTION_ANALYSIS_DAYS * DAY).isoformat()
+        archived, empty_segments = self.archive.expire(conn, cutoff)
+        for segment in empty_segments:
+            _remove(os.path.join(self.archive.folder, segment))
+        return {"recordsDeleted": deleted + archived, "segmentsDeleted": len(empty_segments)}
+
+    def _expire_variants(self, now):
+        if RETENTION_VARIANT_DAYS <= 0:
+            return 0
+        return sum(_remove(e.path) for e in _json_files(self.variant_folder)
+                   if _older_than(e, RETENTION_VARIANT_DAYS, now))
+
+    def _expire_uploads(self, now):
+        grace = ORPHAN_GRACE_SECONDS / DAY
+        report = {"uploadsDeleted": 0, "orphansDeleted": 0, "blobsDeleted": 0}
+
+        metadata = {e.name[:-len(".json")]: e for e in _json_files(self.metadata_folder)}
+        files = {}          # fileId → [DirEntry]
+        try:
+            with os.scandir(self.upload_folder) as entries:
+                for entry in entries:
+                    file_id = _file_id(entry.name, metadata) if entry.is_file() else None
+                    if file_id:
+                        files.setdefault(file_id, []).append(entry)
+        except FileNotFoundError:
+            pass
+
+        for file_id, entries in files.items():
+            expired = file_id in metadata and _older_than(metadata[file_id], RETENTION_UPLOAD_DAYS, now)
+            orphaned = file_id not in metadata and all(_older_than(e, grace, now) for e in entries)
+            if expired or orphaned:
+                removed = sum(_remove(e.path) for e in entries)
+                report["uploadsDeleted" if expired else "orphansDeleted"] += removed
+                if expired:
+                    _remove(metadata[file_id].path)
+
+        for file_id, entry in metadata.items():
+            if file_id not in files and _older_than(entry, grace, now):
+                report["orphansDeleted"] += _remove(entry.path)
+
+        # Blobs are hardlinked into uploads/; link count 1 → nothing references them
+        try:
+            with os.scandir(self.blob_folder) as entries:
+                for entry in entries:
+                    if not entry.is_file() or not _older_than(entry, grace, now):
+                        continue
+                    # os.stat, not entry.stat(): DirEntry has no link count on Windows
+                    if entry.name.endswith(".part") or os.stat(entry.path).st_nlink <= 1:
+                        report["blobsDeleted"] += _remove(entry.path)
+        except FileNotFoundError:
+            pass
+        return report
+
+
+if __name__ == "__main__":
+    # One sweep from the command line / cron:  cd Backend && python storage_lifecycle.py
+    manager = LifecycleManager("uploads", "data", os.path.join("uploads", "blobs"))
+    print(json.dumps(manager.sweep(force=True), indent=2))
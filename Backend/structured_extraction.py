@@ -27,4 +27,25 @@ def extract_lab_values(text):
             "status": status
         })
     
-    return results
\ No newline at end of file
+    return results
+
+def extract_lab_values_incremental(chunks):
+    """
+    extract_lab_values() over a stream of chunks (e.g. PDF pages) without
+    ever holding the whole text: each chunk is scanned up to its last newline
+    and the unfinished last line is carried into the next, so a lab row split
+    across two chunks is still found.
+    """
+    results = []
+    carry = ""
+    for chunk in chunks:
+        text = carry + chunk
+        cut = text.rfind("\n")
+        if cut == -1:
+            carry = text
+            continue
+        results.extend(extract_lab_values(text[:cut + 1]))
+        carry = text[cut + 1:]
+    if carry:
+        results.extend(extract_lab_values(carry))
+    return results
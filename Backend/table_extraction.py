@@ -0,0 +1,346 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from persistence import save_json
+from log_setup import get_logger
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Table-aware lab value extraction from pdfplumber pages.
+#
+# HOW IT WORKS:
+#   Almost every lab report is a table: Test | Result | Unit | Reference range.
+#   Instead of running a regex over flattened text (which loses the columns),
+#   we locate the header row from word coordinates, remember where each column
+#   starts on the x axis, and read every line below it column by column. A
+#   word belongs to the column whose header is nearest: the boundary between
+#   two columns is the midpoint between their header positions, so values in
+#   right-aligned or centered columns that start left of their header still
+#   land in the right cell. Words at the start of a line that contain no digit
+#   stay in the test column up to the next header (long test names).
+#   Ruled tables that pdfplumber detects itself (extract_tables) are handled
+#   the same way by column index.
+#
+#   Table lines that contain a number but don't parse as a row are handed
+#   back (extract_page → unparsed text) so the caller's regex pass still sees
+#   them — a value is never lost just because its page had a table.
+#
+#   The column layout ("template") is cached per lab vendor. The vendor is
+#   fingerprinted from the letterhead at the top of the first page (name,
+#   address, …) with digits removed, so repeat reports from the same lab skip
+#   layout detection and go straight to column slicing — below the page's
+#   header row when it has one, otherwise (continuation pages) the whole
+#   page. Only lines
+#   above the first patient label (Patient / Name / Age / Ref. by …) count —
+#   otherwise every patient would be a "vendor" of their own. A report that
+#   starts with patient details has no fingerprint and always runs detection.
+#   At most LAB_TEMPLATE_MAX layouts are kept; the least recently learned
+#   ones are dropped first.
+#
+#   Pages where no table layout is found return (None, None) and the caller
+#   falls back to the regex extractor.
+#
+# ENVIRONMENT:
+#   LAB_TEMPLATE_FILE   learned layouts (default data/lab_templates.json)
+#   LAB_TEMPLATE_MAX    vendors remembered (default 200)
+# ─────────────────────────────────────────────────────────────────────────────
+
+logger = get_logger("tables")
+
+TEMPLATE_FILE = os.getenv("LAB_TEMPLATE_FILE", os.path.join("data", "lab_templates.json"))
+TEMPLATE_MAX = int(os.getenv("LAB_TEMPLATE_MAX", "200"))
+FINGERPRINT_LINES = 6      # top lines of page 1 that identify the vendor
+LINE_TOLERANCE = 3         # points; words closer than this vertically share a line
+COLUMN_SLACK = 2           # points a test-name word may reach left of the next header
+
+HEADER_WORDS = {
+    "test": {"test", "tests", "investigation", "investigations", "parameter", "parameters",
+             "analyte", "description", "examination"},
+    "value": {"result", "results", "value", "observed", "observation"},
+    "unit": {"unit", "units", "uom"},
+    "range": {"reference", "ref", "range", "normal", "biological", "interval", "limits"},
+}
+_HEADER_LOOKUP = {word: column for column, words in HEADER_WORDS.items() for word in words}
+# Where the letterhead ends and the patient block begins
+_PATIENT_LABEL = re.compile(
+    r"\b(?:patient|name|age|sex|gender|dob|d\.o\.b|ref(?:erred)?|referring|consultant|uhid|mrn"
+    r"|reg(?:istration)?|lab\s*no|sample|collected|received|reported)\b", re.I)
+
+_NUMBER = re.compile(r"[-+]?\d+(?:\.\d+)?")
+_RANGE_PAIR = re.compile(r"(\d+(?:\.\d+)?)\s*(?:-|–|to)\s*(\d+(?:\.\d+)?)")
+_RANGE_UPPER = re.compile(r"^(?:<|≤|<=|upto|up to|below)\s*(\d+(?:\.\d+)?)", re.I)
+_RANGE_LOWER = re.compile(r"^(?:>|≥|>=|above)\s*(\d+(?:\.\d+)?)", re.I)
+
+
+# ── Template cache (per vendor fingerprint) ──────────────────────────────────
+class TemplateCache:
+    """Vendor fingerprint → column layout, persisted (write-behind) across restarts."""
+
+    def __init__(self, path=TEMPLATE_FILE, max_templates=TEMPLATE_MAX):
+        self.path = path
+        self.max_templates = max_templates
+        self._templates = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._templates is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._templates = json.load(f)
+            except (OSError, ValueError):
+                self._templates = {}
+            self._trim()
+        return self._templates
+
+    def _trim(self):
+        # dicts keep insertion order: the oldest layouts go first
+        for key in list(self._templates)[:max(0, len(self._templates) - self.max_templates)]:
+            del self._templates[key]
+
+    def get(self, fingerprint):
+        with self._lock:
+            return self._load().get(fingerprint)
+
+    def put(self, fingerprint, template):
+        with self._lock:
+            templates = self._load()
+            templates.pop(fingerprint, None)
+            templates[fingerprint] = template
+            self._trim()
+            snapshot = dict(templates)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        save_json(self.path, snapshot)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._load())
+
+
+templates = TemplateCache()
+
+
+def fingerprint(page_text):
+    """Vendor identity from the letterhead of the first page: letters only, case-folded."""
+    lines = []
+    for line in (page_text or "").splitlines():
+        if _PATIENT_LABEL.search(line) or len(lines) == FINGERPRINT_LINES:
+            break
+        if line.strip():
+            lines.append(line)
+    normalized = re.sub(r"[^a-z]+", " ", " ".join(lines).lower()).strip()
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:16] if normalized else None
+
+
+# ── Cell parsing ─────────────────────────────────────────────────────────────
+def _parse_value(cell):
+    match = _NUMBER.search((cell or "").replace(",", ""))
+    return float(match.group()) if match else None
+
+
+def _parse_range(cell):
+    """'13.0-17.0' / '< 5.7' / '> 60' → (low, high, display) or None."""
+    cell = (cell or "").replace(",", "").strip()
+    match = _RANGE_PAIR.search(cell)
+    if match:
+        low, high = float(match.group(1)), float(match.group(2))
+        return low, high, f"{low}-{high}"
+    match = _RANGE_UPPER.match(cell)
+    if match:
+        high = float(match.group(1))
+        return None, high, f"<{high}"
+    match = _RANGE_LOWER.match(cell)
+    if match:
+        low = float(match.group(1))
+        return low, None, f">{low}"
+    return None
+
+
+def _make_row(test, value_cell, range_cell, unit=""):
+    """Same shape as extract_lab_values() items, plus the unit column."""
+    test = (test or "").strip()
+    value = _parse_value(value_cell)
+    parsed = _parse_range(range_cell)
+    if not test or value is None or parsed is None or _HEADER_LOOKUP.get(test.lower().split()[0]):
+        return None
+    low, high, display = parsed
+    if low is not None and value < low:
+        status = "Low"
+    elif high is not None and value > high:
+        status = "High"
+    else:
+        status = "Normal"
+    return {"test": test, "value": value, "range": display, "status": status, "unit": (unit or "").strip()}
+
+
+# ── Word-coordinate layouts ──────────────────────────────────────────────────
+def _group_lines(words):
+    lines = []
+    for word in sorted(words, key=lambda w: (round(w["top"]), w["x0"])):
+        if lines and abs(word["top"] - lines[-1][0]["top"]) <= LINE_TOLERANCE:
+            lines[-1].append(word)
+        else:
+            lines.append([word])
+    return [sorted(line, key=lambda w: w["x0"]) for line in lines]
+
+
+def _header_columns(line):
+    """Column name → x0 if this line looks like a table header, else None."""
+    columns = {}
+    for word in line:
+        column = _HEADER_LOOKUP.get(re.sub(r"[^a-z]", "", word["text"].lower()))
+        if column and column not in columns:
+            columns[column] = word["x0"]
+    if "test" in columns and "value" in columns and ("range" in columns or "unit" in columns):
+        return columns
+    return None
+
+
+def _find_header(lines):
+    """(index, columns) of the first header line, or None."""
+    for i, line in enumerate(lines):
+        columns = _header_columns(line)
+        if columns:
+            return i, columns
+    return None
+
+
+def _split_line(line, columns):
+    """Assign each word to the column whose header x is nearest (midpoint boundaries)."""
+    ordered = sorted(columns.items(), key=lambda c: c[1])
+    names = [name for name, _ in ordered]
+    bounds = [(a[1] + b[1]) / 2 for a, b in zip(ordered, ordered[1:])]
+    test_stop = columns.get("test")
+    if test_stop is not None and names.index("test") + 1 < len(names):
+        test_stop = ordered[names.index("test") + 1][1] - COLUMN_SLACK
+    cells = {name: [] for name in names}
+    leading = True
+    for word in line:
+        text = word["text"]
+        if leading and test_stop is not None and word["x0"] < test_stop and not any(c.isdigit() for c in text):
+            cells["test"].append(text)
+            continue
+        leading = False
+        name = names[sum(1 for bound in bounds if word["x0"] >= bound)]
+        cells[name].append(text)
+    return {name: " ".join(parts) for name, parts in cells.items()}
+
+
+def _line_text(line):
+    return " ".join(word["text"] for word in line)
+
+
+def _rows_from_words(lines, columns):
+    """(rows, unparsed lines) — unparsed: lines with a number that didn't make a row."""
+    rows, unparsed = [], []
+    for line in lines:
+        cells = _split_line(line, columns)
+        row = _make_row(cells.get("test"), cells.get("value"), cells.get("range"), cells.get("unit", ""))
+        if row:
+            rows.append(row)
+        elif any(c.isdigit() for c in _line_text(line)):
+            unparsed.append(_line_text(line))
+    return rows, unparsed
+
+
+# ── Ruled tables (pdfplumber.extract_tables) ─────────────────────────────────
+def _table_header_indices(row):
+    indices = {}
+    for i, cell in enumerate(row):
+        words = re.sub(r"[^a-z ]", "", (cell or "").lower()).split()
+        column = next((_HEADER_LOOKUP[w] for w in words if w in _HEADER_LOOKUP), None)
+        if column and column not in indices:
+            indices[column] = i
+    if "test" in indices and "value" in indices and ("range" in indices or "unit" in indices):
+        return indices
+    return None
+
+
+def _rows_from_table(table, indices):
+    def cell(row, name):
+        i = indices.get(name)
+        return row[i] if i is not None and i < len(row) else ""
+
+    rows, unparsed = [], []
+    for raw in table:
+        row = _make_row(cell(raw, "test"), cell(raw, "value"), cell(raw, "range"), cell(raw, "unit"))
+        if row:
+            rows.append(row)
+        else:
+            text = " ".join(c for c in raw if c)
+            if any(c.isdigit() for c in text):
+                unparsed.append(text)
+    return rows, unparsed
+
+
+# ── Per-document extractor ───────────────────────────────────────────────────
+class TableLabExtractor:
+    """
+    Feed it the pages of ONE document in order. The first page's text picks
+    the vendor fingerprint; a cached template is reused for every page.
+    """
+
+    def __init__(self, cache=templates):
+        self.cache = cache
+        self.fingerprint = None
+        self.template = None
+
+    def extract_page(self, page, page_text):
+        """
+        (lab rows read from this page's table, text of the table lines that
+        didn't parse — for the regex pass), or (None, None) if the page has
+        no usable table.
+        """
+        if self.fingerprint is None:
+            self.fingerprint = fingerprint(page_text) or ""
+            self.template = self.cache.get(self.fingerprint) if self.fingerprint else None
+
+        try:
+            # Fast path: known vendor layout → slice columns below the header
+            if self.template and self.template["kind"] == "words":
+                lines = _group_lines(page.extract_words())
+                header = _find_header(lines)
+                body = lines[header[0] + 1:] if header else lines
+                rows, unparsed = _rows_from_words(body, header[1] if header else self.template["columns"])
+                if rows:
+                    return rows, "\n".join(unparsed)
+            if self.template and self.template["kind"] == "table":
+                rows, unparsed = [], []
+                for table in page.extract_tables():
+                    table_rows, table_unparsed = _rows_from_table(table, self.template["indices"])
+                    rows += table_rows
+                    unparsed += table_unparsed
+                if rows:
+                    return rows, "\n".join(unparsed)
+
+            return self._detect(page)
+        except Exception as e:
+            logger.warning("Table extraction failed", extra={"error": str(e)})
+            return None, None
+
+    def _detect(self, page):
+        lines = _group_lines(page.extract_words())
+        for i, line in enumerate(lines):
+            columns = _header_columns(line)
+            if columns:
+                rows, unparsed = _rows_from_words(lines[i + 1:], columns)
+                if rows:
+                    self._remember({"kind": "words", "columns": columns})
+                    return rows, "\n".join(unparsed)
+
+        for table in page.extract_tables():
+            for i, row in enumerate(table):
+                indices = _table_header_indices(row)
+                if indices:
+                    rows, unparsed = _rows_from_table(table[i + 1:], indices)
+                    if rows:
+                        self._remember({"kind": "table", "indices": indices})
+                        return rows, "\n".join(unparsed)
+        return None, None
+
+    def _remember(self, template):
+        if self.fingerprint and template != self.template:
+            self.template = template
+            self.cache.put(self.fingerprint, template)
+            logger.info("Learned lab report layout", extra={"fingerprint": self.fingerprint,
+                                                            "kind": template["kind"]})
@@ -0,0 +1,81 @@
+"""
+Lifecycle sweep over uploads named the way /api/upload names them.
+
+    cd Backend && python -m pytest tests
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage_lifecycle  # noqa: E402
+from storage_lifecycle import LifecycleManager  # noqa: E402
+
+DAY = storage_lifecycle.DAY
+
+
+def _touch(path, age, data=b"x", now=None):
+    with open(path, "wb") as f:
+        f.write(data)
+    mtime = (now or time.time()) - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def _upload(tmp_path, file_id, age, with_metadata=True):
+    uploads, blobs = tmp_path / "uploads", tmp_path / "uploads" / "blobs"
+    metadata = tmp_path / "data" / "uploads"
+    for folder in (uploads, blobs, metadata):
+        folder.mkdir(parents=True, exist_ok=True)
+    blob = _touch(blobs / f"{file_id}-sha", age)
+    report = uploads / f"{file_id}_report_lab.pdf"
+    os.link(blob, report)
+    if with_metadata:
+        _touch(metadata / f"{file_id}.json", age, b"{}")
+    return report
+
+
+def _manager(tmp_path):
+    return LifecycleManager(str(tmp_path / "uploads"), str(tmp_path / "data"),
+                            str(tmp_path / "uploads" / "blobs"), interval=0)
+
+
+def test_sweep_keeps_uploads_with_metadata(tmp_path):
+    report = _upload(tmp_path, "report_1a2b3c4d_1700000000", age=2 * 3600)
+
+    result = _manager(tmp_path).sweep()
+
+    assert result["orphansDeleted"] == 0 and result["uploadsDeleted"] == 0 and result["blobsDeleted"] == 0
+    assert report.exists()
+    assert (tmp_path / "data" / "uploads" / "report_1a2b3c4d_1700000000.json").exists()
+
+
+def test_sweep_applies_upload_retention_and_orphans(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage_lifecycle, "RETENTION_UPLOAD_DAYS", 90)
+    kept = _upload(tmp_path, "report_00000001_1700000000", age=10 * DAY)
+    expired = _upload(tmp_path, "report_00000002_1700000000", age=91 * DAY)
+    orphan = _upload(tmp_path, "report_00000003_1700000000", age=2 * 3600, with_metadata=False)
+    fresh_orphan = _upload(tmp_path, "report_00000004_1700000000", age=60, with_metadata=False)
+
+    result = _manager(tmp_path).sweep()
+
+    assert kept.exists() and fresh_orphan.exists()
+    assert not expired.exists() and not orphan.exists()
+    assert not (tmp_path / "data" / "uploads" / "report_00000002_1700000000.json").exists()
+    assert result["uploadsDeleted"] == 1 and result["orphansDeleted"] == 1
+    # the two blobs nothing links to any more
+    assert result["blobsDeleted"] == 2
+
+
+def test_one_sweep_per_interval_across_workers(tmp_path):
+    _upload(tmp_path, "report_00000005_1700000000", age=60)
+    first = LifecycleManager(str(tmp_path / "uploads"), str(tmp_path / "data"),
+                             str(tmp_path / "uploads" / "blobs"), interval=3600)
+    second = LifecycleManager(str(tmp_path / "uploads"), str(tmp_path / "data"),
+                              str(tmp_path / "uploads" / "blobs"), interval=3600)
+
+    assert first.sweep() is not None
+    assert second.sweep() is None                   # swept this interval already
+    assert second.sweep(now=time.time() + 3601) is not None
+    assert first.sweep(force=True) is not None
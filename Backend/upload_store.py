@@ -0,0 +1,117 @@
+import os
+import shutil
+import hashlib
+import tempfile
+from flask import Request, current_app
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Streaming, content-addressed upload storage.
+#
+# HOW IT WORKS:
+#   Werkzeug's multipart parser asks the Request for a file object per upload
+#   part and writes the body into it chunk by chunk. StreamingUploadRequest
+#   hands it a HashingFileStream instead of a spooled temp file, so each chunk
+#   goes straight to disk (under BLOB_FOLDER) while SHA-256 is updated —
+#   memory stays flat no matter how large the upload is.
+#
+#   commit(dest_path) then stores the bytes once as BLOB_FOLDER/<sha256> and
+#   hardlinks dest_path (uploads/<fileId>_report_x.pdf) to it. Uploading the
+#   same file again costs no extra disk, and the hash is available to
+#   downstream caches immediately.
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+def _link(blob_path, dest_path):
+    try:
+        os.link(blob_path, dest_path)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        # Filesystem without hardlinks (or blob dir on another volume)
+        shutil.copyfile(blob_path, dest_path)
+
+
+class HashingFileStream:
+    """Writable temp file that hashes everything written to it."""
+
+    def __init__(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        fd, self.tmp_path = tempfile.mkstemp(dir=folder, suffix='.part')
+        self._file = os.fdopen(fd, 'w+b')
+        self._sha256 = hashlib.sha256()
+        self.size = 0
+        self.committed = False
+
+    def write(self, chunk):
+        self._sha256.update(chunk)
+        self.size += len(chunk)
+        return self._file.write(chunk)
+
+    def __getattr__(self, name):
+        # seek/read/tell/flush … go to the underlying file
+        return getattr(self._file, name)
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+    def commit(self, dest_path):
+        """
+        Move the bytes into the blob store (once per distinct content) and
+        hardlink dest_path to the blob. Returns {"sha256", "size", "deduplicated"}.
+        """
+        self._file.close()
+        digest = self.hexdigest()
+        blob_path = os.path.join(self.folder, digest)
+
+        deduplicated = os.path.exists(blob_path)
+        if not deduplicated:
+            os.replace(self.tmp_path, blob_path)
+        try:
+            _link(blob_path, dest_path)
+        except FileNotFoundError:
+            if not deduplicated:
+                raise
+            # The lifecycle sweep removed the unreferenced blob after exists():
+            # our .part still holds the same bytes, so it becomes the blob.
+            os.replace(self.tmp_path, blob_path)
+            deduplicated = False
+            _link(blob_path, dest_path)
+        if deduplicated:
+            os.remove(self.tmp_path)
+
+        self.committed = True
+        return {"sha256": digest, "size": self.size, "deduplicated": deduplicated}
+
+    def close(self):
+        # Parts that were never committed (rejected extension, aborted request)
+        # must not leave .part files behind.
+        self._file.close()
+        if not self.committed and os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class StreamingUploadRequest(Request):
+    """Flask Request whose uploaded files stream to disk through HashingFileStream."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingFileStream(current_app.config['BLOB_FOLDER'])
+
+
+def save_upload(file, dest_path):
+    """
+    Persist a FileStorage to dest_path. Uses the streamed blob when available,
+    otherwise falls back to hashing while copying.
+    """
+    stream = file.stream
+    if isinstance(stream, HashingFileStream):
+        return stream.commit(dest_path)
+
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(dest_path, 'wb') as out:
+        for chunk in iter(lambda: stream.read(64 * 1024), b''):
+            sha256.update(chunk)
+            size += len(chunk)
+            out.write(chunk)
+    return {"sha256": sha256.hexdigest(), "size": size, "deduplicated": False}